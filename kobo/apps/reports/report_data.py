@@ -1,40 +1,135 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import datetime
+import hashlib
 import itertools
-from collections import OrderedDict
+import threading
+from collections import Counter, OrderedDict, defaultdict
 from copy import deepcopy
 
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from formpack import FormPack
+from formpack.schema.datadef import FormSection
 from rest_framework import serializers
 
 from .constants import SPECIFIC_REPORTS_KEY, DEFAULT_REPORTS_KEY
+from kpi.models.report_aggregate import ReportAggregate
 from kpi.utils.log import logging
+from kpi.utils.mongo_helper import MongoHelper
 
 
-def build_formpack(asset, submission_stream=None, use_all_form_versions=True):
+FUZZY_VERSION_ID_KEY = '_version_'
+# Pass as `fields` to `build_formpack()` to retrieve the submission data needed
+# by every field of the form
+ALL_FIELDS = '__all__'
+# Always retrieved, whatever the projection. These cover the `COPY_FIELDS` of
+# exports, as well as the usual version ids. Submissions may hold other
+# version ids, which is why `build_formpack()` only projects when
+# `_infer_version_id()` does not need them
+SUBMISSION_METADATA_KEYS = (
+    '_id',
+    '_uuid',
+    '_submission_time',
+    '_validation_status',
+    '__version__',
+    FUZZY_VERSION_ID_KEY,
+)
+INFERRED_VERSION_ID_KEY = '__inferred_version__'
+
+# Most recently used `FormPack`s, keyed by asset and deployed versions. See
+# `_get_formpack()`
+FORMPACK_CACHE_MAX_SIZE = 20
+_formpack_cache = OrderedDict()
+_formpack_cache_lock = threading.Lock()
+
+# Number of values of the `split_by` question that reports are split into,
+# the most common ones first
+SPLIT_BY_TOP_VALUES_COUNT = 5
+# Seconds after which a pending aggregate update is assumed lost, e.g. because
+# its worker died, and may be requested again; see
+# `request_report_aggregate_update()`
+UPDATE_LOCK_TIMEOUT = 60 * 60
+# `ReportAggregate` fields checked before saving an update, so that it is
+# discarded if another one was saved meanwhile
+AGGREGATE_STATE_FIELDS = (
+    'formpack_key',
+    'submission_count',
+    'last_submission_time',
+    'last_submission_id',
+    'date_rebuilt',
+)
+
+
+def _get_top_level_submission_key(field):
     '''
-    Return a tuple containing a `FormPack` instance and the iterable stream of
-    submissions for the given `asset`. If `use_all_form_versions` is `False`,
-    then only the newest version of the form is considered, and all submissions
-    are assumed to have been collected with that version of the form.
+    Return the key under which the data for a formpack `field` is found in a
+    submission: fields within repeating groups are stored in a list under the
+    key of their outermost repeating group
     '''
-    FUZZY_VERSION_ID_KEY = '_version_'
-    INFERRED_VERSION_ID_KEY = '__inferred_version__'
+    # `hierarchy` begins with the root section and ends with the field itself
+    for ancestor in field.hierarchy[1:-1]:
+        if isinstance(ancestor, FormSection):
+            return ancestor.path
+    return field.path
 
-    if not asset.has_deployment:
-        raise Exception('Cannot build formpack for asset without deployment')
 
-    if use_all_form_versions:
-        _versions = asset.deployed_versions
-    else:
-        _versions = [asset.deployed_versions.first()]
+def get_submission_keys(pack, field_names=ALL_FIELDS):
+    '''
+    Return the sorted list of top-level submission keys that must be retrieved
+    to process the fields of `pack` named in `field_names` (or all fields when
+    `field_names` is `ALL_FIELDS`). Suitable for use as a Mongo projection
+    '''
+    keys = set(SUBMISSION_METADATA_KEYS)
+    for field in pack.get_fields_for_versions(versions=pack.versions.keys()):
+        if (
+            field_names == ALL_FIELDS or
+            field.name in field_names or
+            # Needed to infer the version of each submission
+            FUZZY_VERSION_ID_KEY in field.name
+        ):
+            keys.add(_get_top_level_submission_key(field))
+    return sorted(keys)
+
+
+def clear_formpack_cache(asset_uid=None):
+    '''
+    Forget the `FormPack`s built in this process for the asset with
+    `asset_uid`, or for all assets. Others processes do not need it, since a
+    new deployment changes the cache key anyway
+    '''
+    with _formpack_cache_lock:
+        for key in _formpack_cache.keys():
+            if asset_uid is None or key[0] == asset_uid:
+                del _formpack_cache[key]
 
+
+def _get_formpack(asset, versions):
+    '''
+    Return a tuple of the `FormPack` built from `versions`, which must be
+    ordered from newest to oldest, and of the uids of the versions it
+    includes. Building a `FormPack` is expensive, so the most recently used
+    ones are kept in memory
+    '''
+    key = (asset.uid, asset.name, tuple(v.uid for v in versions))
+    with _formpack_cache_lock:
+        try:
+            cached = _formpack_cache.pop(key)
+        except KeyError:
+            pass
+        else:
+            _formpack_cache[key] = cached
+            return cached
+
+    # `versions` only has what is needed for the key; retrieve the content
+    deployed_versions = asset.deployed_versions.filter(
+        uid__in=[v.uid for v in versions])
     schemas = []
-    version_ids_newest_first = []
-    for v in _versions:
+    schema_version_uids = []
+    for v in deployed_versions:
         try:
             fp_schema = v.to_formpack_schema()
         # FIXME: should FormPack validation errors have their own
@@ -49,9 +144,7 @@ def build_formpack(asset, submission_stream=None, use_all_form_versions=True):
         else:
             fp_schema['version_id_key'] = INFERRED_VERSION_ID_KEY
             schemas.append(fp_schema)
-            version_ids_newest_first.append(v.uid)
-            if v.uid_aliases:
-                version_ids_newest_first.extend(v.uid_aliases)
+            schema_version_uids.append(v.uid)
 
     if not schemas:
         raise Exception('Cannot build formpack without any schemas')
@@ -59,11 +152,72 @@ def build_formpack(asset, submission_stream=None, use_all_form_versions=True):
     # FormPack() expects the versions to be ordered from oldest to newest
     pack = FormPack(versions=reversed(schemas), title=asset.name, id_string=asset.uid)
 
-    # Find the AssetVersion UID for each deprecated reversion ID
-    _reversion_ids = dict([
-        (str(v._reversion_version_id), v.uid)
-            for v in _versions if v._reversion_version_id
-    ])
+    cached = (pack, frozenset(schema_version_uids))
+    with _formpack_cache_lock:
+        _formpack_cache[key] = cached
+        while len(_formpack_cache) > FORMPACK_CACHE_MAX_SIZE:
+            _formpack_cache.popitem(last=False)
+    return cached
+
+
+def build_formpack(asset, submission_stream=None, use_all_form_versions=True,
+                   query=None, fields=None):
+    '''
+    Return a tuple containing a `FormPack` instance and the iterable stream of
+    submissions for the given `asset`. If `use_all_form_versions` is `False`,
+    then only the newest version of the form is considered, and all submissions
+    are assumed to have been collected with that version of the form.
+
+    When `submission_stream` is not provided, submissions are retrieved from
+    the deployment, filtered by the Mongo `query` if one is given. To avoid
+    transferring data that will be thrown away, pass the names of the formpack
+    fields that will be used (or `ALL_FIELDS`) as `fields`: only the necessary
+    submission keys will be retrieved (see `get_submission_keys()`). This only
+    applies when the version of the submissions needs no inferring, i.e. when
+    `pack` has a single version; otherwise, any key could hold a version id
+    (see `_infer_version_id()`) and whole submissions are retrieved.
+
+    The returned `FormPack` may be shared with other callers, and must not be
+    modified
+    '''
+    if not asset.has_deployment:
+        raise Exception('Cannot build formpack for asset without deployment')
+
+    _versions = asset.asset_versions.filter(deployed=True).order_by(
+        '-date_modified').only('uid', 'uid_aliases', '_reversion_version')
+    if not use_all_form_versions:
+        _versions = _versions[:1]
+    _versions = list(_versions)
+    if not _versions:
+        raise Exception('Cannot build formpack without any schemas')
+
+    pack, schema_version_uids = _get_formpack(asset, _versions)
+
+    version_ids_newest_first = []
+    for v in _versions:
+        if v.uid in schema_version_uids:
+            version_ids_newest_first.append(v.uid)
+            if v.uid_aliases:
+                version_ids_newest_first.extend(v.uid_aliases)
+
+    # Rank of each version id, lower meaning newer, so that finding the newest
+    # version of a submission does not require searching the whole list
+    version_id_ranks = {}
+    for rank, version_id in enumerate(version_ids_newest_first):
+        version_id_ranks.setdefault(version_id, rank)
+    # Deprecated reversion IDs rank like the UIDs of their corresponding
+    # AssetVersions
+    for v in _versions:
+        if v._reversion_version_id:
+            reversion_id = str(v._reversion_version_id)
+            if v.uid in version_id_ranks:
+                version_id_ranks[reversion_id] = version_id_ranks[v.uid]
+            else:
+                version_id_ranks.pop(reversion_id, None)
+
+    # Submissions of a form share most of their keys; remember which ones
+    # hold version ids
+    version_keys = {}
 
     # A submission often contains many version keys, e.g. `__version__`,
     # `_version_`, `_version__001`, `_version__002`, each with a different
@@ -75,34 +229,50 @@ def build_formpack(asset, submission_stream=None, use_all_form_versions=True):
             submission[INFERRED_VERSION_ID_KEY] = version_ids_newest_first[0]
             return submission
 
-        submission_version_ids = [
-            val for key, val in submission.iteritems()
-                if FUZZY_VERSION_ID_KEY in key
-        ]
-        # Replace any deprecated reversion IDs with the UIDs of their
-        # corresponding AssetVersions
-        submission_version_ids = [
-            _reversion_ids[x] if x in _reversion_ids
-                else x for x in submission_version_ids
-        ]
-        inferred_version_id = None
-        for extant_version_id in version_ids_newest_first:
-            if extant_version_id in submission_version_ids:
-                inferred_version_id = extant_version_id
-                break
-        if not inferred_version_id:
+        inferred_rank = None
+        for key, val in submission.iteritems():
+            try:
+                is_version_key = version_keys[key]
+            except KeyError:
+                is_version_key = version_keys[key] = \
+                    FUZZY_VERSION_ID_KEY in key
+            if not is_version_key:
+                continue
+            try:
+                rank = version_id_ranks.get(val)
+            except TypeError:
+                # Not a version id, e.g. the list of a repeating group whose
+                # name happens to contain `FUZZY_VERSION_ID_KEY`
+                continue
+            if rank is not None and (inferred_rank is None or
+                                     rank < inferred_rank):
+                inferred_rank = rank
+        if inferred_rank is None:
             # Fall back on the latest version
             # TODO: log a warning?
-            inferred_version_id = version_ids_newest_first[0]
-        submission[INFERRED_VERSION_ID_KEY] = inferred_version_id
+            inferred_rank = 0
+        submission[INFERRED_VERSION_ID_KEY] = \
+            version_ids_newest_first[inferred_rank]
         return submission
 
     if submission_stream is None:
         _userform_id = asset.deployment.mongo_userform_id
-        if not _userform_id.startswith(asset.owner.username):
+        # Backends that do not use Mongo (i.e. the mock one) have no
+        # `mongo_userform_id`
+        if (_userform_id is not None and
+                not _userform_id.startswith(asset.owner.username)):
             raise Exception('asset has unexpected `mongo_userform_id`')
 
-        submission_stream = asset.deployment.get_submissions()
+        get_submissions_kwargs = {}
+        if query is not None:
+            get_submissions_kwargs['query'] = query
+        # A projection would drop the version ids that are not form fields;
+        # see `_infer_version_id()`
+        if fields is not None and len(pack.versions) == 1:
+            get_submissions_kwargs['fields'] = get_submission_keys(
+                pack, fields)
+        submission_stream = asset.deployment.get_submissions(
+            **get_submissions_kwargs)
 
     submission_stream = (
         _infer_version_id(submission) for submission in submission_stream
@@ -121,16 +291,393 @@ def _vnames(asset, cache=False):
     return asset._available_report_uids
 
 
+def _get_formpack_key(pack):
+    # The versions determine the fields, and the fields along with
+    # `REPORT_FIELDS_PER_TASK` determine the field groups
+    key = '{}:{}'.format(','.join(sorted(pack.versions.keys())),
+                         settings.REPORT_FIELDS_PER_TASK)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _load_counter(pairs):
+    counter = Counter()
+    for value, count in pairs:
+        counter[value] += count
+    return counter
+
+
+def _load_metrics(metrics, split):
+    # JSON objects only have string keys, so counters are stored as lists of
+    # `[value, count]` pairs
+    if split:
+        fields = dict(
+            (name, defaultdict(Counter, [
+                (value, _load_counter(splitters)) for value, splitters in pairs
+            ])) for name, pairs in metrics.get('fields', {}).iteritems()
+        )
+    else:
+        fields = dict(
+            (name, _load_counter(pairs))
+            for name, pairs in metrics.get('fields', {}).iteritems()
+        )
+    splitters = _load_counter(metrics.get('splitters', []))
+    versions = _load_counter(metrics.get('versions', []))
+    return fields, splitters, versions
+
+
+def _dump_metrics(fields, splitters, versions, split):
+    if split:
+        dumped_fields = dict(
+            (name, [[value, counter.items()]
+                    for value, counter in counters.iteritems()])
+            for name, counters in fields.iteritems()
+        )
+        return {'fields': dumped_fields, 'splitters': splitters.items(),
+                'versions': versions.items()}
+    dumped_fields = dict((name, counter.items())
+                         for name, counter in fields.iteritems())
+    return {'fields': dumped_fields, 'versions': versions.items()}
+
+
+def _count_submission(submission, fields, split_by_field, metrics, splitters):
+    '''
+    Add `submission` to `metrics`, the same way formpack's `AutoReport` does.
+    `AutoReport` only returns the final statistics, not the counters they are
+    computed from, so it cannot be given only the new submissions; the tests
+    compare the resulting reports to its own
+    '''
+    if split_by_field is None:
+        for field in fields:
+            counter = metrics.setdefault(field.name, Counter())
+            raw_value = submission.get(field.path)
+            if raw_value is None:
+                counter[None] += 1
+            else:
+                counter.update(field.parse_values(raw_value))
+                counter['__submissions__'] += 1
+        return
+
+    splitter = submission.get(split_by_field.path)
+    splitters[splitter] += 1
+    for field in fields:
+        counters = metrics.setdefault(field.name, defaultdict(Counter))
+        raw_value = submission.get(field.path)
+        if raw_value is None:
+            values = (None,)
+        else:
+            values = field.parse_values(raw_value)
+        for value in values:
+            counters[value][splitter] += 1
+
+
+def _get_top_splitters(split_by_field, splitters, lang):
+    # Like formpack, only report the most common values of `split_by_field`
+    top_splitters = []
+    for value, _ in splitters.most_common(SPLIT_BY_TOP_VALUES_COUNT):
+        option = split_by_field.choice.options.get(value, {})
+        top_splitters.append(
+            (value, option.get('labels', {}).get(lang, value)))
+    return top_splitters
+
+
+def _get_update_lock_key(asset_uid, split_by, rebuild, field_group):
+    return 'report_aggregate_update:{}:{}:{}:{}'.format(
+        asset_uid, split_by, int(rebuild),
+        'all' if field_group is None else field_group)
+
+
+def _dispatch_update(asset_uid, split_by, rebuild, field_group=None):
+    lock_key = _get_update_lock_key(asset_uid, split_by, rebuild,
+                                    field_group)
+    if not cache.add(lock_key, True, UPDATE_LOCK_TIMEOUT):
+        return
+    from kpi.tasks import update_report_aggregate_in_background
+    try:
+        update_report_aggregate_in_background.delay(
+            asset_uid=asset_uid, split_by=split_by, rebuild=rebuild,
+            field_group=field_group)
+    except Exception:
+        cache.delete(lock_key)
+        raise
+
+
+def request_report_aggregate_update(asset, split_by='', rebuild=False):
+    '''
+    Have Celery workers bring the `ReportAggregate`s of `asset` for
+    `split_by` up to date (see `update_report_aggregate()`), unless such an
+    update is already pending. The task dispatches one more task per group
+    of fields (see `_get_field_groups()`), so that the statistics of wide
+    forms are computed concurrently
+    '''
+    _dispatch_update(asset.uid, split_by, rebuild)
+
+
+def update_report_aggregate_from_task(asset_uid, split_by='', rebuild=False,
+                                      field_group=None):
+    '''
+    Called by the tasks `request_report_aggregate_update()` dispatches:
+    updates the `ReportAggregate` of `field_group`, or, when it is `None`,
+    dispatches a task for each group of fields. Lets the next request
+    dispatch another one once done
+    '''
+    # `kpi.models` imports this module
+    from kpi.models import Asset
+    try:
+        try:
+            asset = Asset.objects.get(uid=asset_uid)
+        except Asset.DoesNotExist:
+            return
+        if not asset.has_deployment:
+            return
+        pack, _ = build_formpack(asset, submission_stream=[])
+        split_by_field = None
+        if split_by:
+            split_by_field = _get_fields_by_name(pack).get(split_by)
+            if split_by_field is None:
+                # Removed by a new deployment meanwhile
+                return
+        field_groups = _get_field_groups(pack)
+        if field_group is None:
+            for index in range(len(field_groups)):
+                _dispatch_update(asset_uid, split_by, rebuild, index)
+            return
+        if field_group >= len(field_groups):
+            # A new deployment has fewer fields
+            return
+        update_report_aggregate(asset, pack, field_groups[field_group],
+                                split_by_field, rebuild=rebuild,
+                                field_group=field_group)
+    finally:
+        cache.delete(_get_update_lock_key(asset_uid, split_by, rebuild,
+                                          field_group))
+
+
+def update_report_aggregate(asset, pack, fields, split_by_field=None,
+                            rebuild=False, field_group=0):
+    '''
+    Bring the `ReportAggregate` of `asset` for `split_by_field` and
+    `field_group` up to date and return it. Only the submissions received
+    since the last update are read, unless `rebuild` is `True`, the deployed
+    versions have changed, submissions have been deleted, or the last full
+    read is older than `settings.REPORT_AGGREGATE_MAX_AGE` seconds, in which
+    case all of them are. The periodic full read is what catches edited submissions, as well
+    as deletions hidden by as many new submissions.
+
+    `fields` are the formpack fields of `pack` to compute the statistics of,
+    i.e. those of `field_group`. They are all counted in a single pass over
+    the submissions, which, like in `AutoReport`, skips those whose version
+    is not part of `pack`. Each group of fields is counted by its own task,
+    with its own projection of the submissions.
+
+    No lock is held while reading submissions. If another update saved the
+    aggregate meanwhile, this one is discarded and the stored aggregate is
+    returned instead. This runs in a Celery task; requests only read
+    aggregates (see `data_by_identifiers()`)
+    '''
+    split_by = split_by_field.name if split_by_field else ''
+    formpack_key = _get_formpack_key(pack)
+    aggregate, _ = ReportAggregate.objects.get_or_create(
+        asset=asset, split_by=split_by, field_group=field_group)
+    loaded_state = {field: getattr(aggregate, field)
+                    for field in AGGREGATE_STATE_FIELDS}
+
+    max_age = datetime.timedelta(seconds=settings.REPORT_AGGREGATE_MAX_AGE)
+    incremental = (
+        not rebuild and
+        aggregate.formpack_key == formpack_key and
+        aggregate.last_submission_id is not None and
+        aggregate.date_rebuilt is not None and
+        aggregate.date_rebuilt > timezone.now() - max_age
+    )
+    _update_report_aggregate(aggregate, asset, pack, fields,
+                             split_by_field, incremental)
+    # Unlike asset lists, nothing prefetched a cached count for `asset`
+    if incremental and aggregate.submission_count > \
+            asset.deployment.submission_count:
+        # Submissions have been deleted since the last update
+        incremental = False
+        _update_report_aggregate(aggregate, asset, pack, fields,
+                                 split_by_field, False)
+    if not incremental:
+        aggregate.date_rebuilt = timezone.now()
+    aggregate.formpack_key = formpack_key
+
+    values = {field: getattr(aggregate, field)
+              for field in AGGREGATE_STATE_FIELDS}
+    values.update(metrics=aggregate.metrics, date_modified=timezone.now())
+    if not ReportAggregate.objects.filter(
+            pk=aggregate.pk, **loaded_state).update(**values):
+        aggregate.refresh_from_db()
+    return aggregate
+
+
+def _count_submissions(asset, pack, fields, split_by_field, query):
+    '''
+    Return a tuple of the metrics of `fields`, of the `split_by_field` values
+    (see `_count_submission()`) and of the versions of the submissions
+    matching `query`, of the number of submissions read, and of the position
+    of the last one (`None` if unknown). Only the keys needed by `fields` are
+    retrieved, unless versions must be inferred (see `build_formpack()`)
+    '''
+    field_names = [field.name for field in fields]
+    if split_by_field is not None:
+        field_names.append(split_by_field.name)
+    # Infer the version of each submission the same way as for `AutoReport`
+    _, submission_stream = build_formpack(asset, query=query,
+                                          fields=field_names)
+
+    metrics = {}
+    splitters = Counter()
+    versions = Counter()
+    count = 0
+    position = None
+    complete_positions = True
+    for submission in submission_stream:
+        count += 1
+        submission_position = (submission.get('_submission_time'),
+                               submission.get('_id'))
+        if None in submission_position:
+            complete_positions = False
+        elif position is None or submission_position > position:
+            position = submission_position
+        version_id = submission[INFERRED_VERSION_ID_KEY]
+        if version_id not in pack.versions:
+            continue
+        versions[version_id] += 1
+        _count_submission(submission, fields, split_by_field, metrics,
+                          splitters)
+    if not complete_positions:
+        position = None
+    return metrics, splitters, versions, count, position
+
+
+def _update_report_aggregate(aggregate, asset, pack, fields, split_by_field,
+                             incremental):
+    split = split_by_field is not None
+    query = None
+    if incremental:
+        metrics, splitters, versions = _load_metrics(aggregate.metrics, split)
+        position = (aggregate.last_submission_time,
+                    aggregate.last_submission_id)
+        query = MongoHelper.get_keyset_query(
+            None, '_submission_time', 1,
+            {'value': position[0], '_id': position[1]})
+    else:
+        metrics, splitters, versions = {}, Counter(), Counter()
+        position = None
+        aggregate.submission_count = 0
+
+    (new_metrics, new_splitters, new_versions, new_count,
+     new_position) = _count_submissions(asset, pack, fields, split_by_field,
+                                        query)
+
+    for name, new_counter in new_metrics.iteritems():
+        if split:
+            counters = metrics.setdefault(name, defaultdict(Counter))
+            for value, counter in new_counter.iteritems():
+                counters[value].update(counter)
+        else:
+            metrics.setdefault(name, Counter()).update(new_counter)
+    splitters.update(new_splitters)
+    versions.update(new_versions)
+    aggregate.metrics = _dump_metrics(metrics, splitters, versions, split)
+    aggregate.submission_count += new_count
+
+    if new_count and new_position is None:
+        # The new submissions cannot be told apart from the others: start
+        # from scratch next time
+        position = None
+    elif new_position is not None:
+        position = new_position
+    aggregate.last_submission_time, aggregate.last_submission_id = \
+        position or (None, None)
+
+
+def _get_fields_by_name(pack):
+    return OrderedDict([
+        (field.name, field) for field in
+        pack.get_fields_for_versions(versions=pack.versions.keys())
+    ])
+
+
+def _get_report_fields(pack):
+    '''
+    Return the fields of `pack` whose statistics `ReportAggregate`s hold, in
+    the order of `AutoReport`. As there, the `split_by` field is included
+    '''
+    return [field for field in _get_fields_by_name(pack).values()
+            if field.has_stats]
+
+
+def _get_field_groups(pack):
+    '''
+    Split the report fields of `pack` into consecutive groups of at most
+    `settings.REPORT_FIELDS_PER_TASK` fields, each with its own
+    `ReportAggregate`. There is always at least one group, if only an empty
+    one
+    '''
+    fields = _get_report_fields(pack)
+    size = settings.REPORT_FIELDS_PER_TASK
+    return [fields[i:i + size] for i in range(0, len(fields), size)] or [[]]
+
+
+def _get_aggregated_stats(aggregates, pack, field_names, lang,
+                          split_by_field):
+    '''
+    Same as `AutoReport.get_stats()`, but computed from the `aggregates` of
+    every field group instead of from the submissions themselves
+    '''
+    split = split_by_field is not None
+    metrics = {}
+    splitters = None
+    for aggregate in aggregates:
+        group_metrics, group_splitters = _load_metrics(aggregate.metrics,
+                                                       split)[:2]
+        metrics.update(group_metrics)
+        if splitters is None:
+            # Every group counts the values of `split_by_field`; those of
+            # the first one split all fields, so that they are split the
+            # same way
+            splitters = group_splitters
+    if split:
+        top_splitters = _get_top_splitters(split_by_field, splitters, lang)
+
+    field_names = set(field_names)
+    for field in _get_report_fields(pack):
+        if field.name not in field_names:
+            continue
+        if split_by_field is None:
+            stats = field.get_stats(metrics.get(field.name, Counter()),
+                                    lang=lang)
+        else:
+            stats = field.get_disaggregated_stats(
+                metrics.get(field.name, defaultdict(Counter)), lang=lang,
+                top_splitters=top_splitters)
+        yield (field, field.get_labels(lang)[0], stats)
+
+
 def data_by_identifiers(asset, field_names=None, submission_stream=None,
                         report_styles=None, lang=None, fields=None,
-                        split_by=None):
-    pack, submission_stream = build_formpack(asset, submission_stream)
+                        split_by=None, rebuild=False):
+    '''
+    Return the statistics of the fields named in `field_names` (or all
+    fields), formatted for the reports API. Unless a `submission_stream` is
+    given, they come from the asset's `ReportAggregate`s, as of their last
+    update; an update including the newer submissions is requested from
+    Celery (see `request_report_aggregate_update()`). Pass `rebuild=True` to
+    have all submissions read again.
+
+    Submissions are only read here when there is no aggregate for the
+    current deployment yet, or when `rebuild` is `True`. Nothing is written
+    to the database either way
+    '''
+    aggregates = None
+    if submission_stream is None:
+        pack, _ = build_formpack(asset, submission_stream=[])
+    else:
+        pack, submission_stream = build_formpack(asset, submission_stream)
     _all_versions = pack.versions.keys()
-    report = pack.autoreport(versions=_all_versions)
-    fields_by_name = OrderedDict([
-            (field.name, field) for field in
-                pack.get_fields_for_versions(versions=_all_versions)
-        ])
+    fields_by_name = _get_fields_by_name(pack)
     if field_names is None:
         field_names = fields_by_name.keys()
     if split_by and (split_by not in fields_by_name):
@@ -138,6 +685,21 @@ def data_by_identifiers(asset, field_names=None, submission_stream=None,
     if split_by and (fields_by_name[split_by].data_type != 'select_one'):
         raise serializers.ValidationError(_("`split_by` field '{}' is not a select one question.").
                                           format(split_by))
+    if submission_stream is None:
+        request_report_aggregate_update(asset, split_by or '', rebuild)
+        if not rebuild:
+            aggregates = list(ReportAggregate.objects.filter(
+                asset=asset, split_by=split_by or '',
+                formpack_key=_get_formpack_key(pack)
+            ).order_by('field_group'))
+            if len(aggregates) != len(_get_field_groups(pack)):
+                # Some groups of fields have not been counted yet
+                aggregates = None
+        if aggregates is None:
+            # Do not wait for the task
+            _, submission_stream = build_formpack(
+                asset, fields=list(field_names) + ([split_by] if split_by
+                                                   else []))
     if report_styles is None:
         report_styles = asset.report_styles
     specified_styles = report_styles.get('specified', {})
@@ -171,9 +733,14 @@ def data_by_identifiers(asset, field_names=None, submission_stream=None,
             'style': specified_styles.get(identifier, {}),
         }
 
+    if aggregates is not None:
+        stats = _get_aggregated_stats(
+            aggregates, pack, field_names, lang,
+            fields_by_name[split_by] if split_by else None)
+    else:
+        report = pack.autoreport(versions=_all_versions)
+        stats = report.get_stats(submission_stream, fields=field_names,
+                                 lang=lang, split_by=split_by)
     return [_package_stat(*stat_tup, split_by=split_by) for
-            stat_tup in report.get_stats(submission_stream,
-                                         fields=field_names,
-                                         lang=lang,
-                                         split_by=split_by)
+            stat_tup in stats
     ]
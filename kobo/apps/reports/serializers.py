@@ -23,8 +23,11 @@ class ReportsDetailSerializer(serializers.BaseSerializer):
             vnames = None
 
         split_by = request.query_params.get('split_by', None)
+        # Read all submissions again instead of only the new ones
+        rebuild = request.query_params.get('rebuild', 'false').lower() == 'true'
 
-        _list = report_data.data_by_identifiers(obj, vnames, split_by=split_by)
+        _list = report_data.data_by_identifiers(obj, vnames, split_by=split_by,
+                                                rebuild=rebuild)
 
         return {
             'url': reverse('reports-detail', args=(obj.uid,), request=request),
@@ -172,6 +172,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'kpi.middleware.PermissionCacheMiddleware',
     # TODO: Uncomment this when interoperability with dkobo is no longer
     # needed. See https://code.djangoproject.com/ticket/21649
     #'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
@@ -260,6 +261,26 @@ ALLOWED_ANONYMOUS_PERMISSIONS = (
 # NOTE: this should be set to False for major deployments. This can take a long time
 SKIP_HEAVY_MIGRATIONS = os.environ.get('SKIP_HEAVY_MIGRATIONS', 'False') == 'True'
 
+# Maximum total size, in bytes, of the XML kept by `kpi.models.XFormCache`
+XFORM_CACHE_MAX_SIZE = int(os.environ.get('XFORM_CACHE_MAX_SIZE',
+                                          100 * 1024 * 1024))
+
+# Seconds after which the report aggregates of an asset are computed again
+# from every submission, to account for edited or deleted ones; see
+# `kobo.apps.reports.report_data.update_report_aggregate()`
+REPORT_AGGREGATE_MAX_AGE = int(os.environ.get('REPORT_AGGREGATE_MAX_AGE',
+                                              24 * 60 * 60))
+
+# The report statistics of forms with more fields than this are computed by
+# several Celery tasks, each counting a group of at most this many fields
+REPORT_FIELDS_PER_TASK = int(os.environ.get('REPORT_FIELDS_PER_TASK', 100))
+
+# Number of seconds during which the submission counts retrieved from KoBoCAT
+# for the asset list are reused; see
+# `KobocatDeploymentBackend.prefetch_submission_counts()`
+SUBMISSION_COUNT_CACHE_TIMEOUT = int(
+    os.environ.get('SUBMISSION_COUNT_CACHE_TIMEOUT', 30))
+
 # Database
 # https://docs.djangoproject.com/en/1.7/ref/settings/#databases
 DATABASES = {
@@ -297,6 +318,10 @@ CAN_LOGIN_AS = lambda request, target_user: request.user.is_superuser
 # REMOVE the oldest if a user exceeds this many exports for a particular form
 MAXIMUM_EXPORTS_PER_USER_PER_FORM = 10
 
+# Maximum `shard_count` of a CSV export, i.e. number of Celery tasks that
+# render it; see `kpi.models.ExportTask`
+EXPORT_MAX_SHARDS = int(os.environ.get('EXPORT_MAX_SHARDS', 8))
+
 # Private media file configuration
 PRIVATE_STORAGE_ROOT = os.path.join(BASE_DIR, 'media')
 PRIVATE_STORAGE_AUTH_FUNCTION = \
@@ -435,6 +460,11 @@ HAYSTACK_SIGNAL_MODELS = (
 # If this causes performance trouble, see
 # http://django-haystack.readthedocs.org/en/latest/best_practices.html#use-of-a-queue-for-a-better-user-experience
 HAYSTACK_SIGNAL_PROCESSOR = 'kpi.haystack_utils.SignalProcessor'
+# Changes to the models above are queued, then indexed in batches by a Celery
+# task that runs `SEARCH_INDEX_QUEUE_DELAY` seconds later. When
+# `SEARCH_INDEX_ASYNC` is `False`, they are indexed right away instead
+SEARCH_INDEX_ASYNC = os.environ.get('SEARCH_INDEX_ASYNC', 'True') == 'True'
+SEARCH_INDEX_QUEUE_DELAY = int(os.environ.get('SEARCH_INDEX_QUEUE_DELAY', 5))
 
 # Enketo settings copied from dkobo.
 ENKETO_SERVER = os.environ.get('ENKETO_URL') or os.environ.get('ENKETO_SERVER', 'https://enketo.org')
@@ -491,6 +521,13 @@ CELERY_BEAT_SCHEDULE = {
     #    'task': 'kpi.tasks.update_search_index',
     #    'schedule': timedelta(hours=12)
     #},
+    # Failsafe for changes queued for search indexing while the task
+    # triggered by the change was already running
+    'update-search-index-from-queue': {
+        'task': 'kpi.tasks.update_search_index_from_queue',
+        'schedule': timedelta(minutes=10),
+        'options': {'queue': 'kpi_queue'}
+    },
     # Schedule every day at midnight UTC. Can be customized in admin section
     "send-hooks-failures-reports": {
         "task": "kobo.apps.hook.tasks.failures_reports",
@@ -8,5 +8,8 @@ DATABASES = {
     'default': dj_database_url.config(default="sqlite:///%s/db.sqlite3" % BASE_DIR),
 }
 
+# Keep the search index up to date without Celery
+SEARCH_INDEX_ASYNC = False
+
 if 'KPI_AWS_STORAGE_BUCKET_NAME' in os.environ:
     PRIVATE_STORAGE_S3_REVERSE_PROXY = False
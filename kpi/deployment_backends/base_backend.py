@@ -1,5 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from django.utils.translation import ugettext as _
+
+from kpi.constants import INSTANCE_FORMAT_TYPE_JSON, INSTANCE_FORMAT_TYPE_XML
+from kpi.utils.mongo_helper import MongoHelper
 
 
 class BaseDeploymentBackend(object):
@@ -11,9 +17,11 @@ class BaseDeploymentBackend(object):
 
     def store_data(self, vals=None):
         self.asset._deployment_data.update(vals)
+        self.asset.sync_deployment_fields()
 
     def delete(self):
         self.asset._deployment_data.clear()
+        self.asset.sync_deployment_fields()
 
     @property
     def backend(self):
@@ -35,6 +43,15 @@ class BaseDeploymentBackend(object):
     def version_id(self):
         return self.asset._deployment_data.get('version', None)
 
+    @classmethod
+    def prefetch_submission_counts(cls, assets):
+        """
+        Retrieves the submission counts of several assets deployed with this
+        backend at once, before `submission_count` is read for each of them
+        (see `Asset.prefetch_submission_counts()`). Nothing to do by default
+        """
+        pass
+
     @property
     def submission_count(self):
         return self._submission_count()
@@ -46,3 +63,60 @@ class BaseDeploymentBackend(object):
     @property
     def mongo_userform_id(self):
         return None
+
+    def get_submissions_page(self, format_type=INSTANCE_FORMAT_TYPE_JSON,
+                             cursor=None, **kwargs):
+        """
+        Keyset (a.k.a. cursor) pagination of submissions: instead of skipping
+        `start` submissions, retrieves the `limit` submissions that follow
+        the position encoded in `cursor`.
+
+        :param format_type: str. INSTANCE_FORMAT_TYPE_JSON|INSTANCE_FORMAT_TYPE_XML
+        :param cursor: str. Returned by a previous call. Empty for the first page
+        :param kwargs: dict. Same filter parameters as `get_submissions()`,
+            except `start`. `sort` must contain only one field
+        :return: tuple. (list of submissions, cursor of the next page or `None`)
+        """
+        kwargs.pop("start", None)
+        params = MongoHelper.validate_params(**kwargs)
+        sort = params["sort"] or {"_id": 1}
+        if len(sort) != 1:
+            raise ValueError(_("Only one `sort` field is supported with `cursor`"))
+        sort_key, sort_dir = sort.items()[0]
+        sort_dir = int(sort_dir)
+        if format_type == INSTANCE_FORMAT_TYPE_XML and sort_key != "_id":
+            raise ValueError(_("Only `_id` can be sorted on with `cursor` "
+                               "and XML format"))
+
+        limit = params["limit"]
+        query = MongoHelper.get_keyset_query(params["query"], sort_key,
+                                             sort_dir,
+                                             MongoHelper.decode_cursor(cursor))
+        fields = params["fields"]
+        if format_type == INSTANCE_FORMAT_TYPE_XML:
+            fields = ["_id"]
+        elif fields:
+            # The last submission must carry what the next cursor is built on
+            fields = list(set(fields) | {"_id", sort_key})
+
+        submissions = list(self.get_submissions(
+            INSTANCE_FORMAT_TYPE_JSON,
+            query=query,
+            sort={sort_key: sort_dir},
+            limit=limit,
+            fields=fields,
+        ))
+
+        next_cursor = None
+        if submissions and len(submissions) == limit:
+            next_cursor = MongoHelper.encode_cursor(submissions[-1], sort_key)
+
+        if format_type == INSTANCE_FORMAT_TYPE_XML and submissions:
+            instances_ids = [submission["_id"] for submission in submissions]
+            submissions = list(self.get_submissions(
+                INSTANCE_FORMAT_TYPE_XML, instances_ids,
+                sort={"id": sort_dir}))
+        elif format_type == INSTANCE_FORMAT_TYPE_XML:
+            submissions = []
+
+        return submissions, next_cursor
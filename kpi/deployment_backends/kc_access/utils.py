@@ -56,6 +56,31 @@ def last_submission_time(xform_id_string, user_id):
     ).last_submission_time
 
 
+@safe_kc_read
+def instance_counts_and_last_submission_times(xform_keys):
+    '''
+    Retrieves the submission counts and last submission times of several
+    xforms with a single query. `xform_keys` is an iterable of
+    `(user_id, id_string)` tuples; the returned dictionary maps those of them
+    that exist to `(num_of_submissions, last_submission_time)` tuples
+    '''
+    xform_keys = set(xform_keys)
+    if not xform_keys:
+        return {}
+    xforms = ReadOnlyXForm.objects.filter(
+        user_id__in=set(user_id for user_id, _ in xform_keys),
+        id_string__in=set(id_string for _, id_string in xform_keys),
+    ).values_list('user_id', 'id_string', 'num_of_submissions',
+                  'last_submission_time')
+    # The filter above also matches pairs of a user and an `id_string` that
+    # were not requested
+    return {
+        (user_id, id_string): (num_of_submissions, last_submission_time)
+        for user_id, id_string, num_of_submissions, last_submission_time
+        in xforms if (user_id, id_string) in xform_keys
+    }
+
+
 @safe_kc_read
 def get_kc_profile_data(user_id):
     '''
@@ -12,6 +12,7 @@ import posixpath
 
 from bson import json_util
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponse
 from django.utils.translation import ugettext_lazy as _
@@ -22,7 +23,11 @@ from rest_framework.authtoken.models import Token
 
 from ..exceptions import BadFormatException, KobocatDeploymentException
 from .base_backend import BaseDeploymentBackend
-from .kc_access.utils import instance_count, last_submission_time
+from .kc_access.utils import (
+    instance_count,
+    instance_counts_and_last_submission_times,
+    last_submission_time,
+)
 from .kc_access.shadow_models import ReadOnlyInstance, ReadOnlyXForm
 from kpi.constants import INSTANCE_FORMAT_TYPE_JSON, INSTANCE_FORMAT_TYPE_XML
 from kpi.utils.mongo_helper import MongoHelper
@@ -400,7 +405,68 @@ class KobocatDeploymentBackend(BaseDeploymentBackend):
         }
         return links
 
+    @staticmethod
+    def _get_submission_count_cache_key(xform_key):
+        return 'kc_submission_count:{}:{}'.format(*xform_key)
+
+    @classmethod
+    def prefetch_submission_counts(cls, assets):
+        """
+        Retrieves the submission counts and last submission times of `assets`
+        from KoBoCAT with a single query, and stores them on each asset so
+        that `submission_count` and `last_submission_time` do not query
+        KoBoCAT once per asset. Values retrieved less than
+        `settings.SUBMISSION_COUNT_CACHE_TIMEOUT` seconds ago are reused
+        """
+        assets_by_xform_key = {}
+        for asset in assets:
+            backend_response = asset._deployment_data.get(
+                'backend_response', {})
+            try:
+                xform_key = (asset.owner_id, backend_response['id_string'])
+            except KeyError:
+                continue
+            assets_by_xform_key.setdefault(xform_key, []).append(asset)
+        if not assets_by_xform_key:
+            return
+
+        cache_keys = {
+            cls._get_submission_count_cache_key(xform_key): xform_key
+            for xform_key in assets_by_xform_key
+        }
+        stats = {
+            cache_keys[cache_key]: value
+            for cache_key, value in cache.get_many(cache_keys.keys()).items()
+        }
+        missing_xform_keys = set(assets_by_xform_key) - set(stats)
+        if missing_xform_keys:
+            retrieved_stats = instance_counts_and_last_submission_times(
+                missing_xform_keys)
+            stats.update(retrieved_stats)
+            timeout = settings.SUBMISSION_COUNT_CACHE_TIMEOUT
+            if timeout:
+                cache.set_many({
+                    cls._get_submission_count_cache_key(xform_key): value
+                    for xform_key, value in retrieved_stats.items()
+                }, timeout)
+
+        for xform_key, xform_assets in assets_by_xform_key.items():
+            for asset in xform_assets:
+                try:
+                    count, submission_time = stats[xform_key]
+                except KeyError:
+                    # Same as `instance_count()`; leave
+                    # `last_submission_time` to fail as usual
+                    asset.prefetched_submission_count = 0
+                else:
+                    asset.prefetched_submission_count = count
+                    asset.prefetched_last_submission_time = submission_time
+
     def _submission_count(self):
+        try:
+            return self.asset.prefetched_submission_count
+        except AttributeError:
+            pass
         _deployment_data = self.asset._deployment_data
         id_string = _deployment_data['backend_response']['id_string']
         # avoid migrations from being created for kc_access mocked models
@@ -441,6 +507,10 @@ class KobocatDeploymentBackend(BaseDeploymentBackend):
         return self.__prepare_as_drf_response_signature(kc_response)
 
     def _last_submission_time(self):
+        try:
+            return self.asset.prefetched_last_submission_time
+        except AttributeError:
+            pass
         _deployment_data = self.asset._deployment_data
         id_string = _deployment_data['backend_response']['id_string']
         return last_submission_time(
@@ -475,6 +545,48 @@ class KobocatDeploymentBackend(BaseDeploymentBackend):
             )
         return submissions
 
+    def get_submissions_page(self, format_type=INSTANCE_FORMAT_TYPE_JSON,
+                             cursor=None, **kwargs):
+        """
+        See `BaseDeploymentBackend.get_submissions_page()`.
+        XML submissions which are not filtered with a Mongo `query` are
+        paginated directly with PostgreSQL.
+        """
+        if format_type != INSTANCE_FORMAT_TYPE_XML or "query" in kwargs:
+            return super(KobocatDeploymentBackend, self).get_submissions_page(
+                format_type, cursor, **kwargs)
+
+        if "fields" in kwargs:
+            raise ValueError(_("`Fields` param is not supported with XML format"))
+
+        kwargs.pop("start", None)
+        params = MongoHelper.validate_params(**kwargs)
+        sort = params["sort"] or {"_id": 1}
+        if len(sort) != 1 or sort.keys()[0] not in ("_id", "id"):
+            raise ValueError(_("Only `_id` can be sorted on with `cursor` "
+                               "and XML format"))
+        sort_dir = int(sort.values()[0])
+        limit = params["limit"]
+
+        queryset = ReadOnlyInstance.objects.filter(
+            xform_id=self.xform_id,
+            deleted_at=None
+        )
+        position = MongoHelper.decode_cursor(cursor)
+        if position is not None:
+            if sort_dir < 0:
+                queryset = queryset.filter(id__lt=position["_id"])
+            else:
+                queryset = queryset.filter(id__gt=position["_id"])
+        queryset = queryset.order_by("-id" if sort_dir < 0 else "id")
+
+        instances = list(queryset.values_list("id", "xml")[:limit])
+        next_cursor = None
+        if instances and len(instances) == limit:
+            next_cursor = MongoHelper.encode_cursor({"_id": instances[-1][0]})
+
+        return [xml for id_, xml in instances], next_cursor
+
     def get_submission(self, pk, format_type=INSTANCE_FORMAT_TYPE_JSON, **kwargs):
         """
         Returns only one occurrence.
@@ -524,7 +636,8 @@ class KobocatDeploymentBackend(BaseDeploymentBackend):
         instances = MongoHelper.get_instances(self.mongo_userform_id, **kwargs)
 
         return (
-            MongoHelper.to_readable_dict(instance)
+            MongoHelper.to_readable_dict(
+                instance, form_id=self.mongo_userform_id)
             for instance in instances
         )
 
@@ -579,7 +692,9 @@ class KobocatDeploymentBackend(BaseDeploymentBackend):
             limit = offset + params.get("limit")
             queryset = queryset[offset:limit]
 
-        return (lazy_instance.xml for lazy_instance in queryset)
+        # Avoid caching instances within the queryset, they may be streamed.
+        # See `SubmissionViewSet.list()`
+        return queryset.values_list("xml", flat=True).iterator()
 
     @staticmethod
     def __kobocat_proxy_request(kc_request, user=None):
@@ -17,6 +17,7 @@ from .kobocat_backend import KobocatDeploymentBackend
 from .mock_backend import MockDeploymentBackend
 from kpi.exceptions import BadAssetTypeException
 from kpi.constants import ASSET_TYPE_SURVEY
+from kobo.apps.reports.report_data import clear_formpack_cache
 
 
 class DeployableMixin:
@@ -51,6 +52,7 @@ class DeployableMixin:
         latest_version = self.latest_version
         latest_version.deployed = True
         latest_version.save()
+        clear_formpack_cache(self.uid)
 
     @property
     def has_deployment(self):
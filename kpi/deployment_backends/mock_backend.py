@@ -1,6 +1,7 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
+import operator
 import re
 
 from django.core.urlresolvers import reverse
@@ -9,6 +10,7 @@ from rest_framework import status
 
 from .base_backend import BaseDeploymentBackend
 from kpi.constants import INSTANCE_FORMAT_TYPE_JSON, INSTANCE_FORMAT_TYPE_XML
+from kpi.utils.mongo_helper import MongoHelper
 
 
 class MockDeploymentBackend(BaseDeploymentBackend):
@@ -22,6 +24,19 @@ class MockDeploymentBackend(BaseDeploymentBackend):
 
     INSTANCE_ID_FIELDNAME = "id"
 
+    # Subset of Mongo's query operators understood by `get_submissions()`
+    QUERY_OPERATORS = {
+        "$eq": operator.eq,
+        "$ne": operator.ne,
+        "$gt": operator.gt,
+        "$gte": operator.ge,
+        "$lt": operator.lt,
+        "$lte": operator.le,
+        "$in": lambda value, choices: value in choices,
+    }
+    # Like Mongo, these only match values of the same type as their operand
+    COMPARISON_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
     def connect(self, active=False):
         self.store_data({
                 'backend': 'mock',
@@ -138,10 +153,31 @@ class MockDeploymentBackend(BaseDeploymentBackend):
 
         :param format_type: str. xml or json
         :param instances_ids: list. Ids of instances to retrieve
+        :param kwargs: dict. Only `query` (see `QUERY_OPERATORS`), `sort`,
+            `start` and `limit` are supported, and only for JSON.
         :return: list
         """
         submissions = self.asset._deployment_data.get("submissions", [])
 
+        if format_type == INSTANCE_FORMAT_TYPE_JSON:
+            params = MongoHelper.validate_params(**kwargs)
+            query = params["query"]
+            if query:
+                submissions = [submission for submission in submissions
+                               if self._matches_query(submission, query)]
+            sort = params["sort"]
+            if len(sort) == 1:
+                sort_key, sort_dir = sort.items()[0]
+                submissions = sorted(
+                    submissions,
+                    key=lambda submission: (submission.get(sort_key),
+                                            submission.get("_id")),
+                    reverse=int(sort_dir) < 0
+                )
+            if "start" in kwargs or "limit" in kwargs:
+                start = params["start"]
+                submissions = submissions[start:start + params["limit"]]
+
         if len(instances_ids) > 0:
             if format_type == INSTANCE_FORMAT_TYPE_XML:
                 # ugly way to find matches, but it avoids to load each xml in memory.
@@ -154,6 +190,47 @@ class MockDeploymentBackend(BaseDeploymentBackend):
 
         return submissions
 
+    @classmethod
+    def _matches_query(cls, submission, query):
+        """
+        Mimics (very roughly) Mongo's filtering of documents
+
+        :param submission: dict
+        :param query: dict. e.g. `{"_submission_time": {"$gt": "2017-10-23"}}`
+        :return: bool
+        """
+        for field, condition in query.items():
+            if field == "$or":
+                if not any(cls._matches_query(submission, sub_query)
+                           for sub_query in condition):
+                    return False
+                continue
+            if field == "$and":
+                if not all(cls._matches_query(submission, sub_query)
+                           for sub_query in condition):
+                    return False
+                continue
+            # Missing values match `None`, like in Mongo
+            value = submission.get(field)
+            if not isinstance(condition, dict):
+                condition = {"$eq": condition}
+            for operator_, operand in condition.items():
+                if operator_ in cls.COMPARISON_OPERATORS and \
+                        not cls._are_comparable(value, operand):
+                    return False
+                if not cls.QUERY_OPERATORS[operator_](value, operand):
+                    return False
+        return True
+
+    @staticmethod
+    def _are_comparable(value, operand):
+        numbers = (int, long, float)
+        if isinstance(value, numbers) and isinstance(operand, numbers):
+            return True
+        if isinstance(value, basestring) and isinstance(operand, basestring):
+            return True
+        return value is not None and type(value) == type(operand)
+
     def get_submission(self, pk, format_type=INSTANCE_FORMAT_TYPE_JSON, **kwargs):
         if pk:
             submissions = list(self.get_submissions(format_type, [pk], **kwargs))
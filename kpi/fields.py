@@ -13,6 +13,8 @@ from rest_framework.pagination import LimitOffsetPagination
 # should be 22 per shortuuid documentation, but keeping at 21 to avoid having
 # to migrate dkobo (see SurveyDraft.kpi_asset_uid)
 UUID_LENGTH = 21
+# Setting up the alphabet is costly; share it between all UIDs
+SHORT_UUID = ShortUUID()
 
 
 class KpiUidField(models.CharField):
@@ -30,7 +32,7 @@ class KpiUidField(models.CharField):
         return name, path, args, kwargs
 
     def generate_uid(self):
-        return self.uid_prefix + ShortUUID().random(UUID_LENGTH)
+        return self.uid_prefix + SHORT_UUID.random(UUID_LENGTH)
         # When UID_LENGTH is 22, that should be changed to:
         # return self.uid_prefix + shortuuid.uuid()
 
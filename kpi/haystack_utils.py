@@ -1,12 +1,35 @@
 import contextlib
+import operator
+from collections import defaultdict
+
 import haystack
 
 from django.apps import apps as kpi_apps
-from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, models, transaction
 from django.conf import settings
 from django.core import exceptions
+from django.core.cache import cache
+from django.utils import timezone
+from kpi.models.search_index_queue import SearchIndexQueueItem
 from kpi.utils.log import logging
 
+# Number of queued objects indexed, and committed to the index, at once
+SEARCH_INDEX_QUEUE_BATCH_SIZE = 100
+# Objects that failed to be indexed this many times stay in the queue, but are
+# no longer processed until they change again (or the
+# `process_search_index_queue --retry-failed` management command runs)
+SEARCH_INDEX_QUEUE_MAX_ATTEMPTS = 5
+# Held while the queue is processed, so that concurrent workers do not
+# compete for the same objects and index lock. Expires in case its holder dies
+SEARCH_INDEX_QUEUE_LOCK_KEY = 'search_index_queue_lock'
+SEARCH_INDEX_QUEUE_LOCK_TIMEOUT = 30 * 60
+# Set while a task processing the queue is pending, so that the changes made
+# meanwhile do not dispatch more. Expires in case the task is lost; the
+# periodic task catches up meanwhile
+SEARCH_INDEX_TASK_PENDING_KEY = 'search_index_queue_task_pending'
+SEARCH_INDEX_TASK_PENDING_TIMEOUT = 10 * 60
+
 
 def update_object_in_search_index(obj):
     '''
@@ -24,10 +47,163 @@ def update_object_in_search_index(obj):
     index.update_object(obj)
 
 
+def enqueue_for_search_index(obj):
+    '''
+    Queue `obj`, which has been saved or deleted, to have its search index
+    entry updated by `process_search_index_queue()`. Unless
+    `settings.SEARCH_INDEX_ASYNC` is `False`, the queue is processed by a
+    Celery task `settings.SEARCH_INDEX_QUEUE_DELAY` seconds later, so that
+    the changes made in the meantime are indexed together
+    '''
+    content_type = ContentType.objects.get_for_model(obj)
+    # The change may fix whatever made previous attempts fail
+    enqueued_again = SearchIndexQueueItem.objects.filter(
+        content_type=content_type, object_id=obj.pk
+    ).update(date_enqueued=timezone.now(), attempts=0, last_error='')
+    if not enqueued_again:
+        try:
+            with transaction.atomic():
+                SearchIndexQueueItem.objects.create(
+                    content_type=content_type, object_id=obj.pk)
+        except IntegrityError:
+            # Queued concurrently
+            pass
+
+    if not settings.SEARCH_INDEX_ASYNC:
+        process_search_index_queue()
+    else:
+        _dispatch_search_index_task()
+
+
+def _dispatch_search_index_task():
+    '''
+    Have a Celery task process the queue `settings.SEARCH_INDEX_QUEUE_DELAY`
+    seconds from now, unless one is already pending
+    '''
+    if not cache.add(SEARCH_INDEX_TASK_PENDING_KEY, True,
+                     SEARCH_INDEX_TASK_PENDING_TIMEOUT):
+        return
+    # Avoid a circular import
+    from kpi.tasks import update_search_index_from_queue
+    try:
+        update_search_index_from_queue.apply_async(
+            countdown=settings.SEARCH_INDEX_QUEUE_DELAY)
+    except Exception:
+        cache.delete(SEARCH_INDEX_TASK_PENDING_KEY)
+        raise
+
+
+def process_search_index_queue_from_task():
+    '''
+    Called by the Celery task `_dispatch_search_index_task()` dispatches, as
+    well as periodically
+    '''
+    # Changes enqueued from now on need another task
+    cache.delete(SEARCH_INDEX_TASK_PENDING_KEY)
+    if process_search_index_queue() is None:
+        # The worker processing the queue may have read past these changes
+        # already
+        _dispatch_search_index_task()
+
+
+def _update_search_index(items):
+    connection = haystack.connections['default']
+    backend = connection.get_backend()
+    unified_index = connection.get_unified_index()
+    object_ids_by_content_type = defaultdict(set)
+    for item in items:
+        object_ids_by_content_type[item.content_type_id].add(item.object_id)
+
+    for content_type_id, object_ids in \
+            object_ids_by_content_type.iteritems():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        try:
+            index = unified_index.get_index(model)
+        except haystack.exceptions.NotHandled:
+            logging.warning('No search index for type {}'.format(model))
+            continue
+        objs = list(index.index_queryset().filter(pk__in=object_ids))
+        if objs:
+            # Committed to the index at once
+            backend.update(index, objs)
+        # Deleted, or no longer meant to be indexed
+        for object_id in object_ids - set(obj.pk for obj in objs):
+            backend.remove(u'{}.{}.{}'.format(
+                model._meta.app_label, model._meta.model_name, object_id))
+
+
+def process_search_index_queue(batch_size=SEARCH_INDEX_QUEUE_BATCH_SIZE):
+    '''
+    Update the search index for every object queued by
+    `enqueue_for_search_index()`, `batch_size` objects at a time, and return
+    the number of objects processed. Objects that fail to be indexed are
+    tried again by the next call, up to `SEARCH_INDEX_QUEUE_MAX_ATTEMPTS`
+    times, without holding up the others. Return `None` without doing
+    anything if another process is already processing the queue
+    '''
+    if not cache.add(SEARCH_INDEX_QUEUE_LOCK_KEY, True,
+                     SEARCH_INDEX_QUEUE_LOCK_TIMEOUT):
+        return None
+    try:
+        return _process_search_index_queue(batch_size)
+    finally:
+        cache.delete(SEARCH_INDEX_QUEUE_LOCK_KEY)
+
+
+def _process_search_index_queue(batch_size):
+    processed_count = 0
+    # Each item is tried at most once per call
+    last_pk = 0
+    while True:
+        items = list(SearchIndexQueueItem.objects.filter(
+            pk__gt=last_pk, attempts__lt=SEARCH_INDEX_QUEUE_MAX_ATTEMPTS
+        ).order_by('pk')[:batch_size])
+        if not items:
+            break
+        last_pk = items[-1].pk
+        try:
+            _update_search_index(items)
+        except Exception:
+            # Index the items one by one to find out which ones fail
+            indexed_items = []
+            for item in items:
+                try:
+                    _update_search_index([item])
+                except Exception as e:
+                    _record_search_index_failure(item, e)
+                else:
+                    indexed_items.append(item)
+        else:
+            indexed_items = items
+        if indexed_items:
+            # Keep the items enqueued again while they were being indexed
+            SearchIndexQueueItem.objects.filter(reduce(operator.or_, [
+                models.Q(pk=item.pk, date_enqueued=item.date_enqueued)
+                for item in indexed_items
+            ])).delete()
+        processed_count += len(indexed_items)
+    return processed_count
+
+
+def _record_search_index_failure(item, error):
+    attempts = item.attempts + 1
+    message = 'Failed to index {} #{} ({} of {} attempts)'.format(
+        ContentType.objects.get_for_id(item.content_type_id).model,
+        item.object_id, attempts, SEARCH_INDEX_QUEUE_MAX_ATTEMPTS)
+    if attempts >= SEARCH_INDEX_QUEUE_MAX_ATTEMPTS:
+        logging.error(message, exc_info=True)
+    else:
+        logging.warning(message, exc_info=True)
+    # Unless the object changed meanwhile, which resets the count
+    SearchIndexQueueItem.objects.filter(
+        pk=item.pk, date_enqueued=item.date_enqueued
+    ).update(attempts=attempts, last_error=unicode(error))
+
+
 class SignalProcessor(haystack.signals.BaseSignalProcessor):
     """
-    Allows for observing when saves/deletes fire & automatically updates the
-    search engine appropriately.
+    Allows for observing when saves/deletes fire & queues the objects to be
+    updated in the search engine (see `enqueue_for_search_index()`).
     """
     def __init__(self, *args, **kwargs):
         self.signal_models = []
@@ -75,6 +251,12 @@ class SignalProcessor(haystack.signals.BaseSignalProcessor):
             models.signals.post_delete.disconnect(
                 self.handle_tagged_item_delete, sender=self.tagged_item_model)
 
+    def handle_save(self, sender, instance, **kwargs):
+        enqueue_for_search_index(instance)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        enqueue_for_search_index(instance)
+
     @staticmethod
     def handle_tagged_item_save(sender, instance, created, raw, **kwargs):
         '''
@@ -87,14 +269,16 @@ class SignalProcessor(haystack.signals.BaseSignalProcessor):
             # not yet consistent
             return
         # Update the search index for the tag itself
-        update_object_in_search_index(instance.tag)
+        enqueue_for_search_index(instance.tag)
         # Update the search index for the tagged object
-        update_object_in_search_index(instance.content_object)
+        enqueue_for_search_index(instance.content_object)
 
     @staticmethod
     def handle_tagged_item_delete(sender, instance, **kwargs):
-        update_object_in_search_index(instance.tag)
-        update_object_in_search_index(instance.content_object)
+        enqueue_for_search_index(instance.tag)
+        # The tagged object itself may be the one being deleted
+        if instance.content_object is not None:
+            enqueue_for_search_index(instance.content_object)
 
     @contextlib.contextmanager
     def defer(self):
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import copy
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kpi.utils.mongo_helper import MongoHelper
+
+
+class Command(BaseCommand):
+    """
+    Measures how fast `MongoHelper.to_readable_dict()` decodes synthetic
+    submissions, compared to the implementation it replaced, which ran
+    `_is_attribute_encoded()` and `decode()` for every key of every
+    submission. Nothing is read from or written to any database
+    """
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--submissions",
+            type=int,
+            default=100000,
+            help="Number of submissions to decode",
+        )
+        parser.add_argument(
+            "--keys",
+            type=int,
+            default=50,
+            help="Number of top-level keys of each submission",
+        )
+
+    def handle(self, *args, **options):
+        submission_count = options["submissions"]
+        key_count = options["keys"]
+        if submission_count < 1 or key_count < 1:
+            raise CommandError("`--submissions` and `--keys` must be positive")
+
+        submissions = build_submissions(submission_count, key_count)
+        timings = []
+        results = []
+        for name, decode in (
+            ("previous implementation", legacy_to_readable_dict),
+            ("to_readable_dict()", lambda submission:
+                MongoHelper.to_readable_dict(submission, form_id="benchmark")),
+            ("to_readable_dict(lazy=True)", lambda submission: dict(
+                MongoHelper.to_readable_dict(submission, lazy=True,
+                                             form_id="benchmark"))),
+        ):
+            # Decoding modifies the submissions in place
+            copies = copy.deepcopy(submissions)
+            start = time.time()
+            decoded = [decode(submission) for submission in copies]
+            timings.append((name, time.time() - start))
+            results.append(decoded)
+
+        for name, seconds in timings:
+            self.stdout.write("{}: {:.2f} s, {:.0f} submissions/s".format(
+                name, seconds, submission_count / seconds))
+        for (name, _), result in zip(timings[1:], results[1:]):
+            if result != results[0]:
+                raise CommandError("{} output differs".format(name))
+
+
+def build_submissions(submission_count, key_count):
+    """
+    Returns `submission_count` submissions of the same form, with
+    `key_count` top-level keys including encoded ones and a repeating group
+    """
+    encoded_dot = MongoHelper.encode(".")
+    submissions = []
+    for index in xrange(submission_count):
+        submission = {
+            "_id": index,
+            "_uuid": "uuid-{}".format(index),
+            "_submission_time": "2018-01-01T00:00:00",
+            "group{dot}with{dot}dots".format(dot=encoded_dot): [
+                {"group{dot}with{dot}dots/question{dot}{repeat}".format(
+                    dot=encoded_dot, repeat=repeat): repeat}
+                for repeat in xrange(3)
+            ],
+        }
+        for key_index in xrange(key_count - len(submission)):
+            if key_index % 5:
+                key = "question_{}".format(key_index)
+            else:
+                key = "question{}{}".format(encoded_dot, key_index)
+            submission[key] = "answer {}".format(index)
+        submissions.append(submission)
+    return submissions
+
+
+def legacy_to_readable_dict(d):
+    """
+    `MongoHelper.to_readable_dict()` as it was before decoded keys were
+    cached
+    """
+    for key, value in list(d.items()):
+        if type(value) == list:
+            value = [legacy_to_readable_dict(e)
+                     if type(e) == dict else e for e in value]
+        elif type(value) == dict:
+            value = legacy_to_readable_dict(value)
+
+        if MongoHelper._is_attribute_encoded(key):
+            del d[key]
+            d[MongoHelper.decode(key)] = value
+
+    return d
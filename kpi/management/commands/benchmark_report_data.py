@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from kobo.apps.reports import report_data
+from kpi.models import Asset
+
+# Question types of the synthetic form, in turn
+QUESTION_TYPES = ('select_one', 'integer', 'text', 'decimal')
+
+
+class Command(BaseCommand):
+    """
+    Measures how long the report statistics of a synthetic wide form take to
+    compute with formpack alone, and to store in `ReportAggregate`s, against
+    `MockDeploymentBackend`. The field groups that Celery tasks count
+    concurrently (see `settings.REPORT_FIELDS_PER_TASK`) are timed one after
+    the other here. Everything written to the database is rolled back
+    """
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--fields",
+            type=int,
+            default=500,
+            help="Number of questions of the form",
+        )
+        parser.add_argument(
+            "--submissions",
+            type=int,
+            default=1000,
+            help="Number of submissions",
+        )
+
+    def handle(self, *args, **options):
+        field_count = options["fields"]
+        submission_count = options["submissions"]
+        if field_count < 1 or submission_count < 2:
+            raise CommandError("`--fields` must be positive and "
+                               "`--submissions` at least 2")
+
+        with transaction.atomic():
+            timings = run_benchmark(field_count, submission_count)
+            transaction.set_rollback(True)
+
+        for name, seconds in timings:
+            self.stdout.write("{}: {:.2f} s".format(name, seconds))
+
+
+def build_content(field_count):
+    survey = []
+    for index in xrange(field_count):
+        row = {
+            'type': QUESTION_TYPES[index % len(QUESTION_TYPES)],
+            'name': 'q{}'.format(index),
+            'label': 'Question {}'.format(index),
+        }
+        if row['type'] == 'select_one':
+            row['select_from_list_name'] = 'choices'
+        survey.append(row)
+    choices = [
+        {'list_name': 'choices', 'name': 'option_{}'.format(index),
+         'label': 'Option {}'.format(index)}
+        for index in xrange(5)
+    ]
+    return {'survey': survey, 'choices': choices, 'settings': {}}
+
+
+def build_submissions(field_count, submission_count, version_uid):
+    submissions = []
+    for index in xrange(submission_count):
+        submission = {
+            '_id': index + 1,
+            '_submission_time': '2018-01-01T00:00:{:02d}.{:06d}'.format(
+                index // 1000000 % 60, index % 1000000),
+            '__version__': version_uid,
+        }
+        for field_index in xrange(field_count):
+            question_type = QUESTION_TYPES[field_index % len(QUESTION_TYPES)]
+            if question_type == 'select_one':
+                value = 'option_{}'.format((index + field_index) % 5)
+            elif question_type == 'integer':
+                value = (index * field_index) % 100
+            elif question_type == 'decimal':
+                value = (index + field_index) % 100 / 4.0
+            else:
+                value = 'answer {}'.format(index % 10)
+            submission['q{}'.format(field_index)] = value
+        submissions.append(submission)
+    return submissions
+
+
+def run_benchmark(field_count, submission_count):
+    """
+    Returns the `(name, seconds)` tuple of each step. The last tenth of the
+    submissions arrives after the first aggregate update. With enough
+    workers, field groups take as long as the slowest of them
+    """
+    user = User.objects.create(username='benchmark_report_data')
+    asset = Asset.objects.create(content=build_content(field_count),
+                                 owner=user, asset_type='survey')
+    asset.deploy(backend='mock', active=True)
+    asset.save()
+    submissions = build_submissions(
+        field_count, submission_count, asset.latest_deployed_version.uid)
+    first_count = submission_count - submission_count // 10
+    asset.deployment.mock_submissions(submissions)
+
+    timings = []
+    start = time.time()
+    report_data.data_by_identifiers(
+        asset, submission_stream=asset.deployment.get_submissions())
+    timings.append(('formpack, every submission', time.time() - start))
+
+    pack, _ = report_data.build_formpack(asset, submission_stream=[])
+    fields = report_data._get_report_fields(pack)
+    asset.deployment.mock_submissions(submissions[:first_count])
+    start = time.time()
+    report_data.update_report_aggregate(asset, pack, fields, rebuild=True)
+    timings.append(('aggregate, {} submissions'.format(first_count),
+                    time.time() - start))
+
+    asset.deployment.mock_submissions(submissions)
+    start = time.time()
+    report_data.update_report_aggregate(asset, pack, fields)
+    timings.append(('aggregate, {} new submissions'.format(
+        submission_count - first_count), time.time() - start))
+
+    group_seconds = []
+    for index, group in enumerate(report_data._get_field_groups(pack)):
+        start = time.time()
+        report_data.update_report_aggregate(asset, pack, group, rebuild=True,
+                                            field_group=index)
+        group_seconds.append(time.time() - start)
+    timings.append((
+        'aggregate, {} submissions, slowest of {} field groups'.format(
+            submission_count, len(group_seconds)),
+        max(group_seconds)
+    ))
+    return timings
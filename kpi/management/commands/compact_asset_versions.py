@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from kpi.models.asset_version import AssetVersion, AssetVersionContent
+
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    """
+    Moves the content still stored inline in `AssetVersion` to
+    `AssetVersionContent`, then deletes `AssetVersionContent` records that are
+    no longer used, e.g. after `remove_duplicate_assetversions`
+    """
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--skip-purge",
+            action='store_true',
+            default=False,
+            help="Do not delete unused content",
+        )
+
+    def handle(self, *args, **options):
+        verbosity = options["verbosity"]
+        compact_asset_versions(
+            purge=not options["skip_purge"],
+            stdout=self.stdout if verbosity >= 1 else None
+        )
+        if verbosity >= 1:
+            self.stdout.write("Done!")
+
+
+def compact_asset_versions(purge=True, stdout=None):
+    """
+    :return: tuple. Number of versions moved and of contents deleted
+    """
+    moved_count = 0
+    last_pk = 0
+    while True:
+        # Oldest first, so that each content is stored relative to the
+        # previous version of the same asset
+        versions = list(AssetVersion.objects.filter(
+            pk__gt=last_pk, _version_content__isnull=False
+        ).order_by('pk')[:BATCH_SIZE])
+        if not versions:
+            break
+        with transaction.atomic():
+            for version in versions:
+                version.save(update_fields=['_version_content'])
+        moved_count += len(versions)
+        last_pk = versions[-1].pk
+        if stdout:
+            stdout.write("{} versions moved".format(moved_count))
+
+    deleted_count = 0
+    if purge:
+        # Deleting deltas may leave their keyframes unused
+        while True:
+            unused = AssetVersionContent.objects.filter(
+                asset_versions__isnull=True, deltas__isnull=True
+            ).values_list('pk', flat=True)[:BATCH_SIZE]
+            unused_pks = list(unused)
+            if not unused_pks:
+                break
+            deleted_count += len(unused_pks)
+            AssetVersionContent.objects.filter(pk__in=unused_pks).delete()
+        if stdout:
+            stdout.write("{} unused contents deleted".format(deleted_count))
+
+    return moved_count, deleted_count
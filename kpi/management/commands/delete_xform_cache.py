@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .delete_base_command import DeleteBaseCommand
+from kpi.models import XFormCache
+
+
+class Command(DeleteBaseCommand):
+
+    help = "Deletes cached XForms"
+
+    def _prepare_delete_queryset(self, **options):
+        days = options["days"]
+        self._model = XFormCache
+
+        # Retrieve all records that have not been used for `days`
+        return XFormCache.objects.filter(
+            date_accessed__lt=timezone.now() - timedelta(days=days),
+        )
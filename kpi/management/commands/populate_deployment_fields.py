@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from kpi.models import Asset
+
+BATCH_SIZE = 100
+DEPLOYMENT_FIELDS = (
+    'deployment_backend',
+    'deployment_active',
+    'deployment_identifier',
+    'deployed_version_uid',
+)
+
+
+class Command(BaseCommand):
+    """
+    Copies the deployment of each asset from `_deployment_data` to the columns
+    read by asset lists; see `Asset.sync_deployment_fields()`. Only needed
+    once for the assets deployed before these columns were added, or after
+    changing `_deployment_data` without `store_data()`
+    """
+
+    def handle(self, *args, **options):
+        verbosity = options["verbosity"]
+        populate_deployment_fields(
+            stdout=self.stdout if verbosity >= 1 else None)
+        if verbosity >= 1:
+            self.stdout.write("Done!")
+
+
+def populate_deployment_fields(stdout=None):
+    """
+    :return: int. Number of assets updated
+    """
+    updated_count = 0
+    last_pk = 0
+    while True:
+        assets = list(Asset.objects.filter(pk__gt=last_pk).only(
+            'pk', '_deployment_data', *DEPLOYMENT_FIELDS
+        ).order_by('pk')[:BATCH_SIZE])
+        if not assets:
+            break
+        with transaction.atomic():
+            for asset in assets:
+                previous_values = [
+                    getattr(asset, field) for field in DEPLOYMENT_FIELDS]
+                asset.sync_deployment_fields()
+                values = {
+                    field: getattr(asset, field) for field in DEPLOYMENT_FIELDS}
+                if previous_values != [values[field]
+                                       for field in DEPLOYMENT_FIELDS]:
+                    # Avoid `save()`, which would update `date_modified`
+                    Asset.objects.filter(pk=asset.pk).update(**values)
+                    updated_count += 1
+        last_pk = assets[-1].pk
+        if stdout:
+            stdout.write("{} assets updated".format(updated_count))
+
+    return updated_count
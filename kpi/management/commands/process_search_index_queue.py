@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kpi.haystack_utils import (
+    process_search_index_queue,
+    SEARCH_INDEX_QUEUE_BATCH_SIZE,
+)
+from kpi.models import SearchIndexQueueItem
+
+
+class Command(BaseCommand):
+    """
+    Updates the search index for every object queued by
+    `kpi.haystack_utils.SignalProcessor`, e.g. when Celery is not running
+    """
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=SEARCH_INDEX_QUEUE_BATCH_SIZE,
+            help="Number of objects to index at once",
+        )
+        parser.add_argument(
+            "--retry-failed",
+            action='store_true',
+            default=False,
+            help="Also index the objects that failed too many times "
+                 "already",
+        )
+
+    def handle(self, *args, **options):
+        if options["retry_failed"]:
+            SearchIndexQueueItem.objects.filter(attempts__gt=0).update(
+                attempts=0)
+        processed_count = process_search_index_queue(
+            batch_size=options["batch_size"])
+        if processed_count is None:
+            raise CommandError("The queue is being processed by another "
+                               "process. Try again later.")
+        if options["verbosity"] >= 1:
+            self.stdout.write("{} objects indexed".format(processed_count))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from kpi.models.object_permission import (
+    EffectivePermission,
+    get_models_with_object_permissions,
+)
+
+
+class Command(BaseCommand):
+    """
+    Recreates `EffectivePermission` records from `ObjectPermission` records,
+    or only reports inconsistencies between them with `--check`
+    """
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            "--check",
+            action='store_true',
+            default=False,
+            help="Only report objects whose effective permissions are "
+                 "inconsistent. Exit with an error if any is found.",
+        )
+
+    def handle(self, *args, **options):
+        check_only = options["check"]
+        verbosity = options["verbosity"]
+
+        inconsistent_count = rebuild_effective_permissions(
+            check_only=check_only,
+            stdout=self.stdout if verbosity >= 1 else None,
+            verbose=verbosity >= 2
+        )
+
+        if check_only and inconsistent_count:
+            raise CommandError(
+                "{} objects have inconsistent effective permissions. Run "
+                "`rebuild_effective_permissions` without `--check` to fix "
+                "them.".format(inconsistent_count))
+        if verbosity >= 1:
+            self.stdout.write("Done!")
+
+
+def rebuild_effective_permissions(check_only=False, stdout=None,
+                                  verbose=False):
+    """
+    Synchronizes (or compares, if `check_only` is `True`) the effective
+    permissions of every object using object-level permissions.
+
+    :return: int. Number of inconsistent objects
+    """
+    inconsistent_count = 0
+
+    for model in get_models_with_object_permissions():
+        content_type = ContentType.objects.get_for_model(model)
+        # Notified once per model rather than once per object
+        changed_user_ids = set()
+        # Retrieve only what `_get_effective_perms()` needs
+        objects = model.objects.only(
+            'pk', 'owner', 'parent', 'editors_can_change_permissions'
+        ).order_by('pk')
+        for obj in objects.iterator():
+            with transaction.atomic():
+                missing_perms, stale_perms = obj._sync_effective_perms(
+                    check_only=check_only, notify_changes=False)
+            if missing_perms or stale_perms:
+                inconsistent_count += 1
+                changed_user_ids.update(
+                    user_id for user_id, _ in missing_perms | stale_perms)
+                if stdout and verbose:
+                    stdout.write(
+                        "{} #{}: {} missing, {} stale".format(
+                            model._meta.model_name, obj.pk,
+                            len(missing_perms), len(stale_perms)))
+
+        # Records of deleted objects
+        orphans = EffectivePermission.objects.filter(
+            content_type=content_type
+        ).exclude(object_id__in=model.objects.values('pk'))
+        orphan_object_count = orphans.values('object_id').distinct().count()
+        if orphan_object_count:
+            inconsistent_count += orphan_object_count
+            if not check_only:
+                changed_user_ids.update(
+                    orphans.values_list('user_id', flat=True))
+                orphans.delete()
+
+        if changed_user_ids and not check_only:
+            model._effective_perms_changed(changed_user_ids)
+
+        if stdout:
+            stdout.write("{}: {} objects processed".format(
+                model._meta.verbose_name_plural, objects.count()))
+
+    return inconsistent_count
@@ -288,6 +288,10 @@ def _sync_form_metadata(asset, xform, changes):
         deployment_data['backend_response'] = _get_kc_backend_response(xform)
         modified = True
 
+    if modified:
+        # `deployment_data` was changed in place, not with `store_data()`
+        asset.sync_deployment_fields()
+
     affected_users = _sync_permissions(asset, xform)
     if affected_users:
         modified = True
@@ -390,6 +394,7 @@ def _sync_permissions(asset, xform):
                 content_type=ASSET_CT,
                 object_id=asset.pk
             ).delete()
+            asset._sync_effective_perms()
         if perms_to_assign or perms_to_revoke:
             affected_usernames.append(user_obj.username)
 
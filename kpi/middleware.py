@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals
+
+from .models.object_permission import start_request_cache, end_request_cache
+
+
+class PermissionCacheMiddleware(object):
+    """
+    Remember the effective permissions (and the anonymous user) retrieved
+    while handling a request, so that the many permission checks made by
+    the backend, the permission classes, the serializers and the views hit
+    the database only once per object and user.
+    See `kpi.models.object_permission.ObjectPermissionMixin.has_perm()`
+    """
+    def process_request(self, request):
+        start_request_cache()
+
+    def process_response(self, request, response):
+        end_request_cache()
+        return response
+
+    def process_exception(self, request, exception):
+        end_request_cache()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def populate_effective_permissions(apps, schema_editor):
+    if settings.SKIP_HEAVY_MIGRATIONS:
+        print("""
+            !!! ATTENTION !!!
+            If you have existing projects you need to run this management command:
+
+               > python manage.py rebuild_effective_permissions
+
+            Otherwise, users will not be able to access them.
+            This command can take a long time, but it is idempotent
+            so you can run it even if you are not sure if it is
+            necessary.
+            """)
+    else:
+        print("""
+            This might take a while. If it is too slow, you may want to re-run the
+            migration with SKIP_HEAVY_MIGRATIONS=True and run the management command
+            (rebuild_effective_permissions) to prepare the permissions.
+            """)
+        for model_name in ('Collection', 'Asset'):
+            populate_model_effective_permissions(
+                apps, apps.get_model('kpi', model_name))
+
+
+def populate_model_effective_permissions(apps, model):
+    """
+    Historical equivalent of `ObjectPermissionMixin._sync_effective_perms()`
+    for every object of `model`. Uses only the models of `apps`, so that
+    fields and hooks added by later migrations are not involved
+    """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Permission = apps.get_model('auth', 'Permission')
+    ObjectPermission = apps.get_model('kpi', 'ObjectPermission')
+    EffectivePermission = apps.get_model('kpi', 'EffectivePermission')
+
+    try:
+        content_type = ContentType.objects.get(
+            app_label=model._meta.app_label, model=model._meta.model_name)
+    except ContentType.DoesNotExist:
+        # Fresh database: content types are only created after migrating
+        return
+    codenames = dict(Permission.objects.filter(
+        content_type=content_type).values_list('pk', 'codename'))
+    permission_ids = {codename: pk for pk, codename in codenames.items()}
+    share_permission_ids = {}
+    for pk, codename in codenames.items():
+        if codename.startswith('change_'):
+            share_codename = re.sub('^change_', 'share_', codename, 1)
+            if share_codename in permission_ids:
+                share_permission_ids[pk] = permission_ids[share_codename]
+    delete_permission_ids = [pk for pk, codename in codenames.items()
+                             if codename.startswith('delete_')]
+    allowed_anonymous_permission_ids = set()
+    for perm in settings.ALLOWED_ANONYMOUS_PERMISSIONS:
+        app_label, codename = perm.split('.', 1)
+        if app_label == content_type.app_label and \
+                codename in permission_ids:
+            allowed_anonymous_permission_ids.add(permission_ids[codename])
+
+    objects = model.objects.order_by('pk').values_list(
+        'pk', 'owner_id', 'editors_can_change_permissions')
+    last_pk = None
+    while True:
+        batch = objects
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        batch = list(batch[:BATCH_SIZE])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+
+        grant_perms = defaultdict(set)
+        deny_perms = defaultdict(set)
+        for object_id, user_id, permission_id, deny in \
+                ObjectPermission.objects.filter(
+                    content_type=content_type,
+                    object_id__in=[pk for pk, _, _ in batch]
+                ).values_list('object_id', 'user_id', 'permission_id', 'deny'):
+            perms = deny_perms if deny else grant_perms
+            perms[object_id].add((user_id, permission_id))
+
+        effective_perms = []
+        for object_id, owner_id, editors_can_change_permissions in batch:
+            perms = grant_perms[object_id] - deny_perms[object_id]
+            if editors_can_change_permissions:
+                perms.update(
+                    (user_id, share_permission_ids[permission_id])
+                    for user_id, permission_id in list(perms)
+                    if permission_id in share_permission_ids
+                )
+            if owner_id is not None:
+                perms.update((owner_id, permission_id)
+                             for permission_id in delete_permission_ids)
+            effective_perms.extend(
+                EffectivePermission(
+                    user_id=user_id,
+                    permission_id=permission_id,
+                    codename=codenames[permission_id],
+                    object_id=object_id,
+                    content_type=content_type,
+                )
+                for user_id, permission_id in perms
+                if user_id != settings.ANONYMOUS_USER_ID or
+                permission_id in allowed_anonymous_permission_ids
+            )
+        EffectivePermission.objects.bulk_create(effective_perms)
+
+
+# allow this command to be run backwards
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('auth', '0006_require_contenttypes_0002'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('kpi', '0022_assetfile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EffectivePermission',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('codename', models.CharField(max_length=100)),
+                ('object_id', models.PositiveIntegerField()),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('permission', models.ForeignKey(to='auth.Permission')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='effectivepermission',
+            unique_together=set([('user', 'permission', 'object_id', 'content_type')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='effectivepermission',
+            index_together=set([('user', 'content_type', 'codename'), ('content_type', 'object_id', 'user', 'codename')]),
+        ),
+        migrations.RunPython(
+            populate_effective_permissions,
+            reverse_code=noop
+        ),
+    ]
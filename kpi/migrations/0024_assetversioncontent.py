@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonbfield.fields
+
+from kpi.utils.json_patch import apply_patch, make_patch
+
+BATCH_SIZE = 100
+# Same as `AssetVersionContent` at the time of this migration
+KEYFRAME_INTERVAL = 50
+MAX_DELTA_SIZE_RATIO = 0.5
+
+
+def move_version_content(apps, schema_editor):
+    if settings.SKIP_HEAVY_MIGRATIONS:
+        print("""
+            !!! ATTENTION !!!
+            If you have existing asset versions, you should run this
+            management command to deduplicate their content:
+
+               > python manage.py compact_asset_versions
+
+            Versions remain readable until then. This command can take a
+            long time, but it is idempotent so you can run it even if you
+            are not sure if it is necessary.
+            """)
+    else:
+        print("""
+            This might take a while. If it is too slow, you may want to re-run the
+            migration with SKIP_HEAVY_MIGRATIONS=True and run the management command
+            (compact_asset_versions) to deduplicate the content of asset versions.
+            """)
+        move_content_to_blobs(apps.get_model('kpi', 'AssetVersion'),
+                              apps.get_model('kpi', 'AssetVersionContent'))
+
+
+def hash_version_content(content):
+    _json_string = json.dumps(content, sort_keys=True)
+    return hashlib.sha1(_json_string).hexdigest()
+
+
+def move_content_to_blobs(AssetVersion, AssetVersionContent):
+    """
+    Historical equivalent of `compact_asset_versions`: the models as of this
+    migration lack the logic of `AssetVersion.save()`, and the current models
+    have fields that do not exist yet, so the keyframe/delta storage of
+    `AssetVersionContent.create_for()` is repeated here
+    """
+    last_pk = 0
+    while True:
+        # Oldest first, so that each content is stored relative to the
+        # previous version of the same asset
+        versions = list(AssetVersion.objects.filter(
+            pk__gt=last_pk, _version_content__isnull=False
+        ).order_by('pk')[:BATCH_SIZE])
+        if not versions:
+            break
+        for version in versions:
+            content = version._version_content
+            content_hash = hash_version_content(content)
+            if not AssetVersionContent.objects.filter(
+                    content_hash=content_hash).exists():
+                previous_hash = AssetVersion.objects.filter(
+                    asset_id=version.asset_id, content_blob__isnull=False
+                ).exclude(pk=version.pk).order_by(
+                    '-date_modified'
+                ).values_list('content_blob', flat=True).first()
+                store_content(AssetVersionContent, content, content_hash,
+                              previous_hash)
+            AssetVersion.objects.filter(pk=version.pk).update(
+                content_blob=content_hash, _version_content=None)
+        last_pk = versions[-1].pk
+
+
+def store_content(AssetVersionContent, content, content_hash, previous_hash):
+    defaults = {'content': content}
+    previous = None
+    if previous_hash is not None:
+        previous = AssetVersionContent.objects.select_related(
+            'keyframe').filter(content_hash=previous_hash).first()
+    if previous is not None and previous.sequence < KEYFRAME_INTERVAL:
+        keyframe = previous.keyframe or previous
+        delta = make_patch(keyframe.content, content)
+        if len(json.dumps(delta)) <= MAX_DELTA_SIZE_RATIO * len(
+                json.dumps(content)) and hash_version_content(
+                apply_patch(keyframe.content, delta)) == content_hash:
+            defaults = {
+                'keyframe': keyframe,
+                'delta': delta,
+                'sequence': previous.sequence + 1,
+            }
+    AssetVersionContent.objects.create(content_hash=content_hash, **defaults)
+
+
+# allow this command to be run backwards
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0023_effectivepermission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetVersionContent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content_hash', models.CharField(unique=True, max_length=40)),
+                ('content', jsonbfield.fields.JSONField(null=True)),
+                ('delta', jsonbfield.fields.JSONField(null=True)),
+                ('sequence', models.PositiveIntegerField(default=0)),
+                ('keyframe', models.ForeignKey(related_name='deltas', on_delete=django.db.models.deletion.PROTECT, to='kpi.AssetVersionContent', null=True)),
+            ],
+        ),
+        migrations.RenameField(
+            model_name='assetversion',
+            old_name='version_content',
+            new_name='_version_content',
+        ),
+        migrations.AlterField(
+            model_name='assetversion',
+            name='_version_content',
+            field=jsonbfield.fields.JSONField(null=True, db_column='version_content'),
+        ),
+        migrations.AddField(
+            model_name='assetversion',
+            name='content_blob',
+            field=models.ForeignKey(related_name='asset_versions', on_delete=django.db.models.deletion.PROTECT, db_column='content_hash', to_field='content_hash', to='kpi.AssetVersionContent', null=True),
+        ),
+        migrations.RunPython(
+            move_version_content,
+            reverse_code=noop
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonbfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0024_assetversioncontent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assetversion',
+            name='_formpack_schema_cache',
+            field=jsonbfield.fields.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonbfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0026_xformcache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportAggregate',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('split_by', models.CharField(default='', max_length=255, blank=True)),
+                ('formpack_key', models.CharField(default='', max_length=40, blank=True)),
+                ('submission_count', models.PositiveIntegerField(default=0)),
+                ('last_submission_time', models.CharField(max_length=64, null=True)),
+                ('last_submission_id', models.IntegerField(null=True)),
+                ('metrics', jsonbfield.fields.JSONField(default=dict)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+                ('asset', models.ForeignKey(related_name='report_aggregates', to='kpi.Asset')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='reportaggregate',
+            unique_together=set([('asset', 'split_by')]),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_deployment_fields(apps, schema_editor):
+    if settings.SKIP_HEAVY_MIGRATIONS:
+        print("""
+            !!! ATTENTION !!!
+            If you have existing deployed assets, you must run this management
+            command to copy their deployment to the new columns:
+
+               > python manage.py populate_deployment_fields
+
+            Until then, asset lists will show them as not deployed. This
+            command is idempotent so you can run it even if you are not sure
+            if it is necessary.
+            """)
+    else:
+        print("""
+            This might take a while. If it is too slow, you may want to re-run the
+            migration with SKIP_HEAVY_MIGRATIONS=True and run the management command
+            (populate_deployment_fields) to copy the deployment of assets.
+            """)
+        from kpi.management.commands.populate_deployment_fields import \
+            populate_deployment_fields
+        populate_deployment_fields()
+
+
+# allow this command to be run backwards
+def noop(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0028_searchindexqueueitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='deployed_version_uid',
+            field=models.CharField(default='', max_length=255, db_index=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='asset',
+            name='deployment_active',
+            field=models.BooleanField(default=False, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='asset',
+            name='deployment_backend',
+            field=models.CharField(default='', max_length=32, db_index=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='asset',
+            name='deployment_identifier',
+            field=models.TextField(default='', db_index=True, blank=True),
+        ),
+        migrations.RunPython(
+            populate_deployment_fields,
+            reverse_code=noop
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('kpi', '0029_asset_deployment_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetSetVersion',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('user', models.OneToOneField(related_name='asset_set_version', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0030_assetsetversion'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='asset',
+            index_together=set([('date_modified', 'id'), ('parent', 'date_modified', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='collection',
+            index_together=set([('date_modified', 'id'), ('parent', 'date_modified', 'id')]),
+        ),
+    ]
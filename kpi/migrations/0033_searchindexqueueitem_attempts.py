@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0032_reportaggregate_date_rebuilt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchindexqueueitem',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='searchindexqueueitem',
+            name='last_error',
+            field=models.TextField(default='', blank=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kpi', '0033_searchindexqueueitem_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportaggregate',
+            name='field_group',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterUniqueTogether(
+            name='reportaggregate',
+            unique_together=set([('asset', 'split_by', 'field_group')]),
+        ),
+    ]
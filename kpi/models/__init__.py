@@ -2,9 +2,14 @@ from kpi.models.collection import Collection, CollectionChildrenQuerySet
 from kpi.models.collection import UserCollectionSubscription
 from kpi.models.asset import Asset
 from kpi.models.asset import AssetSnapshot
-from kpi.models.asset_version import AssetVersion
+from kpi.models.asset_version import AssetVersion, AssetVersionContent
+from kpi.models.asset_set_version import AssetSetVersion
 from kpi.models.asset_file import AssetFile
+from kpi.models.xform_cache import XFormCache
+from kpi.models.report_aggregate import ReportAggregate
+from kpi.models.search_index_queue import SearchIndexQueueItem
 from kpi.models.object_permission import ObjectPermission, ObjectPermissionMixin
+from kpi.models.object_permission import EffectivePermission
 from kpi.models.import_export_task import ImportTask, ExportTask
 from kpi.models.tag_uid import TagUid
 from kpi.models.authorized_application import AuthorizedApplication
@@ -6,8 +6,9 @@ import re
 import sys
 import copy
 import json
-import StringIO
-from collections import OrderedDict
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict
 
 import xlwt
 import six
@@ -28,7 +29,9 @@ from formpack import FormPack
 from formpack.utils.flatten_content import flatten_content
 from formpack.utils.json_hash import json_hash
 from formpack.utils.spreadsheet_content import flatten_to_spreadsheet_content
-from asset_version import AssetVersion
+from asset_version import AssetVersion, hash_version_content
+from asset_set_version import AssetSetVersion
+from xform_cache import XFormCache
 from kpi.utils.standardize_content import (standardize_content,
                                            needs_standardization,
                                            standardize_content_in_place)
@@ -36,7 +39,11 @@ from kpi.utils.autoname import (autoname_fields_in_place,
                                 autovalue_choices_in_place)
 from kpi.constants import ASSET_TYPES, ASSET_TYPE_BLOCK,\
     ASSET_TYPE_QUESTION, ASSET_TYPE_SURVEY, ASSET_TYPE_TEMPLATE
-from .object_permission import ObjectPermission, ObjectPermissionMixin
+from .object_permission import (
+    EffectivePermission,
+    ObjectPermission,
+    ObjectPermissionMixin,
+)
 from ..fields import KpiUidField, LazyDefaultJSONBField
 from ..utils.asset_content_analyzer import AssetContentAnalyzer
 from ..utils.sluggify import sluggify_label
@@ -55,6 +62,7 @@ from ..utils.asset_translation_utils import (
         TRANSLATIONS_MULTIPLE_CHANGES,
     )
 from ..utils.random_id import random_id
+from ..deployment_backends.backends import DEPLOYMENT_BACKENDS
 from ..deployment_backends.mixin import DeployableMixin
 from kobo.apps.reports.constants import (SPECIFIC_REPORTS_KEY,
                                          DEFAULT_REPORTS_KEY)
@@ -91,7 +99,34 @@ class KpiTaggableManager(_TaggableManager):
         super(KpiTaggableManager, self).add(*tags_out, **kwargs)
 
 
-class AssetManager(TaggableModelManager):
+class AssetQuerySet(models.QuerySet):
+    _prefetch_submission_counts = False
+
+    def prefetch_submission_counts(self):
+        '''
+        Once the assets are retrieved, retrieves the submission counts of
+        the deployed ones with one query per deployment backend instead of
+        one per asset; see `Asset.prefetch_submission_counts()`
+        '''
+        clone = self._clone()
+        clone._prefetch_submission_counts = True
+        return clone
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        clone = super(AssetQuerySet, self)._clone(klass, setup, **kwargs)
+        # `values()` and `values_list()` do not retrieve assets
+        clone._prefetch_submission_counts = (
+            self._prefetch_submission_counts and klass is None)
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super(AssetQuerySet, self)._fetch_all()
+        if self._prefetch_submission_counts and not fetched:
+            Asset.prefetch_submission_counts(self._result_cache)
+
+
+class AssetManager(TaggableModelManager.from_queryset(AssetQuerySet)):
     def filter_by_tag_name(self, tag_name):
         return self.filter(tags__name=tag_name)
 
@@ -360,10 +395,65 @@ class FormpackXLSFormUtils(object):
         _ts[_ts.index(_from)] = _to
 
 
+# Number of rows `to_xls_io()` keeps as xlwt cell objects before encoding
+# them to xlwt's temporary file; a multiple of 32, the size of row blocks in
+# XLS files. This only limits the overhead of those objects: the content is
+# already in memory, and xlwt reads the encoded rows back when saving
+XLS_ROWS_FLUSH_INTERVAL = 1024
+# Size, in bytes, above which the file returned by `to_xls_io()` is moved
+# from memory to disk
+XLS_IO_MAX_MEMORY_SIZE = 1024 * 1024
+
+# Most recently used results of `XlsExportable.ordered_xlsform_content()`,
+# keyed by content and options
+ORDERED_XLSFORM_CONTENT_CACHE_MAX_SIZE = 50
+_ordered_xlsform_content_cache = OrderedDict()
+_ordered_xlsform_content_cache_lock = threading.Lock()
+
+
 class XlsExportable(object):
     def ordered_xlsform_content(self,
                                 kobo_specific_types=False,
                                 append=None):
+        # The caller is free to modify the result
+        return copy.deepcopy(self._get_ordered_xlsform_content(
+            kobo_specific_types=kobo_specific_types, append=append))
+
+    def _get_ordered_xlsform_content(self,
+                                     kobo_specific_types=False,
+                                     append=None):
+        '''
+        Same as `ordered_xlsform_content()`, but the result is shared with
+        other callers and must not be modified
+        '''
+        # The content of a saved asset is that of its latest version, so
+        # repeatedly exporting or deploying an unchanged form hits the cache
+        key = (
+            hash_version_content(self.content),
+            kobo_specific_types,
+            hash_version_content(append) if append else None,
+        )
+        with _ordered_xlsform_content_cache_lock:
+            try:
+                content = _ordered_xlsform_content_cache.pop(key)
+            except KeyError:
+                pass
+            else:
+                _ordered_xlsform_content_cache[key] = content
+                return content
+
+        content = self._build_ordered_xlsform_content(
+            kobo_specific_types=kobo_specific_types, append=append)
+        with _ordered_xlsform_content_cache_lock:
+            _ordered_xlsform_content_cache[key] = content
+            while len(_ordered_xlsform_content_cache) > \
+                    ORDERED_XLSFORM_CONTENT_CACHE_MAX_SIZE:
+                _ordered_xlsform_content_cache.popitem(last=False)
+        return content
+
+    def _build_ordered_xlsform_content(self,
+                                       kobo_specific_types=False,
+                                       append=None):
         # currently, this method depends on "FormpackXLSFormUtils"
         content = copy.deepcopy(self.content)
         if append:
@@ -384,7 +474,9 @@ class XlsExportable(object):
             `{'sheet name': [{'column name': 'cell value'}]}`
         Extra settings may be included as a dictionary in the same
         parameter.
-            `{'settings': {'setting name': 'setting value'}}` '''
+            `{'settings': {'setting name': 'setting value'}}`
+        Returns a file object positioned at its start, which is kept in
+        memory only up to `XLS_IO_MAX_MEMORY_SIZE` bytes '''
         if versioned:
             append = kwargs['append'] = kwargs.get('append', {})
             append_survey = append['survey'] = append.get('survey', [])
@@ -397,22 +489,29 @@ class XlsExportable(object):
             append_settings.update({'version': self.version_id})
         try:
             def _add_contents_to_sheet(sheet, contents):
-                cols = []
+                # Columns in order of appearance, found in a single pass
+                col_indexes = OrderedDict()
                 for row in contents:
-                    for key in row.keys():
-                        if key not in cols:
-                            cols.append(key)
-                for ci, col in enumerate(cols):
-                    sheet.write(0, ci, col)
-                for ri, row in enumerate(contents):
-                    for ci, col in enumerate(cols):
-                        val = row.get(col, None)
+                    for key in row:
+                        if key not in col_indexes:
+                            col_indexes[key] = len(col_indexes)
+                header_row = sheet.row(0)
+                for col, ci in col_indexes.iteritems():
+                    header_row.write(ci, col)
+                for ri, row in enumerate(contents, 1):
+                    sheet_row = sheet.row(ri)
+                    for (col, val) in row.iteritems():
                         if val:
-                            sheet.write(ri + 1, ci, val)
+                            sheet_row.write(col_indexes[col], val)
+                    if (ri + 1) % XLS_ROWS_FLUSH_INTERVAL == 0:
+                        # Encode the rows written so far to xlwt's temporary
+                        # file
+                        sheet.flush_row_data()
             # The extra rows and settings should persist within this function
-            # and its return value *only*. Calling deepcopy() is required to
-            # achieve this isolation.
-            ss_dict = self.ordered_xlsform_content(**kwargs)
+            # and its return value *only*. `ordered_xlsform_content()` works
+            # on a copy of the content to achieve this isolation; its result
+            # is only read here, so the cached one can be used as is
+            ss_dict = self._get_ordered_xlsform_content(**kwargs)
 
             workbook = xlwt.Workbook()
             for (sheet_name, contents) in ss_dict.iteritems():
@@ -426,10 +525,11 @@ class XlsExportable(object):
                 sys.exc_info()[2]
             )
 
-        string_io = StringIO.StringIO()
-        workbook.save(string_io)
-        string_io.seek(0)
-        return string_io
+        xls_io = tempfile.SpooledTemporaryFile(
+            max_size=XLS_IO_MAX_MEMORY_SIZE)
+        workbook.save(xls_io)
+        xls_io.seek(0)
+        return xls_io
 
 
 class Asset(ObjectPermissionMixin,
@@ -460,6 +560,15 @@ class Asset(ObjectPermissionMixin,
     # _deployment_data should be accessed through the `deployment` property
     # provided by `DeployableMixin`
     _deployment_data = JSONField(default=dict)
+    # Copied from `_deployment_data` by `sync_deployment_fields()`, so that
+    # lists do not have to parse it and queries can filter on the deployment
+    deployment_backend = models.CharField(
+        max_length=32, blank=True, default='', db_index=True)
+    deployment_active = models.BooleanField(default=False, db_index=True)
+    deployment_identifier = models.TextField(
+        blank=True, default='', db_index=True)
+    deployed_version_uid = models.CharField(
+        max_length=255, blank=True, default='', db_index=True)
 
     permissions = GenericRelation(ObjectPermission)
 
@@ -471,6 +580,11 @@ class Asset(ObjectPermissionMixin,
 
     class Meta:
         ordering = ('-date_modified',)
+        # Keyset pagination; see `kpi.utils.keyset_pagination`
+        index_together = (
+            ('date_modified', 'id'),
+            ('parent', 'date_modified', 'id'),
+        )
 
         permissions = (
             # change_, add_, and delete_asset are provided automatically
@@ -534,6 +648,36 @@ class Asset(ObjectPermissionMixin,
     KC_ANONYMOUS_PERMISSIONS_XFORM_FLAGS = {
         'view_submissions': {'shared': True, 'shared_data': True}
     }
+    # Columns needed by each field of `AssetListSerializer`, and the related
+    # objects retrieved for it by `optimize_queryset_for_list()`. Other fields
+    # need neither
+    LIST_FIELD_COLUMNS = {
+        'url': ('uid',),
+        'date_modified': ('date_modified',),
+        'date_created': ('date_created',),
+        'owner': ('owner',),
+        'summary': ('summary',),
+        'owner__username': ('owner',),
+        'parent': ('parent',),
+        'uid': ('uid',),
+        'settings': ('settings',),
+        'name': ('name',),
+        'asset_type': ('asset_type',),
+        'has_deployment': ('deployment_backend',),
+        'deployed_version_id': ('deployed_version_uid',),
+        'deployment__identifier': ('deployment_identifier',),
+        'deployment__active': ('deployment_active',),
+        'deployment__submission_count': ('_deployment_data', 'owner'),
+        'downloads': ('uid',),
+    }
+    LIST_FIELD_RELATED_OBJECTS = {
+        'owner': ('owner',),
+        'owner__username': ('owner',),
+        'tag_string': ('tags',),
+        'version_id': ('versions',),
+        'deployment__submission_count': ('submission_counts',),
+        'permissions': ('permissions',),
+    }
 
     # todo: test and implement this method
     # def restore_version(self, uid):
@@ -586,17 +730,67 @@ class Asset(ObjectPermissionMixin,
         if _title is not None:
             self.name = _title
 
+    # State as of the last load or save; see `_get_unchanged_latest_version()`
+    _saved_asset_type = None
+    _saved_report_styles = None
+
+    @classmethod
+    def _effective_perms_changed(cls, user_ids):
+        AssetSetVersion.increment(user_ids)
+
+    def _increment_viewers_asset_set_versions(self):
+        AssetSetVersion.increment(
+            EffectivePermission.objects.filter_for_object(self).filter(
+                codename='view_asset').values('user_id'))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Asset, cls).from_db(db, field_names, values)
+        instance._remember_saved_state()
+        return instance
+
+    def _remember_saved_state(self):
+        deferred_fields = self.get_deferred_fields()
+        self._saved_asset_type = None if 'asset_type' in deferred_fields \
+            else self.asset_type
+        self._saved_report_styles = None \
+            if 'report_styles' in deferred_fields \
+            else json.dumps(self.report_styles, sort_keys=True)
+
+    def _get_unchanged_latest_version(self):
+        '''
+        Returns the latest version if `content` is the same, i.e. it already
+        went through `adjust_content_on_save()` and the summary is up to date.
+        Otherwise, returns `None`
+        '''
+        if self._state.adding or \
+                self.asset_type != self._saved_asset_type or \
+                'filename' in (self.summary or {}):
+            return None
+        latest_version = self.asset_versions.order_by(
+            '-date_modified').only('name', 'content_blob').first()
+        if latest_version is None or latest_version.content_hash != \
+                hash_version_content(self.content):
+            return None
+        return latest_version
+
     def save(self, *args, **kwargs):
         if self.content is None:
             self.content = {}
 
-        # in certain circumstances, we don't want content to
-        # be altered on save. (e.g. on asset.deploy())
-        if kwargs.pop('adjust_content', True):
-            self.adjust_content_on_save()
+        # Renames, tags and settings do not need the content to be processed
+        # again
+        unchanged_latest_version = self._get_unchanged_latest_version()
+        adjust_content = kwargs.pop('adjust_content', True)
+
+        if unchanged_latest_version is None:
+            # in certain circumstances, we don't want content to
+            # be altered on save. (e.g. on asset.deploy())
+            if adjust_content:
+                self.adjust_content_on_save()
 
-        # populate summary
-        self._populate_summary()
+            # populate summary
+            self._populate_summary()
 
         # infer asset_type only between question and block
         if self.asset_type in [ASSET_TYPE_QUESTION, ASSET_TYPE_BLOCK]:
@@ -606,10 +800,17 @@ class Asset(ObjectPermissionMixin,
             elif row_count > 1:
                 self.asset_type = ASSET_TYPE_BLOCK
 
-        self._populate_report_styles()
+        if unchanged_latest_version is None or json.dumps(
+                self.report_styles, sort_keys=True) != \
+                self._saved_report_styles:
+            self._populate_report_styles()
 
         _create_version = kwargs.pop('create_version', True)
+        if unchanged_latest_version is not None and \
+                unchanged_latest_version.name == self.name:
+            _create_version = False
         super(Asset, self).save(*args, **kwargs)
+        self._remember_saved_state()
 
         if _create_version:
             self.asset_versions.create(name=self.name,
@@ -698,7 +899,8 @@ class Asset(ObjectPermissionMixin,
     @property
     def deployed_versions(self):
         return self.asset_versions.filter(deployed=True).order_by(
-                                          '-date_modified')
+                                          '-date_modified').select_related(
+                                          'content_blob__keyframe')
 
     @property
     def latest_deployed_version(self):
@@ -761,6 +963,35 @@ class Asset(ObjectPermissionMixin,
     def __unicode__(self):
         return u'{} ({})'.format(self.name, self.uid)
 
+    def sync_deployment_fields(self):
+        '''
+        Copies the backend, state, identifier and deployed version of the
+        deployment from `_deployment_data` to their own columns. Does not save
+        the asset
+        '''
+        if not self.has_deployment:
+            self.deployment_backend = ''
+            self.deployment_active = False
+            self.deployment_identifier = ''
+            self.deployed_version_uid = ''
+            return
+
+        deployment = self.deployment
+        self.deployment_backend = deployment.backend
+        self.deployment_active = bool(deployment.active)
+        self.deployment_identifier = deployment.identifier or ''
+        version_id = deployment.version_id
+        if isinstance(version_id, int):
+            # Deployments made before the `replace_deployment_ids` migration
+            # store the id of a `reversion` version instead of a uid
+            versions = self.asset_versions.only('uid')
+            try:
+                version_id = versions.get(_reversion_version_id=version_id).uid
+            except AssetVersion.DoesNotExist:
+                deployed_version = versions.filter(deployed=True).first()
+                version_id = deployed_version.uid if deployed_version else None
+        self.deployed_version_uid = version_id or ''
+
     @property
     def has_active_hooks(self):
         """
@@ -771,40 +1002,84 @@ class Asset(ObjectPermissionMixin,
         return self.hooks.filter(active=True).exists()
 
     @staticmethod
-    def optimize_queryset_for_list(queryset):
-        ''' Used by serializers to improve performance when listing assets '''
-        queryset = queryset.defer(
-            # Avoid pulling these `JSONField`s from the database because:
-            #   * they are stored as plain text, and just deserializing them
-            #     to Python objects is CPU-intensive;
-            #   * they are often huge;
-            #   * we don't need them for list views.
-            'content', 'report_styles'
-        ).select_related(
-            'owner__username',
-        ).prefetch_related(
+    def optimize_queryset_for_list(queryset, fields=None):
+        '''
+        Used by serializers to improve performance when listing assets. When
+        `fields` lists the fields of `AssetListSerializer` to be returned, only
+        the columns and related objects that those fields need are retrieved
+        '''
+        if fields is None:
+            queryset = queryset.defer(
+                # Avoid pulling these `JSONField`s from the database because:
+                #   * they are stored as plain text, and just deserializing
+                #     them to Python objects is CPU-intensive;
+                #   * they are often huge;
+                #   * we don't need them for list views.
+                'content', 'report_styles'
+            )
+            related_objects = set(
+                related_object
+                for field_related_objects
+                in Asset.LIST_FIELD_RELATED_OBJECTS.values()
+                for related_object in field_related_objects
+            )
+        else:
+            # `date_modified` is also needed by keyset pagination
+            columns = set(['pk', 'date_modified'])
+            related_objects = set()
+            for field in fields:
+                columns.update(Asset.LIST_FIELD_COLUMNS.get(field, ()))
+                related_objects.update(
+                    Asset.LIST_FIELD_RELATED_OBJECTS.get(field, ()))
+            queryset = queryset.only(*columns)
+
+        if 'owner' in related_objects:
+            queryset = queryset.select_related('owner__username')
+        prefetches = []
+        if 'permissions' in related_objects:
             # We previously prefetched `permissions__content_object`, but that
             # actually pulled the entirety of each permission's linked asset
             # from the database! For now, the solution is to remove
             # `content_object` here *and* from
             # `ObjectPermissionNestedSerializer`.
-            'permissions__permission',
-            'permissions__user',
-            # `Prefetch(..., to_attr='prefetched_list')` stores the prefetched
-            # related objects in a list (`prefetched_list`) that we can use in
-            # other methods to avoid additional queries; see:
-            # https://docs.djangoproject.com/en/1.8/ref/models/querysets/#prefetch-objects
-            Prefetch('tags', to_attr='prefetched_tags'),
-            Prefetch(
+            prefetches.extend(('permissions__permission', 'permissions__user'))
+        # `Prefetch(..., to_attr='prefetched_list')` stores the prefetched
+        # related objects in a list (`prefetched_list`) that we can use in
+        # other methods to avoid additional queries; see:
+        # https://docs.djangoproject.com/en/1.8/ref/models/querysets/#prefetch-objects
+        if 'tags' in related_objects:
+            prefetches.append(Prefetch('tags', to_attr='prefetched_tags'))
+        if 'versions' in related_objects:
+            prefetches.append(Prefetch(
                 'asset_versions',
                 queryset=AssetVersion.objects.order_by(
                     '-date_modified'
-                ).only('uid', 'asset', 'date_modified', 'deployed'),
+                ).only('uid', 'asset', 'date_modified', 'deployed',
+                       'content_blob'),
                 to_attr='prefetched_latest_versions',
-            ),
-        )
+            ))
+        if prefetches:
+            queryset = queryset.prefetch_related(*prefetches)
+        if 'submission_counts' in related_objects:
+            queryset = queryset.prefetch_submission_counts()
         return queryset
 
+    @staticmethod
+    def prefetch_submission_counts(assets):
+        '''
+        Lets the deployment backends retrieve the submission counts of all the
+        deployed `assets` at once, before `deployment.submission_count` is
+        read for each of them
+        '''
+        assets_by_backend = defaultdict(list)
+        for asset in assets:
+            if asset.has_deployment:
+                assets_by_backend[asset._deployment_data['backend']].append(
+                    asset)
+        for backend, backend_assets in assets_by_backend.iteritems():
+            DEPLOYMENT_BACKENDS[backend].prefetch_submission_counts(
+                backend_assets)
+
 
 class AssetSnapshot(models.Model, XlsExportable, FormpackXLSFormUtils):
     '''
@@ -813,6 +1088,8 @@ class AssetSnapshot(models.Model, XlsExportable, FormpackXLSFormUtils):
 
     TODO: come up with a policy to clear this cache out.
     DO NOT: depend on these snapshots existing for more than a day until a policy is set.
+
+    The XML itself is only generated once per source; see `XFormCache`.
     '''
     xml = models.TextField()
     source = JSONField(null=True)
@@ -850,16 +1127,33 @@ class AssetSnapshot(models.Model, XlsExportable, FormpackXLSFormUtils):
         _settings = _source.get('settings', {})
         form_title = _settings.get('form_title')
         id_string = _settings.get('id_string')
-
-        (self.xml, self.details) = \
-            self.generate_xml_from_source(_source,
-                                          include_note=_note,
-                                          root_node_name='data',
-                                          form_title=form_title,
-                                          id_string=id_string)
+        self._prepend_note(_source, _note)
+
+        # Unchanged forms are previewed over and over again; only run pyxform
+        # for sources it has not seen yet
+        options = {
+            'root_node_name': 'data',
+            'form_title': form_title,
+            'id_string': id_string,
+        }
+        (self.xml, self.details) = XFormCache.get_xml(
+            XFormCache.get_key(_source, **options),
+            lambda: self.generate_xml_from_source(_source, **options)
+        )
         self.source = _source
         return super(AssetSnapshot, self).save(*args, **kwargs)
 
+    @staticmethod
+    def _prepend_note(source, note):
+        if note and 'survey' in source:
+            _translations = source.get('translations', [])
+            _label = note
+            if len(_translations) > 0:
+                _label = [_label for t in _translations]
+            source['survey'].append({u'type': u'note',
+                                     u'name': u'prepended_note',
+                                     u'label': _label})
+
     def generate_xml_from_source(self,
                                  source,
                                  include_note=False,
@@ -871,14 +1165,7 @@ class AssetSnapshot(models.Model, XlsExportable, FormpackXLSFormUtils):
         if id_string is None:
             id_string = 'snapshot_xml'
 
-        if include_note and 'survey' in source:
-            _translations = source.get('translations', [])
-            _label = include_note
-            if len(_translations) > 0:
-                _label = [_label for t in _translations]
-            source['survey'].append({u'type': u'note',
-                                     u'name': u'prepended_note',
-                                     u'label': _label})
+        self._prepend_note(source, include_note)
 
         source_copy = copy.deepcopy(source)
         self._expand_kobo_qs(source_copy)
@@ -916,8 +1203,18 @@ class AssetSnapshot(models.Model, XlsExportable, FormpackXLSFormUtils):
 
 
 
+@receiver(models.signals.post_save, sender=Asset)
+def post_save_asset(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    # Let `AssetViewSet.hash()` know that the assets of its viewers changed
+    instance._increment_viewers_asset_set_versions()
+
+
 @receiver(models.signals.post_delete, sender=Asset)
 def post_delete_asset(sender, instance, **kwargs):
+    instance._increment_viewers_asset_set_versions()
     # Remove all permissions associated with this object
     ObjectPermission.objects.filter_for_object(instance).delete()
+    EffectivePermission.objects.filter_for_object(instance).delete()
     # No recalculation is necessary since children will also be deleted
@@ -0,0 +1,31 @@
+from hashlib import md5
+
+from django.db import models
+from django.db.models import F
+
+
+class AssetSetVersion(models.Model):
+    '''
+    Counter incremented whenever one of the assets a user can view is saved
+    or deleted, or the user's permissions on an asset change. It lets
+    `AssetViewSet.hash()` tell whether anything changed without reading the
+    assets themselves
+    '''
+    user = models.OneToOneField('auth.User', related_name='asset_set_version')
+    version = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def increment(cls, user_ids):
+        '''
+        `user_ids` may also be a queryset of `user_id` values, in which case
+        a single query is needed. Users who never requested their hash have no
+        counter to increment
+        '''
+        cls.objects.filter(user_id__in=user_ids).update(
+            version=F('version') + 1)
+
+    @classmethod
+    def get_hash(cls, user):
+        asset_set_version, _ = cls.objects.get_or_create(user=user)
+        return md5('{}:{}'.format(
+            user.pk, asset_set_version.version)).hexdigest()
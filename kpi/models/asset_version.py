@@ -8,6 +8,7 @@ from django.db import models
 from jsonbfield.fields import JSONField as JSONBField
 from reversion.models import Version
 from ..fields import KpiUidField
+from ..utils.json_patch import apply_patch, make_patch
 from ..utils.kobo_to_xlsform import to_xlsform_structure
 
 from formpack.utils.expand_content import expand_content
@@ -15,6 +16,92 @@ from formpack.utils.expand_content import expand_content
 DEFAULT_DATETIME = datetime.datetime(2010, 1, 1)
 
 
+def hash_version_content(content):
+    _json_string = json.dumps(content, sort_keys=True)
+    return hashlib.sha1(_json_string).hexdigest()
+
+
+class AssetVersionContent(models.Model):
+    '''
+    Content of asset versions, stored once per `content_hash`. A row either
+    holds the full content (a keyframe) or a JSON Patch `delta` to apply to
+    the content of its `keyframe`.
+    '''
+    # A keyframe is stored after this many consecutive deltas...
+    KEYFRAME_INTERVAL = 50
+    # ...or when the delta would be more than half the size of the content
+    MAX_DELTA_SIZE_RATIO = 0.5
+
+    content_hash = models.CharField(max_length=40, unique=True)
+    content = JSONBField(null=True)
+    keyframe = models.ForeignKey('self', null=True, related_name='deltas',
+                                 on_delete=models.PROTECT)
+    delta = JSONBField(null=True)
+    # Number of deltas since the keyframe; 0 for keyframes
+    sequence = models.PositiveIntegerField(default=0)
+
+    # Serialized contents by hash. JSON strings are immutable and decoding
+    # them is much cheaper than another round trip to the database
+    _serialized_cache = {}
+    SERIALIZED_CACHE_MAX_SIZE = 100
+
+    @classmethod
+    def create_for(cls, content, content_hash, previous_hash=None):
+        '''
+        Stores `content`, as a delta from the keyframe of the row identified
+        by `previous_hash` whenever it is worth it
+        '''
+        defaults = {'content': content}
+        previous = None
+        if previous_hash is not None:
+            previous = cls.objects.select_related('keyframe').filter(
+                content_hash=previous_hash).first()
+        if previous is not None and \
+                previous.sequence < cls.KEYFRAME_INTERVAL:
+            keyframe = previous.keyframe or previous
+            delta = make_patch(keyframe.content, content)
+            # Keep the keyframe if the delta does not reproduce the content
+            # exactly, e.g. because of `str` and `unicode` differences
+            if len(json.dumps(delta)) <= cls.MAX_DELTA_SIZE_RATIO * len(
+                    json.dumps(content)) and hash_version_content(
+                    apply_patch(keyframe.content, delta)) == content_hash:
+                defaults = {
+                    'keyframe': keyframe,
+                    'delta': delta,
+                    'sequence': previous.sequence + 1,
+                }
+        # Another process may have stored the same content meanwhile
+        blob, created = cls.objects.get_or_create(content_hash=content_hash,
+                                                  defaults=defaults)
+        return blob
+
+    @classmethod
+    def get_cached_content(cls, content_hash):
+        try:
+            return json.loads(cls._serialized_cache[content_hash])
+        except KeyError:
+            return None
+
+    def get_content(self):
+        '''
+        Returns a fresh copy of the content, applying the delta if needed.
+        Use `select_related('keyframe')` to avoid an extra query for deltas
+        '''
+        content = self.get_cached_content(self.content_hash)
+        if content is not None:
+            return content
+
+        if self.keyframe_id is None:
+            content = self.content
+        else:
+            content = apply_patch(self.keyframe.content, self.delta)
+
+        if len(self._serialized_cache) >= self.SERIALIZED_CACHE_MAX_SIZE:
+            self._serialized_cache.clear()
+        self._serialized_cache[self.content_hash] = json.dumps(content)
+        return content
+
+
 class AssetVersion(models.Model):
     uid = KpiUidField(uid_prefix='v')
     asset = models.ForeignKey('Asset', related_name='asset_versions')
@@ -27,15 +114,78 @@ class AssetVersion(models.Model):
                                               null=True,
                                               on_delete=models.SET_NULL,
                                               )
-    version_content = JSONBField()
+    # Content is stored in `content_blob`; use `version_content` to read or
+    # write it. `_version_content` only holds content that has not been moved
+    # there yet (see the `compact_asset_versions` management command)
+    _version_content = JSONBField(null=True, db_column='version_content')
+    content_blob = models.ForeignKey(AssetVersionContent,
+                                     to_field='content_hash',
+                                     db_column='content_hash',
+                                     null=True,
+                                     related_name='asset_versions',
+                                     on_delete=models.PROTECT)
     uid_aliases = JSONBField(null=True)
     deployed_content = JSONBField(null=True)
+    # Expanded content of deployed versions, along with the `content_hash` it
+    # was expanded from; see `to_formpack_schema()`
+    _formpack_schema_cache = JSONBField(null=True)
     _deployment_data = JSONBField(default=False)
     deployed = models.BooleanField(default=False)
 
+    _cached_version_content = None
+
     class Meta:
         ordering = ['-date_modified']
 
+    @property
+    def version_content(self):
+        if self._cached_version_content is None:
+            if self.content_blob_id is not None:
+                content = AssetVersionContent.get_cached_content(
+                    self.content_blob_id)
+                if content is None:
+                    # Use `select_related('content_blob__keyframe')` to
+                    # avoid queries here
+                    content = self.content_blob.get_content()
+                self._cached_version_content = content
+            else:
+                self._cached_version_content = self._version_content
+        return self._cached_version_content
+
+    @version_content.setter
+    def version_content(self, content):
+        # Kept inline until `save()` moves it to `content_blob`, so that
+        # `bulk_create()` does not lose it
+        self._cached_version_content = content
+        self._version_content = content
+        self.content_blob = None
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if (update_fields is None or '_version_content' in update_fields) \
+                and '_version_content' not in self.get_deferred_fields() \
+                and self._version_content is not None:
+            self._store_content_blob()
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + [
+                    'content_blob']
+        super(AssetVersion, self).save(*args, **kwargs)
+
+    def _store_content_blob(self):
+        content_hash = hash_version_content(self._version_content)
+        try:
+            self.content_blob = AssetVersionContent.objects.get(
+                content_hash=content_hash)
+        except AssetVersionContent.DoesNotExist:
+            # New content is stored relative to the asset's latest version
+            previous_hash = AssetVersion.objects.filter(
+                asset_id=self.asset_id, content_blob__isnull=False
+            ).exclude(pk=self.pk).order_by('-date_modified').values_list(
+                'content_blob', flat=True).first()
+            self.content_blob = AssetVersionContent.create_for(
+                self._version_content, content_hash, previous_hash)
+        self._version_content = None
+
     def _deployed_content(self):
         if self.deployed_content is not None:
             return self.deployed_content
@@ -48,8 +198,23 @@ class AssetVersion(models.Model):
                                         move_autonames=True)
 
     def to_formpack_schema(self):
+        content_hash = self.content_hash
+        cached = self._formpack_schema_cache
+        if cached and cached.get('content_hash') == content_hash:
+            content = cached['content']
+        else:
+            content = expand_content(self._deployed_content())
+            # Deployed versions do not change; spare the next exports and
+            # reports the expansion
+            if self.deployed and self.pk is not None:
+                self._formpack_schema_cache = {
+                    'content_hash': content_hash,
+                    'content': content,
+                }
+                AssetVersion.objects.filter(pk=self.pk).update(
+                    _formpack_schema_cache=self._formpack_schema_cache)
         return {
-            'content': expand_content(self._deployed_content()),
+            'content': content,
             'version': self.uid,
             'version_id_key': '__version__',
         }
@@ -57,9 +222,9 @@ class AssetVersion(models.Model):
     @property
     def content_hash(self):
         # used to determine changes in the content from version to version
-        # not saved, only compared with other asset_versions
-        _json_string = json.dumps(self.version_content, sort_keys=True)
-        return hashlib.sha1(_json_string).hexdigest()
+        if self.content_blob_id is not None:
+            return self.content_blob_id
+        return hash_version_content(self.version_content)
 
     def __unicode__(self):
         return '{}@{} T{}{}'.format(self.asset.uid, self.uid,
@@ -16,8 +16,13 @@ from asset import (
     KpiTaggableManager,
     TagStringMixin,
 )
-from object_permission import ObjectPermission, ObjectPermissionMixin
+from object_permission import (
+    EffectivePermission,
+    ObjectPermission,
+    ObjectPermissionMixin,
+)
 from ..haystack_utils import update_object_in_search_index
+from ..utils.keyset_pagination import estimate_count, filter_after
 from ..fields import KpiUidField
 
 
@@ -66,6 +71,11 @@ class Collection(ObjectPermissionMixin, TagStringMixin, MPTTModel):
 
     class Meta:
         ordering = ('-date_modified',)
+        # Keyset pagination; see `kpi.utils.keyset_pagination`
+        index_together = (
+            ('date_modified', 'id'),
+            ('parent', 'date_modified', 'id'),
+        )
         permissions = (
             # change_, add_, and delete_collection are provided automatically
             # by Django
@@ -126,6 +136,7 @@ class Collection(ObjectPermissionMixin, TagStringMixin, MPTTModel):
 def post_delete_collection(sender, instance, **kwargs):
     # Remove all permissions associated with this object
     ObjectPermission.objects.filter_for_object(instance).delete()
+    EffectivePermission.objects.filter_for_object(instance).delete()
     # No recalculation is necessary since children will also be deleted
 
 
@@ -203,6 +214,28 @@ class CollectionChildrenQuerySet(object):
     def count(self):
         return self.child_collections.count() + self.child_assets.count()
 
+    def estimate_count(self):
+        return estimate_count(self.child_collections) + \
+            estimate_count(self.child_assets)
+
+    def get_keyset_page(self, position, limit):
+        ''' Returns at most `limit` children following `position`; see
+        `kpi.utils.keyset_pagination`. Collections still come before assets,
+        but each are ordered newest first instead of in tree order. Unlike
+        slicing, this does not count the collections '''
+        collections = self.child_collections
+        assets = self.child_assets
+        if position is not None and position['kind'] == 'asset':
+            # Every collection was on a previous page
+            page = []
+            assets = filter_after(assets, position)
+        else:
+            page = list(filter_after(collections, position)[:limit])
+            assets = filter_after(assets, None)
+        if len(page) < limit:
+            page.extend(assets[:limit - len(page)])
+        return page
+
     def all(self):
         return self._clone()
 
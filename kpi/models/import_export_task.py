@@ -1,9 +1,11 @@
 import re
+import math
 import pytz
 import base64
 import datetime
 import requests
 import tempfile
+import itertools
 import posixpath
 import dateutil.parser
 from io import BytesIO
@@ -25,14 +27,13 @@ from formpack.utils.string import ellipsize
 from formpack.schema.fields import ValidationStatusCopyField
 
 from kpi.utils.log import logging
-from kobo.apps.reports.report_data import build_formpack
+from kobo.apps.reports.report_data import build_formpack, ALL_FIELDS
 
 from ..fields import KpiUidField
 from ..models import Collection, Asset
 from ..zip_importer import HttpContentParse
 from ..model_utils import create_assets, _load_library_content, \
                           remove_string_prefix
-from ..deployment_backends.mock_backend import MockDeploymentBackend
 
 
 # TODO: Remove lines below (38:58) when django and django-storages are upgraded
@@ -58,6 +59,32 @@ def _flush_write_buffer(self):
 # Monkey Patch S3Boto3StorageFile class with 1.7.1 version of the method
 S3Boto3StorageFile._flush_write_buffer = _flush_write_buffer
 
+# S3 refuses multipart upload parts smaller than 5 MiB (except the last one),
+# so never copy export results in smaller pieces than this
+EXPORT_RESULT_CHUNK_SIZE = 5 * 1024 * 1024
+
+
+def _copy_in_chunks(source_file, destination_file, chunk_size=None):
+    '''
+    Copy the contents of `source_file` into `destination_file`, reading at
+    most `chunk_size` bytes at a time, so that memory usage stays bounded no
+    matter how large the export is. `chunk_size` defaults to
+    `EXPORT_RESULT_CHUNK_SIZE`. When `destination_file` is an
+    `S3Boto3StorageFile`, each full write buffer is sent as a separate part of
+    a multipart upload by `_flush_write_buffer()` above. Returns the total
+    number of bytes copied
+    '''
+    if chunk_size is None:
+        chunk_size = EXPORT_RESULT_CHUNK_SIZE
+    total_bytes = 0
+    while True:
+        chunk = source_file.read(chunk_size)
+        if not chunk:
+            break
+        destination_file.write(chunk)
+        total_bytes += len(chunk)
+    return total_bytes
+
 
 def utcnow(*args, **kwargs):
     '''
@@ -97,6 +124,9 @@ class ImportExportTask(models.Model):
     PROCESSING = 'processing'
     COMPLETE = 'complete'
     ERROR = 'error'
+    # Not a status: returned by `_run_task()` when the work continues in other
+    # asynchronous jobs
+    DEFERRED = 'deferred'
 
     STATUS_CHOICES = (
         (CREATED, CREATED),
@@ -137,7 +167,10 @@ class ImportExportTask(models.Model):
         msgs = defaultdict(list)
         try:
             # This method must be implemented by a subclass
-            self._run_task(msgs)
+            if self._run_task(msgs) == self.DEFERRED:
+                # Whichever job finishes the work is now responsible for
+                # marking this task as complete
+                return
             self.status = self.COMPLETE
         except Exception as err:
             msgs['error_type'] = type(err).__name__
@@ -149,10 +182,7 @@ class ImportExportTask(models.Model):
             )
 
         self.messages.update(msgs)
-        # Record the processing time for diagnostic purposes
-        self.data['processing_time_seconds'] = (
-            datetime.datetime.now(self.date_created.tzinfo) - self.date_created
-        ).total_seconds()
+        self._record_processing_time()
         try:
             self.save(update_fields=['status', 'messages', 'data'])
         except TypeError as e:
@@ -162,6 +192,12 @@ class ImportExportTask(models.Model):
                           exc_info=True)
             self.save(update_fields=['status'])
 
+    def _record_processing_time(self):
+        # Record the processing time for diagnostic purposes
+        self.data['processing_time_seconds'] = (
+            datetime.datetime.now(self.date_created.tzinfo) - self.date_created
+        ).total_seconds()
+
 
 class ImportTask(ImportExportTask):
     uid = KpiUidField(uid_prefix='i')
@@ -396,6 +432,19 @@ class ExportTask(ImportExportTask):
              | 123                             |
 
         The default is `['hxl']`
+    * `incremental`: optional; defaults to `False`. When `true`, and a previous
+        CSV export of the same source with the same options has completed,
+        only submissions received after that export are fetched, and their
+        rows are appended to a copy of the previous result. Submissions that
+        were edited or deleted since the previous export are NOT updated or
+        removed from the copied rows; request a complete export to see those
+        changes. Ignored for other export types
+    * `shard_count`: optional; defaults to `1`. When greater than `1`, a CSV
+        export is split into this many shards of consecutive `_id`s, each
+        rendered by its own Celery task; the last shard to finish concatenates
+        them, in order, into `result`. At most `settings.EXPORT_MAX_SHARDS`.
+        Ignored for other export types and for incremental exports that find
+        a previous one to extend
     '''
 
     uid = KpiUidField(uid_prefix='e')
@@ -418,6 +467,24 @@ class ExportTask(ImportExportTask):
     }
 
     TIMESTAMP_KEY = '_submission_time'
+    # `_submission_time` is stored as a naive UTC string in Mongo, with only
+    # per-second resolution. An incremental export therefore fetches the
+    # submissions received during the previous export's last second again,
+    # and skips those whose `_id` is in `data['last_submission_ids']`
+    MONGO_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+    # Options that must be identical for a previous export to be extended by
+    # an incremental one
+    INCREMENTAL_OPTION_KEYS = (
+        'type',
+        'lang',
+        'hierarchy_in_labels',
+        'group_sep',
+        'fields_from_all_versions',
+        'tag_cols_for_header',
+    )
+    # Because of `force_index`, formpack always places `_index` in the last
+    # (quoted) CSV column
+    CSV_INDEX_COLUMN_RE = re.compile(r'"(\d+)"$')
     # Above 244 seems to cause 'Download error' in Chrome 64/Linux
     MAXIMUM_FILENAME_LENGTH = 240
 
@@ -427,6 +494,18 @@ class ExportTask(ImportExportTask):
             'fields_from_all_versions', 'true'
         ).lower() == 'true'
 
+    @property
+    def _shard_count(self):
+        try:
+            shard_count = int(self.data.get('shard_count', 1))
+        except ValueError:
+            return 1
+        return min(max(1, shard_count), settings.EXPORT_MAX_SHARDS)
+
+    @property
+    def _incremental(self):
+        return self.data.get('incremental', 'false').lower() == 'true'
+
     def _build_export_filename(self, export, export_type):
         '''
         Internal method to build the export filename based on the export title
@@ -508,26 +587,289 @@ class ExportTask(ImportExportTask):
         '''
         Internal generator that yields each submission in the given
         `submission_stream` while recording the most recent submission
-        timestamp in `self.last_submission_time`
+        timestamp in `self.last_submission_time`, and, once the stream ends,
+        the `_id`s of the submissions received at that time in
+        `data['last_submission_ids']`
+        '''
+        last_submission_ids = set(self.data.get('last_submission_ids', []))
+        try:
+            for submission in submission_stream:
+                timestamp = self._get_submission_timestamp(submission)
+                if timestamp is not None:
+                    if (
+                            self.last_submission_time is None or
+                            timestamp > self.last_submission_time
+                    ):
+                        self.last_submission_time = timestamp
+                        last_submission_ids = set()
+                    if timestamp == self.last_submission_time:
+                        last_submission_ids.add(submission.get('_id'))
+                self.data['submission_count'] = (
+                    self.data.get('submission_count', 0) + 1)
+                yield submission
+        finally:
+            # Sorting once, rather than for every submission received during
+            # the last second, keeps bulk imports with identical timestamps
+            # linear
+            self.data['last_submission_ids'] = sorted(last_submission_ids)
+
+    def _get_submission_timestamp(self, submission):
+        '''
+        Internal method to parse the `_submission_time` of `submission`.
+        Returns `None` if it has none
         '''
-        # FIXME: Mongo has only per-second resolution. Brutal.
+        try:
+            timestamp = submission[self.TIMESTAMP_KEY]
+        except KeyError:
+            return None
+        timestamp = dateutil.parser.parse(timestamp)
+        # Mongo timestamps are UTC, but their string representation does not
+        # indicate that
+        return timestamp.replace(tzinfo=pytz.UTC)
+
+    def _skip_exported_submissions(self, submission_stream, previous_export):
+        '''
+        Internal generator that yields each submission in the given
+        `submission_stream`, except those that `previous_export` already
+        includes because they were received during its last second
+        '''
+        exported_ids = set(
+            previous_export.data.get('last_submission_ids', []))
         for submission in submission_stream:
-            try:
-                timestamp = submission[self.TIMESTAMP_KEY]
-            except KeyError:
-                pass
-            else:
-                timestamp = dateutil.parser.parse(timestamp)
-                # Mongo timestamps are UTC, but their string representation
-                # does not indicate that
-                timestamp = timestamp.replace(tzinfo=pytz.UTC)
-                if (
-                        self.last_submission_time is None or
-                        timestamp > self.last_submission_time
-                ):
-                    self.last_submission_time = timestamp
+            if (
+                submission.get('_id') in exported_ids and
+                self._get_submission_timestamp(submission) ==
+                previous_export.last_submission_time
+            ):
+                continue
             yield submission
 
+    def _get_previous_export(self, source_url):
+        '''
+        Internal method to find the most recent completed export that an
+        incremental export can extend: it must belong to the same user, have
+        the same source and options, and its `result` must still exist.
+        Returns `None` if there is no such export
+        '''
+        candidates = self._filter_by_source_kludge(
+            ExportTask.objects.filter(
+                user=self.user,
+                status=self.COMPLETE,
+                last_submission_time__isnull=False,
+            ).exclude(pk=self.pk),
+            source_url
+        ).order_by('-date_created')
+        options = [self.data.get(key) for key in self.INCREMENTAL_OPTION_KEYS]
+        for candidate in candidates:
+            if candidate.data.get('source') != source_url:
+                continue
+            candidate_options = [
+                candidate.data.get(key) for key in self.INCREMENTAL_OPTION_KEYS
+            ]
+            if candidate_options != options:
+                continue
+            if 'last_submission_ids' not in candidate.data:
+                # Completed before incremental exports could tell which
+                # submissions of the last second they included
+                continue
+            if candidate.result and candidate.result.storage.exists(
+                    candidate.result.name):
+                return candidate
+
+    def _write_csv_lines(self, output_file, csv_lines, index_offset=0):
+        '''
+        Internal method to write the lines yielded by formpack's `to_csv()` to
+        `output_file`, adding `index_offset` to the `_index` of each row
+        '''
+        for line in csv_lines:
+            if index_offset:
+                line = self.CSV_INDEX_COLUMN_RE.sub(
+                    lambda match: u'"{}"'.format(
+                        int(match.group(1)) + index_offset),
+                    line
+                )
+            output_file.write((line + u"\r\n").encode('utf-8'))
+
+    @staticmethod
+    def _plan_shards(source, shard_count):
+        '''
+        Internal method to split the submissions of `source` into (at most)
+        `shard_count` shards of consecutive `_id`s, each containing about the
+        same number of submissions. Returns a tuple of the total number of
+        submissions and a list of dictionaries, in `_id` order, each with the
+        Mongo `query` that selects the submissions of the shard and the
+        `index_offset` to apply to their `_index`.
+        The `_id`s are never all retrieved, since `get_submissions()` returns
+        at most `MongoHelper.DEFAULT_LIMIT` submissions: only the first `_id`
+        of each shard is looked up, by position. The first and last shards
+        are open-ended, so that no submission falls outside of every shard
+        '''
+        submission_count = source.deployment.submission_count
+        if not submission_count:
+            return 0, []
+        shard_size = int(math.ceil(submission_count / float(shard_count)))
+        lower_bounds = [None]
+        for offset in range(shard_size, submission_count, shard_size):
+            first_submission = next(iter(source.deployment.get_submissions(
+                fields=['_id'], sort={'_id': 1}, start=offset, limit=1
+            )), None)
+            if first_submission is None:
+                # Some submissions were deleted since they were counted
+                break
+            lower_bounds.append(first_submission['_id'])
+        shards = []
+        for index, lower_bound in enumerate(lower_bounds):
+            id_query = {}
+            if lower_bound is not None:
+                id_query['$gte'] = lower_bound
+            if index + 1 < len(lower_bounds):
+                id_query['$lt'] = lower_bounds[index + 1]
+            shards.append({
+                'query': {'_id': id_query} if id_query else {},
+                'index_offset': index * shard_size,
+                'result': None,
+            })
+        return submission_count, shards
+
+    def _get_shard_result_name(self, shard_index):
+        return export_upload_to(
+            self, u'{}-shard-{}.csv'.format(self.uid, shard_index))
+
+    def run_shard(self, shard_index):
+        '''
+        Render one shard of a sharded CSV export (see `shard_count`). Like
+        `run()`, catches all exceptions and is suitable to be called by
+        Celery. The shard that completes last assembles the final `result`.
+        If any shard fails, the export fails and every shard result is deleted
+        '''
+        if self.status != self.PROCESSING:
+            # Another shard has failed, or the whole export is stuck
+            return
+        try:
+            self._run_shard(shard_index)
+        except Exception as err:
+            logging.error(
+                'Failed to run shard %s of %s: %s' % (
+                    shard_index, self._meta.model_name, repr(err)),
+                exc_info=True
+            )
+            with transaction.atomic():
+                locked_self = ExportTask.objects.select_for_update().get(
+                    pk=self.pk)
+                locked_self.messages['error_type'] = type(err).__name__
+                locked_self.messages['error'] = err.message
+                locked_self.status = self.ERROR
+                locked_self.save(update_fields=['status', 'messages'])
+                # The export will never be assembled. Shards still running
+                # delete their own results when they find it has failed
+                locked_self._delete_shard_results(
+                    [shard['result'] for shard in locked_self.data['_shards']
+                     if shard['result']] +
+                    [self._get_shard_result_name(shard_index)]
+                )
+
+    def _delete_shard_results(self, shard_result_names):
+        '''
+        Internal method to delete the given shard results from storage,
+        ignoring those that do not exist
+        '''
+        storage = self.result.storage
+        for shard_result_name in shard_result_names:
+            try:
+                if storage.exists(shard_result_name):
+                    storage.delete(shard_result_name)
+            except Exception as err:
+                logging.warning(
+                    'Failed to delete shard result %s: %s' % (
+                        shard_result_name, repr(err)),
+                    exc_info=True
+                )
+
+    def _run_shard(self, shard_index):
+        shard = self.data['_shards'][shard_index]
+        source_url = self.data['source']
+        source_type, source = _resolve_url_to_asset_or_collection(source_url)
+
+        pack, submission_stream = build_formpack(
+            source,
+            use_all_form_versions=self._fields_from_all_versions,
+            query=shard['query'],
+            fields=ALL_FIELDS
+        )
+        # Only this shard's submissions; added to the total below
+        self.data['submission_count'] = 0
+        submission_stream = self._record_last_submission_time(
+            submission_stream)
+        options = self._build_export_options(pack)
+        export = pack.export(**options)
+        csv_lines = export.to_csv(submission_stream)
+        if shard_index > 0:
+            # Only the first shard includes the header rows
+            header_line_count = len(list(pack.export(**options).to_csv([])))
+            csv_lines = itertools.islice(csv_lines, header_line_count, None)
+
+        shard_result_name = self._get_shard_result_name(shard_index)
+        with self.result.storage.open(shard_result_name, 'wb') as shard_file:
+            self._write_csv_lines(
+                shard_file, csv_lines, shard['index_offset'])
+
+        with transaction.atomic():
+            # Shards finish concurrently; serialize their bookkeeping
+            locked_self = ExportTask.objects.select_for_update().get(
+                pk=self.pk)
+            if locked_self.status != self.PROCESSING:
+                # Another shard has failed meanwhile
+                self._delete_shard_results([shard_result_name])
+                return
+            locked_self.data['_shards'][shard_index][
+                'result'] = shard_result_name
+            locked_self.data['submission_count'] += self.data[
+                'submission_count']
+            if self.last_submission_time is not None and (
+                    locked_self.last_submission_time is None or
+                    self.last_submission_time >
+                    locked_self.last_submission_time
+            ):
+                locked_self.last_submission_time = self.last_submission_time
+                locked_self.data['last_submission_ids'] = self.data[
+                    'last_submission_ids']
+            elif (
+                self.last_submission_time is not None and
+                self.last_submission_time == locked_self.last_submission_time
+            ):
+                locked_self.data['last_submission_ids'] = sorted(
+                    set(locked_self.data['last_submission_ids']).union(
+                        self.data['last_submission_ids'])
+                )
+            locked_self.save(update_fields=['data', 'last_submission_time'])
+            is_last_shard = all(
+                s['result'] for s in locked_self.data['_shards'])
+
+        if is_last_shard:
+            locked_self._merge_shards(
+                self._build_export_filename(export, 'csv'))
+
+    def _merge_shards(self, filename):
+        '''
+        Internal method to concatenate the results of all shards, in order,
+        into `result`, named `filename`, and to mark the export as complete
+        '''
+        self.result.save(filename, ContentFile(''))
+        # See `_run_task()`
+        self.result.close()
+        storage = self.result.storage
+        with storage.open(self.result.name, 'wb') as output_file:
+            for shard in self.data['_shards']:
+                with storage.open(shard['result'], 'rb') as shard_file:
+                    _copy_in_chunks(shard_file, output_file)
+        self._delete_shard_results(
+            [shard['result'] for shard in self.data['_shards']])
+        del self.data['_shards']
+        self.status = self.COMPLETE
+        self._record_processing_time()
+        self.save(update_fields=['status', 'data'])
+        self.remove_excess(self.user, self.data['source'])
+
     def _run_task(self, messages):
         '''
         Generate the export and store the result in the `self.result`
@@ -562,24 +904,86 @@ class ExportTask(ImportExportTask):
         # Take this opportunity to do some housekeeping
         self.log_and_mark_stuck_as_errored(self.user, source_url)
 
-        if isinstance(source.deployment, MockDeploymentBackend):
-            # Currently used only for unit testing (`MockDeploymentBackend`)
-            # TODO: Have the KC backend also implement `_get_submissions()`?
-            submission_stream = source.deployment.get_submissions()
-        else:
-            submission_stream = None
-
+        previous_export = None
+        if self._incremental and export_type == 'csv':
+            previous_export = self._get_previous_export(source_url)
+
+        if (export_type == 'csv' and previous_export is None and
+                self._shard_count > 1):
+            # Decide before building the pack: each shard builds its own
+            _, shards = self._plan_shards(
+                source, self._shard_count)
+            if len(shards) > 1:
+                # Avoid a circular import
+                from kpi.tasks import export_shard_in_background
+                self.data['_shards'] = shards
+                # The count of the deployment may be approximate; each shard
+                # adds the number of submissions it has actually exported
+                self.data['submission_count'] = 0
+                # The shards re-fetch the instance; the last one to finish
+                # saves `result`
+                self.save(update_fields=['data'])
+                for shard_index in range(len(shards)):
+                    export_shard_in_background.delay(
+                        export_task_uid=self.uid, shard_index=shard_index)
+                return self.DEFERRED
+
+        submission_query = None
+        if previous_export is not None:
+            # Include the previous export's last second; see `TIMESTAMP_KEY`
+            submitted_since = previous_export.last_submission_time.astimezone(
+                pytz.UTC).strftime(self.MONGO_TIMESTAMP_FORMAT)
+            submission_query = {
+                self.TIMESTAMP_KEY: {'$gte': submitted_since}}
+
+        # Every field of the form may appear in the export, but submissions
+        # often contain much more (attachments, geolocation, notes, etc.)
         pack, submission_stream = build_formpack(
-            source, submission_stream, self._fields_from_all_versions)
+            source,
+            use_all_form_versions=self._fields_from_all_versions,
+            query=submission_query,
+            fields=ALL_FIELDS
+        )
+
+        options = self._build_export_options(pack)
+        export = pack.export(**options)
+        filename = self._build_export_filename(export, export_type)
+
+        csv_header_lines = []
+        if previous_export is not None:
+            # Exporting no submissions at all yields only the header rows
+            csv_header_lines = list(pack.export(**options).to_csv([]))
+            csv_header = u''.join(
+                line + u'\r\n' for line in csv_header_lines).encode('utf-8')
+            with previous_export.result.storage.open(
+                    previous_export.result.name, 'rb') as previous_file:
+                columns_changed = (
+                    previous_file.read(len(csv_header)) != csv_header)
+            if columns_changed:
+                # The rows of the previous export cannot be reused; start over
+                previous_export = None
+                pack, submission_stream = build_formpack(
+                    source,
+                    use_all_form_versions=self._fields_from_all_versions,
+                    fields=ALL_FIELDS
+                )
+                export = pack.export(**options)
+
+        if previous_export is not None:
+            self.last_submission_time = previous_export.last_submission_time
+            self.data['last_submission_ids'] = previous_export.data[
+                'last_submission_ids']
+            self.data['submission_count'] = previous_export.data[
+                'submission_count']
+            submission_stream = self._skip_exported_submissions(
+                submission_stream, previous_export)
+        else:
+            self.data['submission_count'] = 0
 
         # Wrap the submission stream in a generator that records the most
         # recent timestamp
         submission_stream = self._record_last_submission_time(
             submission_stream)
-
-        options = self._build_export_options(pack)
-        export = pack.export(**options)
-        filename = self._build_export_filename(export, export_type)
         self.result.save(filename, ContentFile(''))
         # FileField files are opened read-only by default and must be
         # closed and reopened to allow writing
@@ -588,8 +992,19 @@ class ExportTask(ImportExportTask):
         self.result.file.close()
         with self.result.storage.open(self.result.name, 'wb') as output_file:
             if export_type == 'csv':
-                for line in export.to_csv(submission_stream):
-                    output_file.write((line + u"\r\n").encode('utf-8'))
+                csv_lines = export.to_csv(submission_stream)
+                index_offset = 0
+                if previous_export is not None:
+                    with previous_export.result.storage.open(
+                            previous_export.result.name, 'rb'
+                    ) as previous_file:
+                        _copy_in_chunks(previous_file, output_file)
+                    # The previous result already has the header rows, and
+                    # `_index` must continue where the previous result ended
+                    csv_lines = itertools.islice(
+                        csv_lines, len(csv_header_lines), None)
+                    index_offset = self.data['submission_count']
+                self._write_csv_lines(output_file, csv_lines, index_offset)
             elif export_type == 'xls':
                 # XLSX export actually requires a filename (limitation of
                 # pyexcelerate?)
@@ -597,20 +1012,9 @@ class ExportTask(ImportExportTask):
                         prefix='export_xlsx', mode='rb'
                 ) as xlsx_output_file:
                     export.to_xlsx(xlsx_output_file.name, submission_stream)
-                    # TODO: chunk again once
-                    # https://github.com/jschneier/django-storages/issues/449
-                    # is fixed
-                    # TODO: Check if monkey-patch (line 57) can restore writing
-                    # by chunk
-                    '''
-                    while True:
-                        chunk = xlsx_output_file.read(5 * 1024 * 1024)
-                        if chunk:
-                            output_file.write(chunk)
-                        else:
-                            break
-                    '''
-                    output_file.write(xlsx_output_file.read())
+                    # Never read the whole file into memory; large exports
+                    # can be hundreds of megabytes
+                    _copy_in_chunks(xlsx_output_file, output_file)
             elif export_type == 'spss_labels':
                 export.to_spss_labels(output_file)
 
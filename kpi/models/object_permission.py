@@ -1,14 +1,20 @@
 import re
 import copy
+import threading
 from django.apps import apps
 from django.conf import settings
 from collections import defaultdict
-from django.db import models, transaction
+from django.db import connection, models, transaction
+from django.db.models.signals import post_migrate
 from django.shortcuts import _get_queryset
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.auth.models import User, AnonymousUser, Permission
-from django.core.exceptions import ValidationError, ImproperlyConfigured
+from django.core.exceptions import (
+    FieldDoesNotExist,
+    ImproperlyConfigured,
+    ValidationError,
+)
 
 from ..fields import KpiUidField
 from ..deployment_backends.kc_access.utils import (
@@ -119,11 +125,10 @@ def get_objects_for_user(user, perms, klass=None):
         user = get_anonymous_user()
 
     # Now we should extract list of pk values for which we would filter queryset
-    user_obj_perms_queryset = (ObjectPermission.objects
+    user_obj_perms_queryset = (EffectivePermission.objects
         .filter(user=user)
-        .filter(permission__content_type=ctype)
-        .filter(permission__codename__in=codenames)
-        .filter(deny=False))
+        .filter(content_type=ctype)
+        .filter(codename__in=codenames))
 
     if len(codenames) > 1:
         counts = user_obj_perms_queryset.values('object_id').annotate(
@@ -137,8 +142,21 @@ def get_objects_for_user(user, perms, klass=None):
     return objects
 
 
+# Process-wide caches. See `get_anonymous_user()` and `get_cached_permissions()`
+_anonymous_user = None
+_permissions_by_content_type = {}
+# Request-wide cache. See `PermissionCacheMiddleware`
+_request_cache = threading.local()
+
+
 def get_anonymous_user():
     ''' Return a real User in the database to represent AnonymousUser. '''
+    global _anonymous_user
+    if _anonymous_user is not None:
+        return _anonymous_user
+    request_cache = get_request_cache()
+    if request_cache is not None and 'anonymous_user' in request_cache:
+        return request_cache['anonymous_user']
     try:
         user = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
     except User.DoesNotExist:
@@ -151,9 +169,64 @@ def get_anonymous_user():
             pk=settings.ANONYMOUS_USER_ID,
             username=username
         )
+    else:
+        # A user read within a transaction may have been created by that
+        # same transaction, and would vanish if it were rolled back
+        if not connection.in_atomic_block:
+            _anonymous_user = user
+    if request_cache is not None:
+        request_cache['anonymous_user'] = user
     return user
 
 
+def get_cached_permissions(content_type):
+    ''' Return a dictionary of all `Permission`s of `content_type`, keyed by
+    codename. `Permission`s are only created by migrations, so the result is
+    cached for the life of the process, like `ContentType`s are. '''
+    try:
+        return _permissions_by_content_type[content_type.pk]
+    except KeyError:
+        permissions = {
+            permission.codename: permission
+            for permission in Permission.objects.filter(
+                content_type=content_type)
+        }
+        _permissions_by_content_type[content_type.pk] = permissions
+        return permissions
+
+
+def _clear_process_caches(**kwargs):
+    ''' Permissions and users may be recreated when the database is migrated
+    or flushed '''
+    global _anonymous_user
+    _anonymous_user = None
+    _permissions_by_content_type.clear()
+
+post_migrate.connect(_clear_process_caches)
+
+
+def get_request_cache():
+    ''' Return the dictionary holding the results of permission checks for
+    the current request, or `None` outside of a request '''
+    return getattr(_request_cache, 'store', None)
+
+
+def start_request_cache():
+    _request_cache.store = {}
+
+
+def end_request_cache():
+    _request_cache.store = None
+
+
+def clear_request_cache():
+    ''' Forget the results of permission checks made so far, e.g. because
+    permissions have changed '''
+    request_cache = get_request_cache()
+    if request_cache is not None:
+        request_cache.clear()
+
+
 class ObjectPermissionManager(models.Manager):
     def _rewrite_query_args(self, method, content_object, **kwargs):
         ''' Rewrite content_object into object_id and content_type, then pass
@@ -234,6 +307,35 @@ class ObjectPermission(models.Model):
         )
 
 
+class EffectivePermission(models.Model):
+    ''' Denormalized result of `ObjectPermissionMixin._get_effective_perms()`:
+    one record for each permission, calculated ones included, that a user
+    effectively has on an object. It allows permission checks with a single
+    indexed query. Records are kept up to date by
+    `ObjectPermissionMixin._sync_effective_perms()`; the
+    `rebuild_effective_permissions` management command recreates or checks
+    them all. '''
+    user = models.ForeignKey('auth.User')
+    permission = models.ForeignKey('auth.Permission')
+    # Copied from `permission` to avoid a join when checking permissions
+    codename = models.CharField(max_length=100)
+    object_id = models.PositiveIntegerField()
+    content_type = models.ForeignKey(ContentType)
+    content_object = GenericForeignKey('content_type', 'object_id')
+    objects = ObjectPermissionManager()
+
+    class Meta:
+        unique_together = ('user', 'permission', 'object_id', 'content_type')
+        index_together = (
+            ('content_type', 'object_id', 'user', 'codename'),
+            ('user', 'content_type', 'codename'),
+        )
+
+    def __unicode__(self):
+        return u'{} effectively granted to {}'.format(
+            unicode(self.codename), unicode(self.user))
+
+
 class ObjectPermissionMixin(object):
     ''' A mixin class that adds the methods necessary for object-level
     permissions to a model (either models.Model or MPTTModel). The model must
@@ -245,6 +347,33 @@ class ObjectPermissionMixin(object):
     e.g.
         class MyAwesomeModel(ObjectPermissionMixin, models.Model)
     '''
+    # Number of descendants handled at once by `recalculate_descendants_perms()`
+    PERMISSIONS_BATCH_SIZE = 1000
+    # Fields (`attname`s) that `_get_effective_perms()` depends on. Unless one
+    # of them changed since the object was loaded, `save()` leaves the
+    # permissions alone
+    PERMISSIONS_DEPENDENCIES = (
+        'parent_id', 'owner_id', 'editors_can_change_permissions')
+    _loaded_permissions_dependencies = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(ObjectPermissionMixin, cls).from_db(
+            db, field_names, values)
+        instance._loaded_permissions_dependencies = \
+            instance._get_permissions_dependencies()
+        return instance
+
+    def _get_permissions_dependencies(self):
+        ''' Returns the current values of `PERMISSIONS_DEPENDENCIES`, or
+        `None` if some are deferred '''
+        deferred_fields = self.get_deferred_fields()
+        if any(field in deferred_fields
+               for field in self.PERMISSIONS_DEPENDENCIES):
+            return None
+        return tuple(getattr(self, field)
+                     for field in self.PERMISSIONS_DEPENDENCIES)
+
     def get_assignable_permissions(self):
         ''' The "versioned app registry" used during migrations apparently does
         not store non-database attributes, so this awful workaround is needed
@@ -284,15 +413,20 @@ class ObjectPermissionMixin(object):
 
     @transaction.atomic
     def save(self, *args, **kwargs):
+        adding = self._state.adding
         # Make sure we exist in the database before proceeding
         super(ObjectPermissionMixin, self).save(*args, **kwargs)
+        dependencies = self._get_permissions_dependencies()
+        if not adding and dependencies is not None and \
+                dependencies == self._loaded_permissions_dependencies:
+            # Trivial modification, e.g. a collection was renamed
+            return
         # Recalculate self and all descendants, re-fetching ourself first to
         # guard against stale MPTT values
         fresh_self = type(self).objects.get(pk=self.pk)
-        # TODO: Don't do this when the modification is trivial, e.g. a
-        # collection was renamed
         fresh_self._recalculate_inherited_perms()
         fresh_self.recalculate_descendants_perms()
+        self._loaded_permissions_dependencies = dependencies
 
     def _filter_anonymous_perms(self, unfiltered_set):
         ''' Restrict a set of tuples in the format (user_id, permission_id) to
@@ -305,9 +439,10 @@ class ObjectPermissionMixin(object):
             app_label, codename = perm_parse(perm)
             if app_label == content_type.app_label:
                 codenames.add(codename)
-        allowed_permissions = Permission.objects.filter(
-            content_type=content_type, codename__in=codenames
-        ).values_list('pk', flat=True)
+        permissions = get_cached_permissions(content_type)
+        allowed_permissions = [permissions[codename].pk
+                               for codename in codenames
+                               if codename in permissions]
         filtered_set = copy.copy(unfiltered_set)
         for user_id, permission_id in unfiltered_set:
             if user_id == settings.ANONYMOUS_USER_ID:
@@ -364,10 +499,11 @@ class ObjectPermissionMixin(object):
                 codename is None or codename.startswith('share_')
         ):
             # Everyone with change_ should also get share_
-            change_permissions = Permission.objects.filter(
-                content_type=content_type,
-                codename__startswith='change_'
-            )
+            permissions = get_cached_permissions(content_type)
+            change_permissions = [
+                permission for permission in permissions.values()
+                if permission.codename.startswith('change_')
+            ]
             for change_permission in change_permissions:
                 share_permission_codename = re.sub(
                     '^change_', 'share_', change_permission.codename, 1)
@@ -378,10 +514,7 @@ class ObjectPermissionMixin(object):
                     # doesn't match exactly. Necessary because `Asset` has
                     # `*_submissions` in addition to `*_asset`
                     continue
-                share_permission = Permission.objects.get(
-                    content_type=content_type,
-                    codename=share_permission_codename
-                )
+                share_permission = permissions[share_permission_codename]
                 for user_id, permission_id in effective_perms_copy:
                     if permission_id == change_permission.pk:
                         effective_perms.add((user_id, share_permission.pk))
@@ -390,10 +523,11 @@ class ObjectPermissionMixin(object):
                 user is None or user.pk == self.owner.pk) and (
                 codename is None or codename.startswith('delete_')
         ):
-            delete_permissions = Permission.objects.filter(
-                content_type=content_type,
-                codename__startswith='delete_'
-            )
+            delete_permissions = [
+                permission for permission in
+                get_cached_permissions(content_type).values()
+                if permission.codename.startswith('delete_')
+            ]
             for delete_permission in delete_permissions:
                 if (codename is not None and
                         delete_permission.codename != codename
@@ -411,80 +545,310 @@ class ObjectPermissionMixin(object):
             # Anonymous users weren't considered; no filtering is necessary
             return effective_perms
 
+    @classmethod
+    def _effective_perms_changed(cls, user_ids):
+        ''' Called after the effective permissions of `user_ids` on objects of
+        this model were added or removed. Nothing to do by default. '''
+        pass
+
+    def _sync_effective_perms(self, check_only=False, notify_changes=True):
+        ''' Bring the `EffectivePermission` records of this object in line
+        with `_get_effective_perms()`. Return the (user_id, permission_id)
+        tuples that were missing and the ones that were stale. If
+        `check_only` is `True`, only compare without writing anything. If
+        `notify_changes` is `False`, the caller is responsible for calling
+        `_effective_perms_changed()`. '''
+        effective_perms = self._get_effective_perms()
+        existing_effective_perms = EffectivePermission.objects.filter_for_object(
+            self)
+        existing_perms = set(existing_effective_perms.values_list(
+            'user_id', 'permission_id'))
+        missing_perms = effective_perms.difference(existing_perms)
+        stale_perms = existing_perms.difference(effective_perms)
+        if check_only:
+            return missing_perms, stale_perms
+
+        if stale_perms:
+            stale_query = models.Q()
+            for user_id, permission_id in stale_perms:
+                stale_query |= models.Q(
+                    user_id=user_id, permission_id=permission_id)
+            existing_effective_perms.filter(stale_query).delete()
+        if stale_perms or missing_perms:
+            clear_request_cache()
+        if (stale_perms or missing_perms) and notify_changes:
+            self._effective_perms_changed(
+                set(user_id for user_id, _ in missing_perms | stale_perms))
+        if missing_perms:
+            content_type = ContentType.objects.get_for_model(self)
+            codenames = {
+                permission.pk: permission.codename for permission in
+                get_cached_permissions(content_type).values()
+            }
+            EffectivePermission.objects.bulk_create([
+                EffectivePermission(
+                    user_id=user_id,
+                    permission_id=permission_id,
+                    codename=codenames[permission_id],
+                    object_id=self.pk,
+                    content_type=content_type,
+                ) for user_id, permission_id in missing_perms
+            ])
+        return missing_perms, stale_perms
+
+    def _get_effective_codenames(self, *user_ids):
+        ''' Return a dictionary of the codenames of the effective permissions
+        each user of `user_ids` has on this object. During a request, results
+        are remembered until permissions change; see
+        `PermissionCacheMiddleware`. '''
+        content_type = ContentType.objects.get_for_model(self)
+        request_cache = get_request_cache()
+        if request_cache is None:
+            request_cache = {}
+        cache_keys = {
+            user_id: ('effective_codenames', content_type.pk, self.pk, user_id)
+            for user_id in user_ids
+        }
+        missing_user_ids = [user_id for user_id, cache_key
+                            in cache_keys.iteritems()
+                            if cache_key not in request_cache]
+        if missing_user_ids:
+            codenames = defaultdict(set)
+            for user_id, codename in EffectivePermission.objects.filter(
+                content_type=content_type,
+                object_id=self.pk,
+                user_id__in=missing_user_ids
+            ).values_list('user_id', 'codename'):
+                codenames[user_id].add(codename)
+            for user_id in missing_user_ids:
+                request_cache[cache_keys[user_id]] = codenames[user_id]
+        return {user_id: request_cache[cache_key]
+                for user_id, cache_key in cache_keys.iteritems()}
+
+    def _is_calculated_perm_applicable(self, user_obj, codename):
+        ''' `EffectivePermission` reflects the object as it was last saved.
+        Honor unsaved changes to the attributes calculated permissions depend
+        on, as `_get_effective_perms()` does. '''
+        if codename not in self.CALCULATED_PERMISSIONS:
+            return True
+        if codename.startswith('share_'):
+            return self.editors_can_change_permissions
+        if codename.startswith('delete_'):
+            return self.owner_id is not None and self.owner_id == user_obj.pk
+        return True
+
     def recalculate_descendants_perms(self):
         ''' Recalculate the inherited permissions of all descendants. Expects
-        either self.get_mixed_children() or self.get_children() to exist. The
-        former will be used preferentially if it exists. '''
-
-        GET_CHILDREN_METHODS = ('get_mixed_children', 'get_children')
-        can_have_children = False
-        for method in GET_CHILDREN_METHODS:
-            if hasattr(self, method):
-                can_have_children = True
-                break
-        if not can_have_children:
+        self to be an MPTT node, e.g. a `Collection`. Descendants are the
+        nodes within our `lft`/`rght` range, as well as the objects of other
+        models whose `parent` is one of those nodes or ourself, e.g. the
+        `Asset`s of a `Collection`. Instead of handling each descendant on its
+        own, permissions are read, calculated and written for batches of
+        `PERMISSIONS_BATCH_SIZE` descendants at a time. '''
+        if not hasattr(self, 'get_descendants'):
             # It's impossible for us to have descendants. Move along...
             return
 
-        # Any potential parents found will be appended to this list
-        parents = [self]
-        while True:
+        node_model = self._meta.concrete_model
+        # Only retrieve the necessary fields from the database. NB: `content`
+        # is particularly heavy
+        only_fields = ('pk', 'owner', 'parent', 'editors_can_change_permissions')
+        # The effective permissions of every node whose children are yet to
+        # be processed
+        effective_perms_by_pk = {
+            self.pk: self._get_effective_perms(include_calculated=False)
+        }
+
+        # MPTT returns nodes in tree order: parents come before their children
+        nodes = self.get_descendants().only(*only_fields)
+        for batch_start in xrange(0, nodes.count(), self.PERMISSIONS_BATCH_SIZE):
+            batch = list(nodes[batch_start:
+                               batch_start + self.PERMISSIONS_BATCH_SIZE])
+            effective_perms_by_pk.update(self._bulk_recalculate_inherited_perms(
+                batch, effective_perms_by_pk))
+
+        mptt_meta = self._mptt_meta
+        in_subtree = {
+            'parent__' + mptt_meta.tree_id_attr:
+                getattr(self, mptt_meta.tree_id_attr),
+            'parent__{}__gte'.format(mptt_meta.left_attr):
+                getattr(self, mptt_meta.left_attr),
+            'parent__{}__lte'.format(mptt_meta.right_attr):
+                getattr(self, mptt_meta.right_attr),
+        }
+        for model in get_models_with_object_permissions():
+            if model is node_model:
+                continue
             try:
-                parent = parents.pop()
-            except IndexError:
-                # No parents left; we're done!
-                break
-            # Get the effective permissions once per parent so that each child
-            # does not have to query the database for the same information
-            parent_effective_perms = parent._get_effective_perms(
-                include_calculated=False)
-            # Get all children, retrieving only the necessary fields from the
-            # database. NB: `content` is particularly heavy
-            for method in GET_CHILDREN_METHODS:
-                if hasattr(parent, method):
+                parent_field = model._meta.get_field('parent')
+            except FieldDoesNotExist:
+                continue
+            if parent_field.rel.to is not node_model:
+                continue
+            children = model.objects.filter(**in_subtree).only(
+                *only_fields).order_by('pk')
+            last_pk = None
+            while True:
+                batch = children
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+                batch = list(batch[:self.PERMISSIONS_BATCH_SIZE])
+                if not batch:
                     break
-            children = getattr(parent, method)().only(
-                'pk', 'owner', 'parent')
-            # Delete stale permissions once per parent, instead of per-child
-            # TODO: Um, don't have two loops?
-            delete_pks_by_content_type = {}
-            for child in children:
-                content_type = ContentType.objects.get_for_model(child).pk
-                pk_list = delete_pks_by_content_type.get(content_type, [])
-                pk_list.append(child.pk)
-                delete_pks_by_content_type[content_type] = pk_list
-            delete_query = models.Q()
-            for content_type, pks in delete_pks_by_content_type.iteritems():
-                delete_query |= models.Q(
+                self._bulk_recalculate_inherited_perms(
+                    batch, effective_perms_by_pk)
+                last_pk = batch[-1].pk
+
+        clear_request_cache()
+
+    @classmethod
+    def _bulk_recalculate_inherited_perms(cls, objects,
+                                          parent_effective_perms_by_pk):
+        ''' Set-based equivalent of `_recalculate_inherited_perms()` and
+        `_sync_effective_perms()` for `objects`, which must all be of the same
+        model. The effective permissions (without calculated ones) of the
+        parents of `objects` must be in `parent_effective_perms_by_pk`.
+        Return those of `objects`, in the same format. '''
+        if not objects:
+            return {}
+        sample = objects[0]
+        content_type = ContentType.objects.get_for_model(sample)
+        permissions = get_cached_permissions(content_type)
+        permissions_by_pk = {permission.pk: codename
+                             for codename, permission in permissions.iteritems()}
+        object_pks = [obj.pk for obj in objects]
+
+        # Translate the permissions of parents into ours
+        parent_model = sample._meta.get_field('parent').rel.to
+        parent_content_type = ContentType.objects.get_for_model(parent_model)
+        if hasattr(sample, 'MAPPED_PARENT_PERMISSIONS'):
+            parent_permissions = get_cached_permissions(parent_content_type)
+            translate_perm = {
+                parent_permissions[parent_codename].pk:
+                    permissions[codename].pk
+                for parent_codename, codename
+                in sample.MAPPED_PARENT_PERMISSIONS.iteritems()
+            }
+        elif content_type == parent_content_type:
+            translate_perm = {permission.pk: permission.pk
+                              for permission in permissions.values()}
+        else:
+            raise ImproperlyConfigured(
+                'Parent of {} is a {}, but the child has not defined '
+                'MAPPED_PARENT_PERMISSIONS.'.format(
+                    type(sample), parent_model)
+            )
+        owner_permission_ids = [
+            permissions[codename].pk
+            for codename in sample.get_assignable_permissions()
+        ]
+        # Calculated permissions; see `_get_effective_perms()`
+        share_permission_ids = {}
+        delete_permission_ids = []
+        for codename, permission in permissions.iteritems():
+            if codename.startswith('change_'):
+                share_codename = re.sub('^change_', 'share_', codename, 1)
+                if share_codename in permissions:
+                    share_permission_ids[permission.pk] = \
+                        permissions[share_codename].pk
+            elif codename.startswith('delete_'):
+                delete_permission_ids.append(permission.pk)
+
+        grant_perms = defaultdict(set)
+        deny_perms = defaultdict(set)
+        for object_id, user_id, permission_id, deny in \
+                ObjectPermission.objects.filter(
                     content_type=content_type,
-                    object_id__in=pks
+                    object_id__in=object_pks,
+                    inherited=False
+                ).values_list('object_id', 'user_id', 'permission_id', 'deny'):
+            if deny:
+                deny_perms[object_id].add((user_id, permission_id))
+            else:
+                grant_perms[object_id].add((user_id, permission_id))
+
+        uid_field = ObjectPermission._meta.get_field('uid')
+        new_permissions = []
+        new_effective_permissions = []
+        effective_perms_by_pk = {}
+        for obj in objects:
+            inherited_perms = set()
+            # The owner gets every assignable permission
+            if obj.owner_id is not None:
+                inherited_perms.update(
+                    (obj.owner_id, permission_id)
+                    for permission_id in owner_permission_ids
                 )
-            # filter(Q()) is like all(); make sure we don't delete with a query
-            # like that just because there are no children!
-            if len(delete_pks_by_content_type):
-                # This doesn't run as a single DELETE query. For once, MySQL
-                # wins? https://code.djangoproject.com/ticket/23576#comment:3
-                # TODO: Verify this is faster than having children delete
-                ObjectPermission.objects.filter(
-                    delete_query, inherited=True).delete()
-            # Process each child individually, but only write to the database
-            # once per parent
-            objects_to_create = []
-            for child in children:
-                for method in GET_CHILDREN_METHODS:
-                    if hasattr(child, method):
-                        # This child could have its own children; make sure we
-                        # check it later
-                        parents.append(child)
-                        break
-                # Recalculate the child's permissions
-                new_permissions = child._recalculate_inherited_perms(
-                    parent_effective_perms=parent_effective_perms,
-                    stale_already_deleted=True,
-                    return_instead_of_creating=True
+            # All our parent's effective permissions become our inherited
+            # permissions
+            if obj.parent_id is not None:
+                for user_id, permission_id in \
+                        parent_effective_perms_by_pk[obj.parent_id]:
+                    if user_id == obj.owner_id:
+                        # The owner already has every assignable permission
+                        continue
+                    try:
+                        inherited_perms.add(
+                            (user_id, translate_perm[permission_id]))
+                    except KeyError:
+                        # We haven't been configured to inherit this
+                        # permission from our parent, so skip it
+                        continue
+            for user_id, permission_id in inherited_perms:
+                new_permissions.append(ObjectPermission(
+                    content_type=content_type,
+                    object_id=obj.pk,
+                    user_id=user_id,
+                    permission_id=permission_id,
+                    inherited=True,
+                    uid=uid_field.generate_uid(),
+                ))
+
+            effective_perms = sample._filter_anonymous_perms(
+                grant_perms[obj.pk].union(inherited_perms).difference(
+                    deny_perms[obj.pk]))
+            effective_perms_by_pk[obj.pk] = effective_perms
+
+            calculated_perms = set(effective_perms)
+            if obj.editors_can_change_permissions:
+                for user_id, permission_id in effective_perms:
+                    if permission_id in share_permission_ids:
+                        calculated_perms.add(
+                            (user_id, share_permission_ids[permission_id]))
+            if obj.owner_id is not None:
+                calculated_perms.update(
+                    (obj.owner_id, permission_id)
+                    for permission_id in delete_permission_ids
                 )
-                objects_to_create += new_permissions
-            ObjectPermission.objects.bulk_create(objects_to_create)
+            for user_id, permission_id in sample._filter_anonymous_perms(
+                    calculated_perms):
+                new_effective_permissions.append(EffectivePermission(
+                    user_id=user_id,
+                    permission_id=permission_id,
+                    codename=permissions_by_pk[permission_id],
+                    object_id=obj.pk,
+                    content_type=content_type,
+                ))
+
+        ObjectPermission.objects.filter(
+            content_type=content_type,
+            object_id__in=object_pks,
+            inherited=True
+        ).delete()
+        ObjectPermission.objects.bulk_create(new_permissions)
+        stale_effective_permissions = EffectivePermission.objects.filter(
+            content_type=content_type,
+            object_id__in=object_pks
+        )
+        affected_user_ids = set(
+            stale_effective_permissions.values_list('user_id', flat=True))
+        stale_effective_permissions.delete()
+        EffectivePermission.objects.bulk_create(new_effective_permissions)
+        affected_user_ids.update(
+            permission.user_id for permission in new_effective_permissions)
+        sample._effective_perms_changed(affected_user_ids)
+
+        return effective_perms_by_pk
 
     def _recalculate_inherited_perms(
             self,
@@ -509,10 +873,9 @@ class ObjectPermissionMixin(object):
             objects_to_return = []
         # The owner gets every assignable permission
         if self.owner is not None:
-            for perm in Permission.objects.filter(
-                content_type=content_type,
-                codename__in=self.get_assignable_permissions()
-            ):
+            permissions = get_cached_permissions(content_type)
+            for codename in self.get_assignable_permissions():
+                perm = permissions[codename]
                 new_permission = ObjectPermission()
                 new_permission.content_object = self
                 # `user_id` instead of `user` is another workaround for
@@ -581,6 +944,7 @@ class ObjectPermissionMixin(object):
                     new_permission.save()
         if return_instead_of_creating:
             return objects_to_return
+        self._sync_effective_perms()
 
     def _get_implied_perms(self, explicit_perm, reverse=False):
         """ Determine which permissions are implied by `explicit_perm` based on
@@ -629,7 +993,8 @@ class ObjectPermissionMixin(object):
             :param perm str: The `codename` of the `Permission`
             :param deny bool: When `True`, break inheritance from parent object
             :param defer_recalc bool: When `True`, skip recalculating
-                descendants
+                descendants and synchronizing effective permissions, which
+                the caller must then do
             :param skip_kc bool: When `True`, skip assignment of applicable KC
                 permissions
         """
@@ -652,10 +1017,8 @@ class ObjectPermissionMixin(object):
                 )
             # Get the User database representation for AnonymousUser
             user_obj = get_anonymous_user()
-        perm_model = Permission.objects.get(
-            content_type__app_label=app_label,
-            codename=codename
-        )
+        perm_model = get_cached_permissions(
+            ContentType.objects.get_for_model(self))[codename]
         existing_perms = ObjectPermission.objects.filter_for_object(
             self,
             user=user_obj,
@@ -699,9 +1062,11 @@ class ObjectPermissionMixin(object):
             self.assign_perm(
                 user_obj, implied_perm, deny=deny, defer_recalc=True)
         # We might have been called by ourself to assign a related
-        # permission. In that case, don't recalculate here.
+        # permission. In that case, don't recalculate here: the outermost
+        # call synchronizes the effective permissions once for all of them
         if defer_recalc:
             return new_permission
+        self._sync_effective_perms()
         # Recalculate all descendants, re-fetching ourself first to guard
         # against stale MPTT values
         fresh_self = type(self).objects.get(pk=self.pk)
@@ -711,10 +1076,11 @@ class ObjectPermissionMixin(object):
     def get_perms(self, user_obj):
         ''' Return a list of codenames of all effective grant permissions that
         user_obj has on this object. '''
-        user_perm_ids = self._get_effective_perms(user=user_obj)
-        perm_ids = [x[1] for x in user_perm_ids]
-        return Permission.objects.filter(pk__in=perm_ids).values_list(
-            'codename', flat=True)
+        if isinstance(user_obj, AnonymousUser):
+            user_obj = get_anonymous_user()
+        codenames = self._get_effective_codenames(user_obj.pk)[user_obj.pk]
+        return [codename for codename in sorted(codenames)
+                if self._is_calculated_perm_applicable(user_obj, codename)]
 
     def get_users_with_perms(self, attach_perms=False):
         ''' Return a QuerySet of all users with any effective grant permission
@@ -748,14 +1114,17 @@ class ObjectPermissionMixin(object):
         # Treat superusers the way django.contrib.auth does
         if user_obj.is_active and user_obj.is_superuser:
             return True
-        # Look for matching permissions
-        result = len(self._get_effective_perms(
-            user=user_obj,
-            codename=codename
-        )) == 1
-        if not result and not is_anonymous:
-            # The user-specific test failed, but does the public have access?
-            result = self.has_perm(AnonymousUser(), perm)
+        if not self._is_calculated_perm_applicable(user_obj, codename):
+            return False
+        # Look for matching permissions. If the user has none, does the public
+        # have access?
+        user_ids = [user_obj.pk]
+        if not is_anonymous:
+            user_ids.append(settings.ANONYMOUS_USER_ID)
+        result = any(
+            codename in codenames for codenames in
+            self._get_effective_codenames(*user_ids).values()
+        )
         if result and is_anonymous:
             # Is an anonymous user allowed to have this permission?
             fq_permission = '{}.{}'.format(app_label, codename)
@@ -779,7 +1148,8 @@ class ObjectPermissionMixin(object):
             :type user_obj: :py:class:`User` or :py:class:`AnonymousUser`
             :param perm str: The `codename` of the `Permission`
             :param defer_recalc bool: When `True`, skip recalculating
-                descendants
+                descendants and synchronizing effective permissions, which
+                the caller must then do
             :param skip_kc bool: When `True`, skip assignment of applicable KC
                 permissions
         """
@@ -817,9 +1187,11 @@ class ObjectPermissionMixin(object):
         if not skip_kc:
             remove_applicable_kc_permissions(self, user_obj, codename)
         # We might have been called by ourself to assign a related
-        # permission. In that case, don't recalculate here.
+        # permission. In that case, don't recalculate here: the outermost
+        # call synchronizes the effective permissions once for all of them
         if defer_recalc:
             return
+        self._sync_effective_perms()
         # Recalculate all descendants, re-fetching ourself first to guard
         # against stale MPTT values
         fresh_self = type(self).objects.get(pk=self.pk)
@@ -0,0 +1,37 @@
+from django.db import models
+from jsonbfield.fields import JSONField as JSONBField
+
+
+class ReportAggregate(models.Model):
+    '''
+    Statistics of the submissions to an asset, as needed to build its report,
+    optionally split by the values of a select one question, for one group
+    of the fields of the form. Wide forms have several groups, counted by
+    concurrent tasks. They are updated with the submissions received after
+    the last one included (see
+    `kobo.apps.reports.report_data.update_report_aggregate()`), so that
+    building a report does not require reading every submission again.
+    They are updated by Celery tasks, never while answering a request
+    '''
+    asset = models.ForeignKey('Asset', related_name='report_aggregates')
+    # Name of the question the statistics are split by, if any
+    split_by = models.CharField(max_length=255, blank=True, default='')
+    # Index of the group of fields the statistics are about; see
+    # `kobo.apps.reports.report_data._get_field_groups()`
+    field_group = models.PositiveIntegerField(default=0)
+    # Identifies the deployed versions and the size of field groups the
+    # statistics were computed with
+    formpack_key = models.CharField(max_length=40, blank=True, default='')
+    submission_count = models.PositiveIntegerField(default=0)
+    # Position of the newest submission included, ordered by
+    # `_submission_time` then `_id`. `None` when unknown, in which case the
+    # statistics are computed again from scratch on the next update
+    last_submission_time = models.CharField(max_length=64, null=True)
+    last_submission_id = models.IntegerField(null=True)
+    metrics = JSONBField(default=dict)
+    date_modified = models.DateTimeField(auto_now=True)
+    # Last time every submission was read, rather than only the new ones
+    date_rebuilt = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (('asset', 'split_by', 'field_group'),)
@@ -0,0 +1,24 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
+
+
+class SearchIndexQueueItem(models.Model):
+    '''
+    An object whose search index entry is out of date. Queued by
+    `kpi.haystack_utils.SignalProcessor` when the object is saved or deleted,
+    and processed in batches by `kpi.haystack_utils.process_search_index_queue()`.
+    There is at most one item per object, however many times it changed
+    '''
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    # Updated each time the object changes, so that processing does not
+    # dequeue changes made while the object was being indexed
+    date_enqueued = models.DateTimeField(default=timezone.now)
+    # Failed indexing attempts since the object last changed. Items are left
+    # alone after `kpi.haystack_utils.SEARCH_INDEX_QUEUE_MAX_ATTEMPTS`
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
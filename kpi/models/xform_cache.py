@@ -0,0 +1,133 @@
+import json
+import hashlib
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.utils import timezone
+from jsonfield import JSONField
+
+
+class XFormCache(models.Model):
+    '''
+    XML generated by pyxform (see `AssetSnapshot.generate_xml_from_source()`),
+    stored once per normalized source and generation options. Failed
+    generations are not stored. The least recently used entries are deleted
+    when the total size of the XML exceeds `settings.XFORM_CACHE_MAX_SIZE`;
+    the `delete_xform_cache` management command deletes the ones that have
+    not been used for a while
+    '''
+    # Increment to invalidate every entry, e.g. after changing how the XML is
+    # generated
+    CACHE_VERSION = 1
+    # Avoid writing to the database on each hit
+    ACCESS_DATE_RESOLUTION = datetime.timedelta(hours=1)
+    # Once the maximum size is exceeded, evict entries until the total size is
+    # this fraction of it, so that eviction does not happen on every miss
+    EVICTION_TARGET_RATIO = 0.9
+    # Running total of `size`, kept in the cache so that the table is only
+    # summed when eviction may be needed
+    TOTAL_SIZE_CACHE_KEY = 'xform_cache_total_size'
+
+    key = models.CharField(max_length=40, unique=True)
+    xml = models.TextField()
+    details = JSONField(default=dict)
+    size = models.PositiveIntegerField(default=0)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_accessed = models.DateTimeField(default=timezone.now, db_index=True)
+
+    @classmethod
+    def get_key(cls, source, **options):
+        # Rows get new `$kuid`s whenever they are copied or imported, but the
+        # XML never includes them (see `AssetSnapshot._strip_kuids()`)
+        source = dict(source)
+        for sheet_name in ('survey', 'choices'):
+            if sheet_name in source:
+                source[sheet_name] = [
+                    {key: value for key, value in row.items()
+                     if key != '$kuid'}
+                    for row in source[sheet_name]
+                ]
+        _json_string = json.dumps({
+            'cache_version': cls.CACHE_VERSION,
+            'source': source,
+            'options': options,
+        }, sort_keys=True)
+        return hashlib.sha1(_json_string).hexdigest()
+
+    @classmethod
+    def get_xml(cls, key, generate):
+        '''
+        Returns the tuple `(xml, details)` stored under `key`, calling
+        `generate()` to obtain and store it if there is none
+        '''
+        now = timezone.now()
+        try:
+            entry = cls.objects.only('pk', 'xml', 'details',
+                                     'date_accessed').get(key=key)
+        except cls.DoesNotExist:
+            pass
+        else:
+            if entry.date_accessed < now - cls.ACCESS_DATE_RESOLUTION:
+                cls.objects.filter(pk=entry.pk).update(date_accessed=now)
+            return entry.xml, entry.details
+
+        xml, details = generate()
+        if not xml or details.get('status') == 'failure':
+            # Let the next request try again, e.g. after a pyxform upgrade
+            return xml, details
+        size = len(xml)
+        # Another process may have stored the same entry meanwhile
+        _, created = cls.objects.get_or_create(key=key, defaults={
+            'xml': xml,
+            'details': details,
+            'size': size,
+            'date_accessed': now,
+        })
+        max_size = settings.XFORM_CACHE_MAX_SIZE
+        if created and cls._add_to_total_size(size) > max_size:
+            cls.evict(max_size=max_size)
+        return xml, details
+
+    @classmethod
+    def _add_to_total_size(cls, size):
+        '''
+        Returns the running total size after adding `size`. It may exceed the
+        actual total, e.g. after `delete_xform_cache`, until `evict()`
+        corrects it
+        '''
+        try:
+            return cache.incr(cls.TOTAL_SIZE_CACHE_KEY, size)
+        except ValueError:
+            # Not in the cache yet, or evicted from it
+            total_size = cls._get_total_size()
+            cache.set(cls.TOTAL_SIZE_CACHE_KEY, total_size, None)
+            return total_size
+
+    @classmethod
+    def _get_total_size(cls):
+        return cls.objects.aggregate(
+            total_size=models.Sum('size'))['total_size'] or 0
+
+    @classmethod
+    def evict(cls, max_size):
+        '''
+        Deletes the least recently used entries if their total size exceeds
+        `max_size`
+        '''
+        total_size = cls._get_total_size()
+        if total_size > max_size:
+            excess_size = total_size - int(
+                max_size * cls.EVICTION_TARGET_RATIO)
+            pks_to_delete = []
+            entries = cls.objects.order_by('date_accessed', 'pk').values_list(
+                'pk', 'size')
+            for pk, size in entries.iterator():
+                if excess_size <= 0:
+                    break
+                pks_to_delete.append(pk)
+                excess_size -= size
+                total_size -= size
+            cls.objects.filter(pk__in=pks_to_delete).delete()
+        cache.set(cls.TOTAL_SIZE_CACHE_KEY, total_size, None)
@@ -2,6 +2,7 @@
 from __future__ import absolute_import, unicode_literals
 
 import json
+from xml.sax.saxutils import quoteattr
 
 from rest_framework import renderers
 from rest_framework_xml.renderers import XMLRenderer as DRFXMLRenderer
@@ -52,6 +53,13 @@ class SubmissionXMLRenderer(DRFXMLRenderer):
 
     def render(self, data, accepted_media_type=None, renderer_context=None):
         if renderer_context.get("view").action == "list":
+            if isinstance(data, dict):
+                # Keyset pagination. See `SubmissionViewSet.list()`
+                next_attribute = ""
+                if data.get("next"):
+                    next_attribute = " next={}".format(quoteattr(data["next"]))
+                return "<root{}>{}</root>".format(next_attribute,
+                                                  "".join(data["results"]))
             return "<root>{}</root>".format("".join(data))
         else:
             return data
@@ -16,6 +16,7 @@ from django.conf import settings
 from rest_framework import serializers, exceptions
 from rest_framework.pagination import LimitOffsetPagination, PageNumberPagination
 from rest_framework.reverse import reverse_lazy, reverse
+from rest_framework.utils.urls import replace_query_param
 from taggit.models import Tag
 
 from hub.models import SitewideMessage, ExtraUserDetail
@@ -36,6 +37,12 @@ from .models import OneTimeAuthenticationKey
 from .forms import USERNAME_REGEX, USERNAME_MAX_LENGTH
 from .forms import USERNAME_INVALID_MESSAGE
 from .utils.gravatar_url import gravatar_url
+from .utils.keyset_pagination import (
+    decode_cursor,
+    encode_cursor,
+    estimate_count,
+    get_keyset_page,
+)
 
 from .deployment_backends.kc_access.utils import get_kc_profile_data
 from .deployment_backends.kc_access.utils import set_kc_require_auth
@@ -50,6 +57,76 @@ class Paginated(LimitOffsetPagination):
         return reverse_lazy('api-root', request=self.context.get('request'))
 
 
+class KeysetPaginated(Paginated):
+    """
+    Same as `Paginated`, unless the request has a `cursor` parameter (empty
+    for the first page). Then, instead of skipping `offset` objects, the
+    `limit` objects following the position encoded in `cursor` are retrieved,
+    newest first (see `kpi.utils.keyset_pagination`), which takes as long for
+    the last page as for the first one. `next` links carry the cursor of the
+    following page; there is no `previous` link.
+    Set the `count` parameter to `false` to skip counting the objects (`count`
+    is then `null`), or to `estimate` to use the database's estimate
+    """
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor = request.query_params.get(self.cursor_query_param)
+        # Only known without an exact count
+        self.has_next = None
+        count = request.query_params.get(self.count_query_param, '').lower()
+        if self.cursor is None and count not in ('false', 'estimate'):
+            return super(KeysetPaginated, self).paginate_queryset(
+                queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        if count == 'false':
+            self.count = None
+        elif count == 'estimate':
+            self.count = estimate_count(queryset)
+        else:
+            self.count = queryset.count()
+
+        # Retrieve one more object to know whether there is a next page
+        if self.cursor is None:
+            self.offset = self.get_offset(request)
+            page = list(queryset[self.offset:self.offset + self.limit + 1])
+        else:
+            try:
+                position = decode_cursor(self.cursor)
+            except ValueError as e:
+                raise exceptions.ValidationError({
+                    self.cursor_query_param: e.message})
+            page = get_keyset_page(queryset, position, self.limit + 1)
+        self.has_next = len(page) > self.limit
+        page = page[:self.limit]
+        if self.has_next and self.cursor is not None:
+            self.next_cursor = encode_cursor(page[-1])
+        return page
+
+    def get_next_link(self):
+        if self.has_next is None:
+            return super(KeysetPaginated, self).get_next_link()
+        if not self.has_next:
+            return None
+        url = replace_query_param(self.request.build_absolute_uri(),
+                                  self.limit_query_param, self.limit)
+        if self.cursor is None:
+            return replace_query_param(url, self.offset_query_param,
+                                       self.offset + self.limit)
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.next_cursor)
+
+    def get_previous_link(self):
+        if self.cursor is not None:
+            return None
+        return super(KeysetPaginated, self).get_previous_link()
+
+
 class TinyPaginated(PageNumberPagination):
     """
     Same as Paginated with a small page size
@@ -511,7 +588,7 @@ class AssetSerializer(serializers.HyperlinkedModelSerializer):
     tag_string = serializers.CharField(required=False, allow_blank=True)
     version_id = serializers.CharField(read_only=True)
     version__content_hash = serializers.CharField(read_only=True)
-    has_deployment = serializers.ReadOnlyField()
+    has_deployment = serializers.SerializerMethodField()
     deployed_version_id = serializers.SerializerMethodField()
     deployed_versions = PaginatedApiField(
         serializer_class=AssetVersionListSerializer,
@@ -604,16 +681,33 @@ class AssetSerializer(serializers.HyperlinkedModelSerializer):
             # TODO: remove this restriction?
             fields['parent'].queryset = fields['parent'].queryset.filter(
                 owner=user)
-        # Honor requests to exclude fields
-        # TODO: Actually exclude fields from tha database query! DRF grabs
-        # all columns, even ones that are never named in `fields`
-        excludes = self.context['request'].GET.get('exclude', '')
-        for exclude in excludes.split(','):
-            exclude = exclude.strip()
-            if exclude in fields:
-                fields.pop(exclude)
+        # Honor requests to select or exclude fields. When listing assets,
+        # `Asset.optimize_queryset_for_list()` also leaves the others out of
+        # the database query
+        requested_fields = self.get_requested_fields(
+            self.context['request'], fields.keys())
+        if requested_fields is not None:
+            for field in set(fields).difference(requested_fields):
+                fields.pop(field)
         return fields
 
+    @staticmethod
+    def get_requested_fields(request, fields):
+        '''
+        Returns those of `fields` that are named in the comma-separated `fields`
+        query parameter, if any, and not in the `exclude` one, or `None` if
+        the request has neither
+        '''
+        only = request.GET.get('fields', '')
+        exclude = request.GET.get('exclude', '')
+        if not only and not exclude:
+            return None
+        only = set(field.strip() for field in only.split(',')) if only \
+            else None
+        exclude = set(field.strip() for field in exclude.split(','))
+        return [field for field in fields
+                if (only is None or field in only) and field not in exclude]
+
     def get_version_count(self, obj):
         return obj.asset_versions.count()
 
@@ -662,35 +756,21 @@ class AssetSerializer(serializers.HyperlinkedModelSerializer):
         return reverse('asset-koboform', args=(obj.uid,), request=self.context
                        .get('request', None))
 
+    # The deployment fields below read the columns that
+    # `Asset.sync_deployment_fields()` copies from `_deployment_data`, to
+    # avoid parsing the latter for each asset of a list
+    def get_has_deployment(self, obj):
+        return bool(obj.deployment_backend)
+
     def get_deployed_version_id(self, obj):
-        if not obj.has_deployment:
-            return
-        if isinstance(obj.deployment.version_id, int):
-            asset_versions_uids_only = obj.asset_versions.only('uid')
-            # this can be removed once the 'replace_deployment_ids'
-            # migration has been run
-            v_id = obj.deployment.version_id
-            try:
-                return asset_versions_uids_only.get(
-                    _reversion_version_id=v_id
-                ).uid
-            except AssetVersion.DoesNotExist:
-                deployed_version = asset_versions_uids_only.filter(
-                    deployed=True
-                ).first()
-                if deployed_version:
-                    return deployed_version.uid
-                else:
-                    return None
-        else:
-            return obj.deployment.version_id
+        return obj.deployed_version_uid or None
 
     def get_deployment__identifier(self, obj):
-        if obj.has_deployment:
-            return obj.deployment.identifier
+        if obj.deployment_backend:
+            return obj.deployment_identifier or None
 
     def get_deployment__active(self, obj):
-        return obj.has_deployment and obj.deployment.active
+        return bool(obj.deployment_backend) and obj.deployment_active
 
     def get_deployment__links(self, obj):
         if obj.has_deployment and obj.deployment.active:
@@ -1086,7 +1166,8 @@ class CollectionSerializer(serializers.HyperlinkedModelSerializer):
         source='*',
         source_processor=lambda source: CollectionChildrenQuerySet(
             source
-        ).optimize_for_list()
+        ).optimize_for_list(),
+        paginator_class=KeysetPaginated,
     )
     permissions = ObjectPermissionSerializer(many=True, read_only=True)
     downloads = serializers.SerializerMethodField()
@@ -3,11 +3,17 @@ from celery import shared_task
 from django.core.management import call_command
 from django.conf import settings
 from .models import ImportTask, ExportTask
+from .haystack_utils import process_search_index_queue_from_task
+from kobo.apps.reports.report_data import update_report_aggregate_from_task
 
 @shared_task
 def update_search_index():
     call_command('update_index', using=['default',], remove=True)
 
+@shared_task
+def update_search_index_from_queue():
+    process_search_index_queue_from_task()
+
 @shared_task
 def import_in_background(import_task_uid):
     import_task = ImportTask.objects.get(uid=import_task_uid)
@@ -18,6 +24,17 @@ def export_in_background(export_task_uid):
     export_task = ExportTask.objects.get(uid=export_task_uid)
     export_task.run()
 
+@shared_task
+def export_shard_in_background(export_task_uid, shard_index):
+    export_task = ExportTask.objects.get(uid=export_task_uid)
+    export_task.run_shard(shard_index)
+
+@shared_task
+def update_report_aggregate_in_background(asset_uid, split_by='',
+                                          rebuild=False, field_group=None):
+    update_report_aggregate_from_task(asset_uid, split_by, rebuild,
+                                      field_group)
+
 @shared_task
 def sync_kobocat_xforms(username=None, quiet=True):
     call_command('sync_kobocat_xforms', username=username, quiet=quiet)
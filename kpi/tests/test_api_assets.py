@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import copy
-from hashlib import md5
 import json
+import mock
 import requests
 import StringIO
+import time
 
 from django.conf import settings
 from django.contrib.auth import get_user
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from lxml import etree
 from rest_framework import status
 from rest_framework.test import APITestCase
@@ -19,14 +24,33 @@ from kpi.models import Asset
 from kpi.models import AssetFile
 from kpi.models import AssetVersion
 from kpi.models import Collection
+from kpi.models import EffectivePermission
 from kpi.models import ExportTask
+from kpi.models.object_permission import get_objects_for_user
 from kpi.serializers import AssetListSerializer
+from kpi.utils.keyset_pagination import encode_cursor, filter_after
 from .kpi_test_case import KpiTestCase
 from formpack.utils.expand_content import SCHEMA_VERSION
 
 EMPTY_SURVEY = {'survey': [], 'schema': SCHEMA_VERSION, 'settings': {}}
 
 
+def get_repeated_permission_queries(captured_queries):
+    """
+    Return the queries retrieving the effective permissions of an object, or
+    the anonymous user, which were run more than once
+    """
+    anonymous_user_condition = '"auth_user"."id" = {}'.format(
+        settings.ANONYMOUS_USER_ID)
+    permission_queries = [
+        query['sql'] for query in captured_queries
+        if '"kpi_effectivepermission"."object_id" =' in query['sql']
+        or anonymous_user_condition in query['sql']
+    ]
+    return [sql for sql in set(permission_queries)
+            if permission_queries.count(sql) > 1]
+
+
 class AssetsListApiTests(APITestCase):
     fixtures = ['test_data']
 
@@ -82,28 +106,270 @@ class AssetsListApiTests(APITestCase):
         self.assertIsNotNone(list_result_detail)
         self.assertDictEqual(expected_list_data, dict(list_result_detail))
 
+    def test_asset_list_retrieves_permissions_once(self):
+        self.test_create_asset()
+        self.test_create_asset()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.list_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual(
+            get_repeated_permission_queries(context.captured_queries), [])
+
+    def _get_hash_response(self, etag=None):
+        hash_url = reverse("asset-hash-list")
+        if etag is None:
+            return self.client.get(hash_url)
+        return self.client.get(hash_url, HTTP_IF_NONE_MATCH=etag)
+
+    def _assert_hash_changed(self, etag):
+        response = self._get_hash_response(etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual('"{}"'.format(response.data["hash"]), etag)
+        self.assertEqual(response["ETag"],
+                         '"{}"'.format(response.data["hash"]))
+        return response["ETag"]
+
+    def _assert_hash_unchanged(self, etag):
+        response = self._get_hash_response(etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
     def test_assets_hash(self):
+        someuser = User.objects.get(username="someuser")
         another_user = User.objects.get(username="anotheruser")
-        user_asset = Asset.objects.first()
+        user_asset = Asset.objects.create(
+            owner=someuser, content={'survey': []}, asset_type='survey')
+
+        self.client.logout()
+        self.client.login(username="anotheruser", password="anotheruser")
+        response = self._get_hash_response()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response["ETag"]
+        self._assert_hash_unchanged(etag)
+
+        # Saving an asset the user cannot view changes nothing
+        user_asset.save()
+        self._assert_hash_unchanged(etag)
+
+        user_asset.assign_perm(another_user, "view_asset")
+        etag = self._assert_hash_changed(etag)
+        self._assert_hash_unchanged(etag)
+
+        user_asset.content = {'survey': [
+            {'type': 'text', 'label': 'Question 1', 'name': 'q1'},
+        ]}
         user_asset.save()
+        etag = self._assert_hash_changed(etag)
+
+        creation_response = self.test_create_asset()
+        etag = self._assert_hash_changed(etag)
+
+        user_asset.remove_perm(another_user, "view_asset")
+        etag = self._assert_hash_changed(etag)
+
+        self.client.delete(creation_response.data['url'])
+        etag = self._assert_hash_changed(etag)
+
+    def test_assets_hash_after_rebuilding_effective_permissions(self):
+        someuser = User.objects.get(username="someuser")
+        another_user = User.objects.get(username="anotheruser")
+        user_asset = Asset.objects.create(
+            owner=someuser, content={'survey': []}, asset_type='survey')
         user_asset.assign_perm(another_user, "view_asset")
+        EffectivePermission.objects.filter_for_object(
+            user_asset, user=another_user).delete()
 
         self.client.logout()
         self.client.login(username="anotheruser", password="anotheruser")
-        creation_response = self.test_create_asset()
+        etag = self._get_hash_response()["ETag"]
+        call_command("rebuild_effective_permissions", stdout=StringIO.StringIO())
+        etag = self._assert_hash_changed(etag)
+        call_command("rebuild_effective_permissions", stdout=StringIO.StringIO())
+        self._assert_hash_unchanged(etag)
+
+    def test_assets_hash_uses_few_queries(self):
+        for _ in xrange(3):
+            self.test_create_asset()
+        # The first request creates the counter
+        self._get_hash_response()
+        with CaptureQueriesContext(connection) as context:
+            self._get_hash_response()
+        few_assets_query_count = len(context.captured_queries)
+
+        for _ in xrange(10):
+            self.test_create_asset()
+        with CaptureQueriesContext(connection) as context:
+            self._get_hash_response()
+        self.assertEqual(len(context.captured_queries),
+                         few_assets_query_count)
+
+
+class LargeAssetListApiTestCase(APITestCase):
+    fixtures = ['test_data']
+    ASSET_COUNT = 1000
+
+    def setUp(self):
+        self.client.login(username='someuser', password='someuser')
+        self.list_url = reverse('asset-list')
+        someuser = User.objects.get(username='someuser')
+        Asset.objects.bulk_create([
+            Asset(name='asset {}'.format(index), owner=someuser,
+                  content=EMPTY_SURVEY, asset_type='survey')
+            for index in xrange(self.ASSET_COUNT)
+        ])
+        # Creating assets in bulk skips assigning their owner's permissions
+        content_type = ContentType.objects.get_for_model(Asset)
+        permission = Permission.objects.get(
+            content_type=content_type, codename='view_asset')
+        EffectivePermission.objects.bulk_create([
+            EffectivePermission(
+                user=someuser,
+                permission=permission,
+                codename=permission.codename,
+                object_id=asset_id,
+                content_type=content_type,
+            ) for asset_id in someuser.assets.values_list('pk', flat=True)
+        ])
 
-        another_user_asset = another_user.assets.last()
-        another_user_asset.save()
+    def _get_list(self, **params):
+        params.setdefault('limit', self.ASSET_COUNT)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.list_url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), params['limit'])
+        return response, [query['sql'] for query in context.captured_queries]
 
-        versions_ids = [
-            user_asset.version_id,
-            another_user_asset.version_id
+    @staticmethod
+    def _get_queries_on(table, queries):
+        return [sql for sql in queries if '"{}"'.format(table) in sql]
+
+
+class AssetsListFieldsApiTests(LargeAssetListApiTestCase):
+
+    def test_list_with_selected_fields(self):
+        full_response, full_queries = self._get_list()
+        response, queries = self._get_list(fields='uid,name,asset_type')
+        for result in response.data['results']:
+            self.assertEqual(set(result), set(['uid', 'name', 'asset_type']))
+
+        # Neither query grows with the number of assets
+        self.assertLess(len(full_queries), 20)
+        self.assertLess(len(queries), len(full_queries))
+        for table in ('kpi_objectpermission', 'kpi_assetversion',
+                      'taggit_tag'):
+            self.assertNotEqual(self._get_queries_on(table, full_queries), [])
+            self.assertEqual(self._get_queries_on(table, queries), [])
+        asset_queries = [
+            sql for sql in self._get_queries_on('kpi_asset', queries)
+            if 'COUNT(' not in sql and '"kpi_asset"."name"' in sql
         ]
-        versions_ids.sort()
-        expected_hash = md5("".join(versions_ids)).hexdigest()
-        hash_url = reverse("asset-hash-list")
-        hash_response = self.client.get(hash_url)
-        self.assertEqual(hash_response.data.get("hash"), expected_hash)
+        self.assertEqual(len(asset_queries), 1)
+        for column in ('content', 'summary', 'settings', '_deployment_data'):
+            self.assertNotIn('"kpi_asset"."{}"'.format(column),
+                             asset_queries[0])
+
+        self.assertLess(len(response.content), len(full_response.content) / 4)
+
+    def test_list_with_excluded_fields(self):
+        full_response, full_queries = self._get_list()
+        response, queries = self._get_list(exclude='permissions,tag_string')
+        expected_fields = set(AssetListSerializer.Meta.fields).difference(
+            ['permissions', 'tag_string'])
+        for result in response.data['results']:
+            self.assertEqual(set(result), expected_fields)
+        self.assertEqual(
+            self._get_queries_on('kpi_objectpermission', queries), [])
+        self.assertEqual(self._get_queries_on('taggit_tag', queries), [])
+        self.assertLess(len(queries), len(full_queries))
+        self.assertLess(len(response.content), len(full_response.content))
+
+    def test_list_with_selected_fields_matches_full_list(self):
+        full_response, _ = self._get_list()
+        response, _ = self._get_list(
+            fields='uid,url,owner__username,version_id,deployment__active',
+            exclude='url',
+        )
+        # The assets were modified at the same time, so their order may differ
+        expected_results = {
+            result['uid']: {
+                'uid': result['uid'],
+                'owner__username': result['owner__username'],
+                'version_id': result['version_id'],
+                'deployment__active': result['deployment__active'],
+            } for result in full_response.data['results']
+        }
+        self.assertDictEqual(
+            {result['uid']: dict(result)
+             for result in response.data['results']},
+            expected_results
+        )
+
+
+class AssetsListKeysetPaginationApiTests(LargeAssetListApiTestCase):
+
+    def _get_visible_assets(self):
+        someuser = User.objects.get(username='someuser')
+        return list(filter_after(
+            get_objects_for_user(someuser, 'view_asset', Asset), None))
+
+    def test_list_all_pages_with_cursor(self):
+        response, _ = self._get_list(cursor='', limit=100)
+        self.assertIsNone(response.data['previous'])
+        uids = []
+        while True:
+            uids.extend(result['uid'] for result in response.data['results'])
+            if response.data['next'] is None:
+                break
+            self.assertIn('cursor=', response.data['next'])
+            response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # Every asset is listed once, newest first
+        self.assertListEqual(
+            uids, [asset.uid for asset in self._get_visible_assets()])
+        self.assertEqual(len(uids), response.data['count'])
+
+    def test_last_page_costs_as_much_as_first_page(self):
+        assets = self._get_visible_assets()
+        # With 2 assets per page, page 500 follows the 998th asset
+        last_page_position = assets[997]
+        first_response, first_queries = self._get_list(
+            cursor='', limit=2, count='false')
+        response, queries = self._get_list(
+            cursor=encode_cursor(last_page_position), limit=2, count='false')
+        self.assertListEqual(
+            [result['uid'] for result in first_response.data['results']],
+            [asset.uid for asset in assets[:2]]
+        )
+        self.assertListEqual(
+            [result['uid'] for result in response.data['results']],
+            [asset.uid for asset in assets[998:1000]]
+        )
+        self.assertEqual(len(queries), len(first_queries))
+        for sql in self._get_queries_on('kpi_asset', queries):
+            self.assertNotIn('OFFSET', sql)
+            self.assertNotIn('COUNT(', sql)
+
+    def test_list_without_count(self):
+        response, queries = self._get_list(limit=10, count='false')
+        self.assertIsNone(response.data['count'])
+        self.assertIn('offset=10', response.data['next'])
+        self.assertEqual(
+            [sql for sql in self._get_queries_on('kpi_asset', queries)
+             if 'COUNT(' in sql],
+            []
+        )
+
+    def test_list_with_estimated_count(self):
+        response, _ = self._get_list(limit=10, count='estimate')
+        self.assertIsInstance(response.data['count'], (int, long))
+        response, _ = self._get_list(limit=10)
+        self.assertEqual(response.data['count'],
+                         len(self._get_visible_assets()))
+
+    def test_list_with_invalid_cursor(self):
+        response = self.client.get(self.list_url, {'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('cursor', response.data)
 
 
 class AssetVersionApiTests(APITestCase):
@@ -168,6 +434,59 @@ class AssetsDetailApiTests(APITestCase):
         resp = self.client.get(self.asset_url, format='json')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_asset_detail_retrieves_permissions_once(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.asset_url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual(
+            get_repeated_permission_queries(context.captured_queries), [])
+
+        self.client.logout()
+        self.asset.assign_perm(AnonymousUser(), 'view_asset')
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.asset_url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertListEqual(
+            get_repeated_permission_queries(context.captured_queries), [])
+
+    def _time_patch(self, data):
+        with CaptureQueriesContext(connection) as context:
+            start = time.time()
+            response = self.client.patch(self.asset_url, data=data,
+                                         format='json')
+            elapsed = time.time() - start
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return elapsed, len(context.captured_queries)
+
+    def test_metadata_only_patch_skips_content_processing(self):
+        content = {'survey': [
+            {'type': 'text', 'name': 'q{}'.format(i),
+             'label': 'Question {}'.format(i)} for i in range(300)
+        ]}
+        content_elapsed, content_query_count = self._time_patch(
+            {'content': json.dumps(content)})
+        version_count = self.asset.asset_versions.count()
+
+        with mock.patch.object(
+            Asset, 'adjust_content_on_save'
+        ) as patched_adjust_content_on_save, mock.patch.object(
+            Asset, '_populate_summary'
+        ) as patched_populate_summary, mock.patch.object(
+            Asset, '_recalculate_inherited_perms'
+        ) as patched_recalculate_inherited_perms:
+            metadata_elapsed, metadata_query_count = self._time_patch(
+                {'tag_string': 'some,tags'})
+        patched_adjust_content_on_save.assert_not_called()
+        patched_populate_summary.assert_not_called()
+        patched_recalculate_inherited_perms.assert_not_called()
+        self.assertEqual(self.asset.asset_versions.count(), version_count)
+        self.assertLess(metadata_query_count, content_query_count)
+        self.assertLess(metadata_elapsed, content_elapsed)
+
+        asset = Asset.objects.get(pk=self.asset.pk)
+        self.assertEqual(asset.tag_string, 'some,tags')
+        self.assertEqual(asset.summary['row_count'], 300)
+
     def test_can_update_asset_settings(self):
         data = {
             'settings': json.dumps({
@@ -554,6 +873,20 @@ class AssetExportTaskTest(APITestCase):
         self.assertEqual(result_content, expected_content)
         return detail_response
 
+    def test_export_shard_count_must_be_in_range(self):
+        post_url = reverse('exporttask-list')
+        asset_url = reverse('asset-detail', args=[self.asset.uid])
+        for shard_count in ('0', 'two', str(settings.EXPORT_MAX_SHARDS + 1)):
+            response = self.client.post(post_url, {
+                'source': asset_url,
+                'type': 'csv',
+                'shard_count': shard_count,
+            })
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            self.assertIn('shard_count', response.data)
+        self.assertFalse(ExportTask.objects.exists())
+
     def test_other_user_cannot_access_export(self):
         detail_response = self.test_owner_can_create_export()
         self.client.logout()
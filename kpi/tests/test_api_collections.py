@@ -5,7 +5,9 @@ from django.core.urlresolvers import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from ..models.asset import Asset
 from ..models.collection import Collection
+from ..utils.keyset_pagination import filter_after
 
 class CollectionsTests(APITestCase):
     fixtures = ['test_data']
@@ -60,3 +62,32 @@ class CollectionsTests(APITestCase):
                 uid_found= True
                 break
         self.assertTrue(uid_found)
+
+    def test_collection_children_with_cursor(self):
+        user = User.objects.get(username='someuser')
+        for index in range(3):
+            Collection.objects.create(
+                name='child collection {}'.format(index), owner=user,
+                parent=self.coll)
+            Asset.objects.create(
+                name='child asset {}'.format(index), owner=user,
+                parent=self.coll, content={'survey': []})
+        # Collections first, then assets, each newest first
+        expected_uids = [
+            child.uid for child in
+            list(filter_after(self.coll.get_children(), None)) +
+            list(filter_after(self.coll.assets.all(), None))
+        ]
+        url = reverse('collection-detail', kwargs={'uid': self.coll.uid})
+        response = self.client.get(url, {'cursor': '', 'limit': 2})
+        uids = []
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            children = response.data['children']
+            self.assertEqual(children['count'], 6)
+            self.assertLessEqual(len(children['results']), 2)
+            uids.extend(child['uid'] for child in children['results'])
+            if children['next'] is None:
+                break
+            response = self.client.get(children['next'])
+        self.assertListEqual(uids, expected_uids)
@@ -140,6 +140,84 @@ class SubmissionApiTests(BaseTestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.asset.remove_perm(anonymous_user, 'view_submissions')
 
+    def test_list_submissions_with_cursor(self):
+        submissions = []
+        for index in range(5):
+            submissions.append({
+                "_id": index + 1,
+                "id": index + 1,
+                "q1": "a{}".format(5 - index),
+            })
+        self.asset.deployment.mock_submissions(submissions)
+
+        # Offset pagination remains the default
+        response = self.client.get(self.submission_url, {"format": "json"})
+        self.assertEqual(response.data, submissions)
+
+        def retrieve_all(params):
+            retrieved = []
+            response = self.client.get(self.submission_url, params)
+            while True:
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertLessEqual(len(response.data["results"]),
+                                     params["limit"])
+                retrieved.extend(response.data["results"])
+                if response.data["next"] is None:
+                    return retrieved
+                response = self.client.get(response.data["next"])
+
+        retrieved = retrieve_all({"format": "json", "cursor": "", "limit": 2})
+        self.assertEqual(retrieved, submissions)
+
+        # Sorting on another field, `_id` breaks ties
+        retrieved = retrieve_all({"format": "json", "cursor": "", "limit": 3,
+                                  "sort": json.dumps({"q1": 1})})
+        self.assertEqual(retrieved, list(reversed(submissions)))
+
+        retrieved = retrieve_all({"format": "json", "cursor": "", "limit": 2,
+                                  "sort": json.dumps({"_id": -1})})
+        self.assertEqual(retrieved, list(reversed(submissions)))
+
+    def test_list_submissions_with_cursor_and_missing_values(self):
+        # Missing and `None` values sort first
+        submissions = [
+            {"_id": 1, "id": 1, "q1": "a2"},
+            {"_id": 2, "id": 2},
+            {"_id": 3, "id": 3, "q1": "a1"},
+            {"_id": 4, "id": 4, "q1": None},
+            {"_id": 5, "id": 5},
+        ]
+        self.asset.deployment.mock_submissions(submissions)
+        expected_ids = [2, 4, 5, 3, 1]
+
+        for sort_dir in (1, -1):
+            retrieved_ids = []
+            params = {"format": "json", "cursor": "", "limit": 2,
+                      "sort": json.dumps({"q1": sort_dir})}
+            response = self.client.get(self.submission_url, params)
+            while True:
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                retrieved_ids.extend(submission["_id"]
+                                     for submission in response.data["results"])
+                if response.data["next"] is None:
+                    break
+                response = self.client.get(response.data["next"])
+            self.assertEqual(retrieved_ids, expected_ids[::sort_dir])
+
+    def test_list_submissions_streamed(self):
+        response = self.client.get(self.submission_url,
+                                   {"format": "json", "stream": "true"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/json")
+        content = "".join(response.streaming_content)
+        self.assertEqual(json.loads(content), self.submissions)
+
+        response = self.client.get(self.submission_url,
+                                   {"format": "json", "stream": "true",
+                                    "cursor": ""})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_retrieve_submission_owner(self):
         submission = self.submissions[0]
         url = self.asset.deployment.get_submission_detail_url(submission.get("id"))
@@ -1,11 +1,14 @@
 import json
+import mock
 
 from django.contrib.auth.models import User
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from .test_api_asset_snapshots import TestAssetSnapshotList
 from ..models import Asset
 from ..models import AssetSnapshot
+from ..models import XFormCache
 
 
 class AssetSnapshotsTestCase(TestCase):
@@ -53,3 +56,54 @@ class CreateAssetSnapshots(AssetSnapshotsTestCase):
         asset = Asset.objects.create(asset_type='survey', content=content)
         _snapshot = asset.snapshot
         self.assertEqual(_snapshot.source.get('settings')['form_title'], 'no_title_asset')
+
+    def test_xml_is_generated_once_per_source(self):
+        with mock.patch.object(
+            AssetSnapshot, 'generate_xml_from_source', autospec=True,
+            side_effect=AssetSnapshot.generate_xml_from_source
+        ) as patched_generate_xml_from_source:
+            snapshot = AssetSnapshot.objects.create(asset=self.asset)
+            self.assertEqual(patched_generate_xml_from_source.call_count, 0)
+            self.assertEqual(snapshot.xml, self.asset_snapshot.xml)
+            self.assertEqual(snapshot.details, self.asset_snapshot.details)
+
+            self.asset.content['survey'][0]['label'] = 'Question 1 changed'
+            self.asset.save()
+            snapshot = AssetSnapshot.objects.create(asset=self.asset)
+            self.assertEqual(patched_generate_xml_from_source.call_count, 1)
+            self.assertIn('Question 1 changed', snapshot.xml)
+        self.assertEqual(XFormCache.objects.count(), 2)
+
+    def test_xml_cache_key_ignores_kuids(self):
+        content = json.loads(json.dumps(self.asset.content))
+        for row in content['survey']:
+            row['$kuid'] = row['$kuid'][::-1]
+        snapshot = AssetSnapshot.objects.create(source=content)
+        self.assertEqual(XFormCache.objects.count(), 1)
+        self.assertEqual(snapshot.xml, self.asset_snapshot.xml)
+
+    def test_failed_xml_generation_is_not_cached(self):
+        failure = ('', {'status': 'failure', 'error': 'Invalid form'})
+        generate = mock.Mock(return_value=failure)
+        for _ in range(2):
+            self.assertEqual(XFormCache.get_xml('failing', generate), failure)
+        self.assertEqual(generate.call_count, 2)
+        self.assertFalse(XFormCache.objects.filter(key='failing').exists())
+
+    def test_xml_cache_is_not_summed_on_each_miss(self):
+        with mock.patch.object(XFormCache, 'evict') as patched_evict:
+            for index in range(3):
+                XFormCache.get_xml(
+                    'key {}'.format(index),
+                    lambda: ('<xml/>', {'status': 'success'})
+                )
+        self.assertEqual(patched_evict.call_count, 0)
+
+    def test_least_recently_used_xml_is_evicted(self):
+        first_entry = XFormCache.objects.get()
+        with override_settings(XFORM_CACHE_MAX_SIZE=first_entry.size * 3 / 2):
+            self.asset.content['survey'][0]['label'] = 'Question 3'
+            self.asset.save()
+            AssetSnapshot.objects.create(asset=self.asset)
+        self.assertFalse(XFormCache.objects.filter(pk=first_entry.pk).exists())
+        self.assertEqual(XFormCache.objects.count(), 1)
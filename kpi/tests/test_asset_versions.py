@@ -1,5 +1,6 @@
 import json
 import hashlib
+import mock
 import unittest
 from django.contrib.auth.models import User
 from django.test import TestCase
@@ -9,6 +10,9 @@ from formpack.utils.expand_content import SCHEMA_VERSION
 
 from ..models import Asset
 from ..models import AssetVersion
+from ..models.asset_version import AssetVersionContent
+from kpi.management.commands.compact_asset_versions import \
+    compact_asset_versions
 from kpi.exceptions import BadAssetTypeException
 
 
@@ -76,6 +80,11 @@ class AssetVersionTestCase(TestCase):
         self.template_asset = Asset.objects.create(asset_type='template')
         self.assertEqual(self.template_asset.asset_versions.count(), 1)
         self.assertEqual(self.template_asset.latest_version.deployed, False)
+        # Saving unchanged content does not create a version
+        self.template_asset.save()
+        self.assertEqual(self.template_asset.asset_versions.count(), 1)
+        self.template_asset.content['survey'].append(
+            {'type': 'note', 'label': 'Read me', 'name': 'n1'})
         self.template_asset.save()
         self.assertEqual(self.template_asset.asset_versions.count(), 2)
         self.assertEqual(self.template_asset.latest_version.deployed, False)
@@ -105,3 +114,90 @@ class AssetVersionTestCase(TestCase):
         new_asset.settings['description'] = 'Loco el que lee'
         new_asset.save()
         self.assertEqual(new_asset.latest_version.content_hash, expected_hash)
+
+    def test_version_content_is_stored_once(self):
+        new_asset = Asset.objects.create(asset_type='survey', content={
+            'survey': [{'type': 'note', 'label': 'Read me', 'name': 'n1'}]
+        })
+        content_count = AssetVersionContent.objects.count()
+        new_asset.name = 'Renamed'
+        new_asset.save()
+        self.assertEqual(new_asset.asset_versions.count(), 2)
+        self.assertEqual(AssetVersionContent.objects.count(), content_count)
+        self.assertEqual(
+            len(set(new_asset.asset_versions.values_list('content_blob',
+                                                         flat=True))),
+            1
+        )
+
+    def test_version_content_is_stored_as_delta(self):
+        new_asset = Asset.objects.create(asset_type='survey', content={
+            'survey': [{'type': 'note', 'label': 'Read me %d' % i,
+                        'name': 'n%d' % i} for i in range(20)]
+        })
+        keyframe = new_asset.latest_version.content_blob
+        self.assertIsNone(keyframe.keyframe)
+        new_asset.content['survey'].insert(10, {'type': 'note',
+                                                'label': 'Read me too',
+                                                'name': 'n_too'})
+        new_asset.save()
+        expected_content = deepcopy(new_asset.content)
+
+        # Bypass the cache of serialized contents
+        AssetVersionContent._serialized_cache.clear()
+        latest_version = AssetVersion.objects.get(
+            uid=new_asset.latest_version.uid)
+        blob = latest_version.content_blob
+        self.assertEqual(blob.keyframe, keyframe)
+        self.assertEqual(blob.sequence, 1)
+        self.assertIsNone(blob.content)
+        self.assertEqual(latest_version.version_content, expected_content)
+        self.assertEqual(latest_version.content_hash, hashlib.sha1(
+            json.dumps(expected_content, sort_keys=True)).hexdigest())
+
+    def test_compact_asset_versions(self):
+        new_asset = Asset.objects.create(asset_type='survey', content={
+            'survey': [{'type': 'note', 'label': 'Read me', 'name': 'n1'}]
+        })
+        # Versions created by `bulk_create()` keep their content inline
+        legacy_content = {'survey': [{'type': 'note', 'name': 'legacy'}]}
+        AssetVersion.objects.bulk_create([AssetVersion(
+            asset=new_asset, version_content=legacy_content)])
+        legacy_version = AssetVersion.objects.get(content_blob=None)
+        self.assertEqual(legacy_version.version_content, legacy_content)
+
+        # An unused content
+        AssetVersionContent.objects.create(content_hash='0' * 40,
+                                           content={})
+        self.assertEqual(compact_asset_versions(), (1, 1))
+        legacy_version = AssetVersion.objects.get(pk=legacy_version.pk)
+        self.assertIsNone(legacy_version._version_content)
+        self.assertEqual(legacy_version.version_content, legacy_content)
+        self.assertFalse(
+            AssetVersionContent.objects.filter(content_hash='0' * 40).exists())
+
+    def test_unchanged_content_is_not_processed_again(self):
+        new_asset = Asset.objects.create(asset_type='survey', content={
+            'survey': [{'type': 'note', 'label': 'Read me', 'name': 'n1'}]
+        })
+        new_asset = Asset.objects.get(pk=new_asset.pk)
+        version_uid = new_asset.latest_version.uid
+        with mock.patch.object(
+            Asset, 'adjust_content_on_save'
+        ) as patched_adjust_content_on_save:
+            new_asset.settings['description'] = 'Loco el que lee'
+            new_asset.save()
+            patched_adjust_content_on_save.assert_not_called()
+            self.assertEqual(new_asset.latest_version.uid, version_uid)
+
+            # A rename is recorded in a new version, but the content is not
+            # processed again
+            new_asset.name = 'Renamed'
+            new_asset.save()
+            patched_adjust_content_on_save.assert_not_called()
+            self.assertNotEqual(new_asset.latest_version.uid, version_uid)
+            self.assertEqual(new_asset.latest_version.name, 'Renamed')
+
+            new_asset.content['survey'][0]['label'] = ['Read me again']
+            new_asset.save()
+            patched_adjust_content_on_save.assert_called_once_with()
@@ -6,12 +6,16 @@ import json
 from collections import OrderedDict
 from copy import deepcopy
 
+import mock
 import xlrd
+import xlwt
 from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from kpi.models import Asset
+from kpi.models import asset as asset_module
 from kpi.models import Collection
 from kpi.models.object_permission import get_all_objects_for_user
 
@@ -307,6 +311,26 @@ class AssetContentTests(AssetsTestCase):
         self.assertEqual(_c['settings'][0]['asdf'], 'jkl')
         self.assertEqual(_c['survey'][-1]['type'], 'note')
 
+    def test_ordered_xlsform_content_is_cached(self):
+        asset_module._ordered_xlsform_content_cache.clear()
+        with mock.patch.object(
+            Asset, '_build_ordered_xlsform_content', autospec=True,
+            side_effect=Asset._build_ordered_xlsform_content
+        ) as build:
+            _c1 = self.asset.ordered_xlsform_content()
+            # Modifying the result must not affect later calls
+            _c1['survey'][0]['name'] = 'modified'
+            _c2 = self.asset.ordered_xlsform_content()
+            self.assertEqual(build.call_count, 1)
+            self.assertEqual(_c2['survey'][0]['name'], 'q1')
+            # Other options and other content are processed separately
+            self.asset.ordered_xlsform_content(kobo_specific_types=True)
+            self.assertEqual(build.call_count, 2)
+            self.asset.content['survey'][0]['name'] = 'renamed'
+            _c3 = self.asset.ordered_xlsform_content()
+            self.assertEqual(build.call_count, 3)
+            self.assertEqual(_c3['survey'][0]['name'], 'renamed')
+
     def test_to_xls_io_versioned_appended(self):
         append = {
             'survey': [
@@ -348,6 +372,36 @@ class AssetContentTests(AssetsTestCase):
         ]
         self.assertEqual(xls_asdf_col, ['asdf', 'jkl'])
 
+    def test_to_xls_io_many_rows(self):
+        # More rows than `XLS_ROWS_FLUSH_INTERVAL`, with a column that only
+        # appears in the last one
+        survey = [{'type': 'text', 'name': 'q{}'.format(i),
+                   'label': ['Question {}'.format(i)]} for i in xrange(2000)]
+        survey[-1]['hint'] = ['Last']
+        self.asset.content = {'survey': survey}
+        self.asset.adjust_content_on_save()
+        with mock.patch.object(
+                xlwt.Worksheet, 'flush_row_data', autospec=True,
+                side_effect=xlwt.Worksheet.flush_row_data
+        ) as patched_flush_row_data:
+            xls_io = self.asset.to_xls_io()
+        # Rows were flushed while the survey sheet was written
+        self.assertTrue(any(
+            call[0][0].name == 'survey'
+            for call in patched_flush_row_data.call_args_list
+        ))
+        workbook = xlrd.open_workbook(file_contents=xls_io.read())
+
+        survey_sheet = workbook.sheet_by_name('survey')
+        self.assertEqual(survey_sheet.nrows, 2001)
+        headers = survey_sheet.row_values(0)
+        name_col = headers.index('name')
+        hint_col = headers.index('hint')
+        self.assertEqual(survey_sheet.cell_value(1, name_col), 'q0')
+        self.assertEqual(survey_sheet.cell_value(2000, name_col), 'q1999')
+        self.assertEqual(survey_sheet.cell_value(2000, hint_col), 'Last')
+        self.assertEqual(survey_sheet.cell_value(1999, hint_col), '')
+
 
 class AssetSettingsTests(AssetsTestCase):
     def _content(self, form_title='some form title'):
@@ -434,6 +488,78 @@ class AssetSettingsTests(AssetsTestCase):
         self.assertEqual(a1.name, 'abcxyz')
 
 
+class AssetListSubmissionCountsTestCase(AssetsTestCase):
+
+    def setUp(self):
+        super(AssetListSubmissionCountsTestCase, self).setUp()
+        cache.clear()
+        self.assets = [self.asset] + [
+            Asset.objects.create(content=self.asset.content,
+                                 owner=self.user, asset_type='survey')
+            for _ in xrange(2)
+        ]
+        for index, asset in enumerate(self.assets):
+            Asset.objects.filter(pk=asset.pk).update(_deployment_data={
+                'backend': 'kobocat',
+                'active': True,
+                'backend_response': {'id_string': 'form_{}'.format(index)},
+            })
+        # No xform for the last asset
+        self.stats = {
+            (self.user.pk, 'form_0'): (3, None),
+            (self.user.pk, 'form_1'): (5, None),
+        }
+
+    def _get_submission_counts(self):
+        queryset = Asset.optimize_queryset_for_list(
+            Asset.objects.filter(pk__in=[a.pk for a in self.assets]))
+        return {asset.uid: asset.deployment.submission_count
+                for asset in queryset}
+
+    def test_submission_counts_are_retrieved_at_once(self):
+        with mock.patch(
+                'kpi.deployment_backends.kobocat_backend.'
+                'instance_counts_and_last_submission_times',
+                return_value=self.stats) as mock_stats, \
+            mock.patch(
+                'kpi.deployment_backends.kobocat_backend.instance_count'
+                ) as mock_instance_count:
+            counts = self._get_submission_counts()
+        self.assertEqual(mock_stats.call_count, 1)
+        self.assertEqual(mock_stats.call_args[0][0],
+                         set(self.stats) | {(self.user.pk, 'form_2')})
+        self.assertFalse(mock_instance_count.called)
+        self.assertEqual(counts, {
+            self.assets[0].uid: 3,
+            self.assets[1].uid: 5,
+            self.assets[2].uid: 0,
+        })
+
+    def test_submission_counts_are_cached(self):
+        with mock.patch(
+                'kpi.deployment_backends.kobocat_backend.'
+                'instance_counts_and_last_submission_times',
+                return_value=self.stats) as mock_stats:
+            self._get_submission_counts()
+            counts = self._get_submission_counts()
+        # Only the missing xform is looked up again
+        self.assertEqual(mock_stats.call_count, 2)
+        self.assertEqual(mock_stats.call_args[0][0],
+                         {(self.user.pk, 'form_2')})
+        self.assertEqual(counts[self.assets[1].uid], 5)
+
+        with override_settings(SUBMISSION_COUNT_CACHE_TIMEOUT=0):
+            cache.clear()
+            with mock.patch(
+                    'kpi.deployment_backends.kobocat_backend.'
+                    'instance_counts_and_last_submission_times',
+                    return_value=self.stats) as mock_stats:
+                self._get_submission_counts()
+                self._get_submission_counts()
+            self.assertEqual(mock_stats.call_count, 2)
+            self.assertEqual(len(mock_stats.call_args[0][0]), 3)
+
+
 class AssetScoreTestCase(TestCase):
     fixtures = ['test_data']
 
@@ -1,3 +1,4 @@
+import mock
 from django.contrib.auth.models import User, AnonymousUser, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
@@ -481,6 +482,43 @@ class ShareCollectionTests(TestCase):
             self.assertTrue(user_obj.has_perm(
                 'view_collection', self.standalone_coll))
 
+    def test_bulk_recalculation_matches_individual_recalculation(self):
+        asset = Asset.objects.create(
+            owner=self.coll_owner, parent=self.child_coll)
+        other_owners_asset = Asset.objects.create(
+            owner=self.someuser, parent=self.parent_coll)
+        self.parent_coll.assign_perm(
+            self.anotheruser, 'view_collection', deny=True)
+        self.child_coll.assign_perm(self.anotheruser, 'view_collection')
+        self.grandparent_coll.assign_perm(self.someuser, 'change_collection')
+        self.grandparent_coll.assign_perm(AnonymousUser(), 'view_collection')
+        self.grandparent_coll.assign_perm(self.anotheruser, 'change_collection')
+
+        # Force several batches
+        with mock.patch.object(Collection, 'PERMISSIONS_BATCH_SIZE', 1):
+            self.grandparent_coll.recalculate_descendants_perms()
+
+        for obj in (self.parent_coll, self.child_coll, asset,
+                    other_owners_asset):
+            obj = type(obj).objects.get(pk=obj.pk)
+            inherited_perms = set(ObjectPermission.objects.filter_for_object(
+                obj, inherited=True).values_list('user_id', 'permission_id'))
+            expected_inherited_perms = {
+                (perm.user_id, perm.permission_id) for perm in
+                obj._recalculate_inherited_perms(
+                    stale_already_deleted=True,
+                    return_instead_of_creating=True
+                )
+            }
+            self.assertEqual(inherited_perms, expected_inherited_perms)
+            self.assertEqual(obj._sync_effective_perms(check_only=True),
+                             (set(), set()))
+        # Denied on the parent collection, granted again on the child
+        self.assertFalse(self.anotheruser.has_perm(
+            'view_collection', self.parent_coll))
+        self.assertTrue(self.anotheruser.has_perm('view_asset', asset))
+        self.assertFalse(self.anotheruser.has_perm('change_asset', asset))
+
 
 class DiscoverablePublicCollectionTests(TestCase):
     fixtures = ['test_data']
@@ -4,6 +4,8 @@
 import pytest
 
 from django.test import TestCase
+from kpi.management.commands.populate_deployment_fields import \
+    populate_deployment_fields
 from kpi.models.asset import Asset
 from kpi.models.asset_version import AssetVersion
 
@@ -98,3 +100,55 @@ class MockDeployment(TestCase):
         self.assertTrue(self.asset.has_deployment)
         self.asset.deployment.delete()
         self.assertFalse(self.asset.has_deployment)
+        self.assertEqual(self.asset.deployment_backend, '')
+        self.assertFalse(self.asset.deployment_active)
+        self.assertEqual(self.asset.deployment_identifier, '')
+
+    def test_deployment_fields(self):
+        asset = Asset.objects.get(pk=self.asset.pk)
+        self.assertEqual(asset.deployment_backend, 'mock')
+        self.assertFalse(asset.deployment_active)
+        self.assertEqual(asset.deployment_identifier,
+                         'mock://%s' % asset.uid)
+
+        self.asset.deployment.set_active(True)
+        self.asset.save()
+        self.assertTrue(Asset.objects.filter(
+            pk=self.asset.pk, deployment_active=True).exists())
+
+    def test_deployed_version_uid(self):
+        version_uid = self.asset.latest_version.uid
+        self.asset.deployment.store_data({'version': version_uid})
+        self.assertEqual(self.asset.deployed_version_uid, version_uid)
+
+        # Legacy deployments store the id of a `reversion` version
+        AssetVersion.objects.filter(uid=version_uid).update(
+            _reversion_version_id=123)
+        self.asset.deployment.store_data({'version': 123})
+        self.assertEqual(self.asset.deployed_version_uid, version_uid)
+
+    def test_populate_deployment_fields(self):
+        self.asset.deployment.store_data({
+            'active': True,
+            'version': self.asset.latest_version.uid,
+        })
+        self.asset.save()
+        Asset.objects.filter(pk=self.asset.pk).update(
+            deployment_backend='',
+            deployment_active=False,
+            deployment_identifier='',
+            deployed_version_uid='',
+        )
+        date_modified = Asset.objects.get(pk=self.asset.pk).date_modified
+
+        self.assertEqual(populate_deployment_fields(), 1)
+        asset = Asset.objects.get(pk=self.asset.pk)
+        self.assertEqual(asset.deployment_backend, 'mock')
+        self.assertTrue(asset.deployment_active)
+        self.assertEqual(asset.deployment_identifier,
+                         'mock://%s' % asset.uid)
+        self.assertEqual(asset.deployed_version_uid,
+                         self.asset.latest_version.uid)
+        self.assertEqual(asset.date_modified, date_modified)
+        # Nothing left to update
+        self.assertEqual(populate_deployment_fields(), 0)
@@ -2,16 +2,23 @@
 from __future__ import unicode_literals
 
 from copy import deepcopy
+import datetime
 import json
+import mock
 from collections import OrderedDict
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
 from kobo.apps.reports import report_data
 from formpack import FormPack
 
+from kpi.deployment_backends.mock_backend import MockDeploymentBackend
 from kpi.models import Asset
+from kpi.models.report_aggregate import ReportAggregate
 
 from formpack.utils import json_hash
 
@@ -72,6 +79,8 @@ def _get_stats_object(pack, version_ids, submissions=None, lang=None, split_by=N
     return stats
 
 
+# Report aggregates are updated by Celery tasks
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
 class MockDataReports(TestCase):
     fixtures = ['test_data']
 
@@ -234,6 +243,300 @@ class MockDataReports(TestCase):
         ])
 
     def test_has_version_and_submissions(self):
-        self.assertEqual(self.asset.asset_versions.count(), 2)
+        # Saving after the deployment did not change the content
+        self.assertEqual(self.asset.asset_versions.count(), 1)
         self.assertTrue(self.asset.has_deployment)
         self.assertEqual(self.asset.deployment.submission_count, 4)
+
+    def test_submission_keys_for_subset_of_fields(self):
+        self.assertEqual(
+            report_data.get_submission_keys(self.fp, ['Select_one', 'Date']),
+            sorted(report_data.SUBMISSION_METADATA_KEYS + (
+                'Select_one', 'Date'))
+        )
+        all_keys = report_data.get_submission_keys(
+            self.fp, report_data.ALL_FIELDS)
+        for field_name in SUBMISSION_DATA.keys():
+            if field_name == 'Note_Should_not_be_displayed':
+                continue
+            self.assertIn(field_name, all_keys)
+
+    def test_report_data_retrieves_only_necessary_keys(self):
+        with mock.patch.object(
+            MockDeploymentBackend, 'get_submissions', autospec=True,
+            side_effect=MockDeploymentBackend.get_submissions
+        ) as patched_get_submissions:
+            values = report_data.data_by_identifiers(
+                self.asset, split_by='Select_one', field_names=['Date'])
+        # The aggregates hold the statistics of every field
+        self.assertEqual(
+            patched_get_submissions.call_args[1]['fields'],
+            report_data.get_submission_keys(self.fp, report_data.ALL_FIELDS)
+        )
+        self.assertEqual(len(values[0]['data']['values']), 4)
+
+    def test_build_formpack_keeps_version_ids_outside_form(self):
+        with mock.patch.object(
+            MockDeploymentBackend, 'get_submissions', autospec=True,
+            side_effect=MockDeploymentBackend.get_submissions
+        ) as patched_get_submissions:
+            report_data.build_formpack(
+                self.asset, fields=report_data.ALL_FIELDS)
+        # A single version needs no inferring
+        self.assertIn('fields', patched_get_submissions.call_args[1])
+
+        self.asset.content['survey'].append(
+            {'type': 'text', 'name': 'new_question', 'label': 'New'})
+        self.asset.save()
+        self.asset.deploy(backend='mock', active=True)
+        new_uid = self.asset.latest_deployed_version.uid
+        submissions = self.asset.deployment.get_submissions()
+        for submission in submissions:
+            # Not a field of any version of the form
+            submission['_version__002'] = new_uid
+        self.asset.deployment.mock_submissions(submissions)
+        with mock.patch.object(
+            MockDeploymentBackend, 'get_submissions', autospec=True,
+            side_effect=MockDeploymentBackend.get_submissions
+        ) as patched_get_submissions:
+            _, submission_stream = report_data.build_formpack(
+                self.asset, fields=report_data.ALL_FIELDS)
+            inferred_version_ids = [
+                submission[report_data.INFERRED_VERSION_ID_KEY]
+                for submission in submission_stream
+            ]
+        self.assertNotIn('fields', patched_get_submissions.call_args[1])
+        self.assertEqual(inferred_version_ids, [new_uid] * 4)
+
+    def test_build_formpack_infers_newest_version(self):
+        old_version = self.asset.latest_deployed_version
+        old_version.uid_aliases = ['old_alias']
+        old_version.save()
+        self.asset.content['survey'].append(
+            {'type': 'text', 'name': 'new_question', 'label': 'New'})
+        self.asset.save()
+        self.asset.deploy(backend='mock', active=True)
+        new_uid = self.asset.latest_deployed_version.uid
+
+        submissions = [
+            {'__version__': old_version.uid, '_version__001': new_uid},
+            {'_version_': 'old_alias', '__version__': 'unknown'},
+            {'__version__': 'unknown'},
+            {},
+        ]
+        _, submission_stream = report_data.build_formpack(
+            self.asset, submission_stream=submissions)
+        self.assertEqual(
+            [submission[report_data.INFERRED_VERSION_ID_KEY]
+             for submission in submission_stream],
+            [new_uid, 'old_alias', new_uid, new_uid]
+        )
+
+    def _set_submission_positions(self):
+        submissions = self.asset.deployment.get_submissions()
+        for index, submission in enumerate(submissions, 1):
+            submission['_id'] = index
+            submission['_submission_time'] = \
+                '2016-06-0{}T12:00:00'.format(index)
+        self.asset.deployment.mock_submissions(submissions)
+        return submissions
+
+    def _assert_report_data_is_aggregated(self, **kwargs):
+        expected_values = report_data.data_by_identifiers(
+            self.asset,
+            submission_stream=self.asset.deployment.get_submissions(),
+            **kwargs)
+        values = report_data.data_by_identifiers(self.asset, **kwargs)
+        self.assertEqual(values, expected_values)
+
+    def test_report_data_is_aggregated(self):
+        submissions = self._set_submission_positions()
+        self._assert_report_data_is_aggregated()
+        self._assert_report_data_is_aggregated(split_by='Select_one')
+        aggregate = self.asset.report_aggregates.get(split_by='')
+        self.assertEqual(aggregate.submission_count, 4)
+        self.assertEqual(aggregate.last_submission_id, 4)
+
+        # Only the new submission is read
+        new_submission = deepcopy(submissions[0])
+        new_submission.update({'_id': 5,
+                               '_submission_time': '2016-06-05T12:00:00',
+                               'Select_one': 'option_2'})
+        self.asset.deployment.mock_submissions(
+            submissions + [new_submission])
+        with mock.patch.object(
+            MockDeploymentBackend, 'get_submissions', autospec=True,
+            side_effect=MockDeploymentBackend.get_submissions
+        ) as patched_get_submissions:
+            values = report_data.data_by_identifiers(
+                self.asset, field_names=['Select_one'])
+        self.assertEqual(patched_get_submissions.call_count, 1)
+        query = patched_get_submissions.call_args[1]['query']
+        self.assertEqual(
+            [submission['_id'] for submission in submissions + [new_submission]
+             if MockDeploymentBackend._matches_query(submission, query)],
+            [5]
+        )
+        self.assertEqual(values[0]['data']['frequencies'], (3, 2))
+        self._assert_report_data_is_aggregated()
+        self._assert_report_data_is_aggregated(split_by='Select_one')
+
+    def test_report_data_is_aggregated_across_versions(self):
+        submissions = self._set_submission_positions()
+        old_version = self.asset.latest_deployed_version
+        old_version.uid_aliases = ['old_alias']
+        old_version.save()
+        self.asset.content['survey'].append(
+            {'type': 'text', 'name': 'new_question', 'label': 'New'})
+        self.asset.save()
+        self.asset.deploy(backend='mock', active=True)
+        new_uid = self.asset.latest_deployed_version.uid
+
+        new_submissions = []
+        for _id, select_one in enumerate(['option_2', 'option_2', None], 5):
+            new_submission = deepcopy(submissions[0])
+            new_submission.update({
+                '_id': _id,
+                '_submission_time': '2016-06-0{}T12:00:00'.format(_id),
+                '__version__': new_uid,
+                'Select_one': select_one,
+                'new_question': 'answer {}'.format(_id % 2),
+            })
+            new_submissions.append(new_submission)
+        # Its version is inferred from an alias, which `AutoReport` does not
+        # count
+        alias_submission = deepcopy(submissions[1])
+        alias_submission.update({
+            '_id': 8,
+            '_submission_time': '2016-06-08T12:00:00',
+            '__version__': 'unknown',
+            '_version_': 'old_alias',
+        })
+        self.asset.deployment.mock_submissions(
+            submissions + new_submissions + [alias_submission])
+
+        self._assert_report_data_is_aggregated()
+        self._assert_report_data_is_aggregated(split_by='Select_one')
+        self._assert_report_data_is_aggregated(
+            split_by='Select_one', field_names=['Select_one', 'new_question'])
+        aggregate = self.asset.report_aggregates.get(split_by='')
+        self.assertEqual(aggregate.submission_count, 8)
+        self.assertEqual(dict(aggregate.metrics['versions']),
+                         {old_version.uid: 4, new_uid: 3})
+
+    @override_settings(REPORT_FIELDS_PER_TASK=5)
+    def test_report_data_is_aggregated_by_field_group(self):
+        self._set_submission_positions()
+        pack, _ = report_data.build_formpack(self.asset, submission_stream=[])
+        field_groups = report_data._get_field_groups(pack)
+        self.assertEqual([len(group) for group in field_groups], [5, 5, 5, 2])
+        with mock.patch.object(
+            MockDeploymentBackend, 'get_submissions', autospec=True,
+            side_effect=MockDeploymentBackend.get_submissions
+        ) as patched_get_submissions:
+            report_data.data_by_identifiers(self.asset)
+        # Each group is counted by its own task, which retrieves only the
+        # keys of its fields
+        self.assertEqual(
+            [call[1]['fields']
+             for call in patched_get_submissions.call_args_list],
+            [report_data.get_submission_keys(
+                pack, [field.name for field in group])
+             for group in field_groups]
+        )
+        self.assertEqual(
+            self.asset.report_aggregates.filter(split_by='').count(), 4)
+        self._assert_report_data_is_aggregated()
+        self._assert_report_data_is_aggregated(split_by='Select_one')
+        self._assert_report_data_is_aggregated(
+            split_by='Select_one', field_names=['Select_one', 'Barcode'])
+
+    def test_report_data_is_rebuilt_after_deletion(self):
+        submissions = self._set_submission_positions()
+        report_data.data_by_identifiers(self.asset)
+        self.asset.deployment.mock_submissions(submissions[1:])
+        self._assert_report_data_is_aggregated()
+        self.assertEqual(
+            self.asset.report_aggregates.get(split_by='').submission_count, 3)
+
+    def test_report_data_is_rebuilt_periodically(self):
+        submissions = self._set_submission_positions()
+        report_data.data_by_identifiers(self.asset)
+        # Editing a submission does not change its position
+        submissions[0]['Select_one'] = 'option_2'
+        self.asset.deployment.mock_submissions(submissions)
+        self.asset.report_aggregates.update(
+            date_rebuilt=timezone.now() - datetime.timedelta(
+                seconds=settings.REPORT_AGGREGATE_MAX_AGE + 1))
+        self._assert_report_data_is_aggregated()
+
+    def test_report_data_does_not_write_while_answering(self):
+        self._set_submission_positions()
+        # The lock of the pending update is never released
+        self.addCleanup(cache.clear)
+        with mock.patch(
+            'kpi.tasks.update_report_aggregate_in_background'
+        ) as patched_task:
+            values = report_data.data_by_identifiers(self.asset)
+            report_data.data_by_identifiers(self.asset)
+        # Only one update is requested until it is done. Meanwhile, the
+        # statistics are computed from the submissions directly
+        self.assertEqual(patched_task.delay.call_count, 1)
+        self.assertFalse(self.asset.report_aggregates.exists())
+        self.assertEqual(values, report_data.data_by_identifiers(
+            self.asset,
+            submission_stream=self.asset.deployment.get_submissions()))
+
+    def test_concurrent_report_aggregate_update_is_discarded(self):
+        self._set_submission_positions()
+        pack, _ = report_data.build_formpack(self.asset, submission_stream=[])
+        fields = report_data._get_report_fields(pack)
+        report_data.update_report_aggregate(self.asset, pack, fields)
+        _update_report_aggregate = report_data._update_report_aggregate
+
+        def _update_concurrently(aggregate, *args):
+            # Another worker saves its update first
+            ReportAggregate.objects.filter(pk=aggregate.pk).update(
+                submission_count=3)
+            _update_report_aggregate(aggregate, *args)
+
+        with mock.patch.object(report_data, '_update_report_aggregate',
+                               side_effect=_update_concurrently):
+            aggregate = report_data.update_report_aggregate(
+                self.asset, pack, fields, rebuild=True)
+        self.assertEqual(aggregate.submission_count, 3)
+
+    def test_report_data_without_submission_positions(self):
+        # Without `_submission_time` and `_id`, everything is read every time
+        self._assert_report_data_is_aggregated()
+        self._assert_report_data_is_aggregated()
+        aggregate = self.asset.report_aggregates.get(split_by='')
+        self.assertEqual(aggregate.submission_count, 4)
+        self.assertIsNone(aggregate.last_submission_id)
+
+    def test_formpack_schema_is_stored(self):
+        version = self.asset.deployed_versions.get()
+        self.assertEqual(version._formpack_schema_cache['content_hash'],
+                         version.content_hash)
+        expected_schema = version.to_formpack_schema()
+        with mock.patch('kpi.models.asset_version.expand_content') as \
+                patched_expand_content:
+            schema = version.to_formpack_schema()
+        patched_expand_content.assert_not_called()
+        self.assertEqual(schema, expected_schema)
+
+    def test_build_formpack_reuses_formpack_until_deployment(self):
+        pack, _ = report_data.build_formpack(self.asset)
+        with mock.patch('kpi.models.asset_version.expand_content') as \
+                patched_expand_content:
+            same_pack, _ = report_data.build_formpack(self.asset)
+        patched_expand_content.assert_not_called()
+        self.assertIs(same_pack, pack)
+
+        self.asset.content['survey'].append(
+            {'type': 'text', 'name': 'new_question', 'label': 'New'})
+        self.asset.save()
+        self.asset.deploy(backend='mock', active=True)
+        new_pack, _ = report_data.build_formpack(self.asset)
+        self.assertIsNot(new_pack, pack)
+        self.assertEqual(len(new_pack.versions), 2)
@@ -2,7 +2,9 @@
 from __future__ import unicode_literals
 
 import os
+import copy
 import mock
+import pytz
 import xlrd
 import zipfile
 import datetime
@@ -12,12 +14,14 @@ from collections import defaultdict
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from kobo.apps.reports import report_data
 from formpack import FormPack
 
+from kpi.deployment_backends.mock_backend import MockDeploymentBackend
 from kpi.models import Asset, ExportTask
+from kpi.models.import_export_task import _copy_in_chunks
 
 
 class MockDataExports(TestCase):
@@ -332,6 +336,46 @@ class MockDataExports(TestCase):
             self.assertEqual(result_row, expected_row)
             row_index += 1
 
+    def test_xls_export_is_copied_in_bounded_chunks(self):
+        chunk_size = 512
+        write_sizes = []
+        real_copy_in_chunks = _copy_in_chunks
+
+        def recording_copy_in_chunks(source_file, destination_file):
+            real_write = destination_file.write
+
+            def recording_write(data):
+                write_sizes.append(len(data))
+                return real_write(data)
+
+            destination_file.write = recording_write
+            return real_copy_in_chunks(
+                source_file, destination_file, chunk_size)
+
+        export_task = ExportTask()
+        export_task.user = self.user
+        export_task.data = {
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'xls',
+            'lang': 'English',
+        }
+        messages = defaultdict(list)
+        with mock.patch('kpi.models.import_export_task._copy_in_chunks',
+                        side_effect=recording_copy_in_chunks):
+            export_task._run_task(messages)
+        self.assertFalse(messages)
+
+        result_content = export_task.result.read()
+        # The result must have needed several writes, none of them larger
+        # than the chunk size
+        self.assertGreater(len(write_sizes), 1)
+        self.assertLessEqual(max(write_sizes), chunk_size)
+        self.assertEqual(sum(write_sizes), len(result_content))
+        # ...and the reassembled file must still be a valid workbook
+        book = xlrd.open_workbook(file_contents=result_content)
+        self.assertEqual(book.sheet_names(), [self.asset.name])
+        self.assertEqual(book.sheets()[0].nrows, 5)
+
     def test_export_spss_labels(self):
         export_task = ExportTask()
         export_task.user = self.user
@@ -529,6 +573,190 @@ class MockDataExports(TestCase):
                 ExportTask.MAXIMUM_FILENAME_LENGTH
         )
 
+    def test_incremental_csv_export(self):
+        task_data = {
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'csv',
+            'incremental': 'true',
+        }
+        # The first export has nothing to build upon, so it includes the
+        # first two submissions in full
+        self.asset.deployment.mock_submissions(self.submissions[:2])
+        first_export = ExportTask.objects.create(
+            user=self.user, data=dict(task_data))
+        first_export.run()
+        self.assertEqual(first_export.status, ExportTask.COMPLETE)
+        self.assertEqual(first_export.data['submission_count'], 2)
+
+        # The second export should only fetch the newer submission
+        self.asset.deployment.mock_submissions(self.submissions)
+        second_export = ExportTask.objects.create(
+            user=self.user, data=dict(task_data))
+        with mock.patch.object(
+                MockDeploymentBackend, 'get_submissions',
+                autospec=True,
+                side_effect=MockDeploymentBackend.get_submissions
+        ) as patched_get_submissions:
+            second_export.run()
+        self.assertEqual(second_export.status, ExportTask.COMPLETE)
+        self.assertEqual(second_export.data['submission_count'], 3)
+        self.assertEqual(
+            patched_get_submissions.call_args[1]['query'],
+            {'_submission_time': {'$gte': '2017-10-23T09:41:38'}}
+        )
+        self.assertEqual(second_export.data['last_submission_ids'], [63])
+
+        # The result must be identical to that of a complete export
+        self.run_csv_export_test(
+            [line.decode('utf-8').rstrip('\r\n')
+                for line in second_export.result]
+        )
+
+    def test_incremental_csv_export_same_second(self):
+        task_data = {
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'csv',
+            'incremental': 'true',
+        }
+        self.asset.deployment.mock_submissions(self.submissions[:2])
+        first_export = ExportTask.objects.create(
+            user=self.user, data=dict(task_data))
+        first_export.run()
+        self.assertEqual(first_export.data['last_submission_ids'], [62])
+
+        # Received during the same second as the previous export's last
+        # submission, which must not be exported twice
+        same_second_submission = copy.deepcopy(self.submissions[1])
+        same_second_submission.update({
+            '_id': 64,
+            '_uuid': 'f2b0b0bd-0bd5-4f2e-9d3c-2ba52b8dfd5d',
+        })
+        self.asset.deployment.mock_submissions(
+            self.submissions[:2] + [same_second_submission])
+        second_export = ExportTask.objects.create(
+            user=self.user, data=dict(task_data))
+        second_export.run()
+        self.assertEqual(second_export.status, ExportTask.COMPLETE)
+        self.assertEqual(second_export.data['submission_count'], 3)
+        self.assertEqual(second_export.data['last_submission_ids'], [62, 64])
+        rows = [line.decode('utf-8').rstrip('\r\n').split(';')
+                for line in second_export.result][1:]
+        # `_id` and `_index` columns
+        self.assertEqual([row[-5] for row in rows], ['"61"', '"62"', '"64"'])
+        self.assertEqual([row[-1] for row in rows], ['"1"', '"2"', '"3"'])
+
+    # Shards are rendered by Celery tasks
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_sharded_csv_export(self):
+        export_task = ExportTask.objects.create(user=self.user, data={
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'csv',
+            'shard_count': '2',
+        })
+        export_task.run()
+        export_task = ExportTask.objects.get(pk=export_task.pk)
+        self.assertEqual(export_task.status, ExportTask.COMPLETE)
+        self.assertEqual(export_task.data['submission_count'], 3)
+        self.assertNotIn('_shards', export_task.data)
+        self.assertEqual(
+            export_task.last_submission_time,
+            datetime.datetime(2017, 10, 23, 9, 42, 11, tzinfo=pytz.UTC)
+        )
+        # Shard results are removed once they have been concatenated
+        for shard_index in range(2):
+            self.assertFalse(export_task.result.storage.exists(
+                export_task._get_shard_result_name(shard_index)))
+        # The result must be identical to that of an unsharded export
+        self.run_csv_export_test(
+            [line.decode('utf-8').rstrip('\r\n')
+                for line in export_task.result]
+        )
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_sharded_csv_export_builds_pack_in_shards_only(self):
+        export_task = ExportTask.objects.create(user=self.user, data={
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'csv',
+            'shard_count': '2',
+        })
+        with mock.patch(
+                'kpi.models.import_export_task.build_formpack',
+                side_effect=report_data.build_formpack
+        ) as patched_build_formpack:
+            export_task.run()
+        self.assertEqual(
+            ExportTask.objects.get(pk=export_task.pk).status,
+            ExportTask.COMPLETE
+        )
+        self.assertEqual(patched_build_formpack.call_count, 2)
+
+    def test_sharded_csv_export_plans_open_ended_shards(self):
+        # Only the first `_id` of the second shard is looked up; neither the
+        # first nor the last shard is bounded by the `_id`s seen so far
+        shards = ExportTask._plan_shards(self.asset, 2)[1]
+        self.assertEqual(
+            [(shard['query'], shard['index_offset']) for shard in shards],
+            [({'_id': {'$lt': 63}}, 0), ({'_id': {'$gte': 63}}, 2)]
+        )
+        self.assertEqual(ExportTask._plan_shards(self.asset, 3)[1][-1][
+            'query'], {'_id': {'$gte': 63}})
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_sharded_csv_export_without_submissions(self):
+        self.asset.deployment.mock_submissions([])
+        self.assertEqual(ExportTask._plan_shards(self.asset, 2), (0, []))
+        export_task = ExportTask.objects.create(user=self.user, data={
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'csv',
+            'shard_count': '2',
+        })
+        export_task.run()
+        export_task = ExportTask.objects.get(pk=export_task.pk)
+        self.assertEqual(export_task.status, ExportTask.COMPLETE)
+        self.assertEqual(export_task.data['submission_count'], 0)
+        rows = [line.decode('utf-8').rstrip('\r\n')
+                for line in export_task.result]
+        # Only the header row
+        self.assertEqual(len(rows), 1)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True, EXPORT_MAX_SHARDS=2)
+    def test_shard_count_is_limited(self):
+        export_task = ExportTask.objects.create(user=self.user, data={
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'csv',
+            'shard_count': '100000',
+        })
+        self.assertEqual(export_task._shard_count, 2)
+        with mock.patch('kpi.tasks.export_shard_in_background.delay') \
+                as patched_delay:
+            export_task.run()
+        self.assertEqual(patched_delay.call_count, 2)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_failed_shard_deletes_shard_results(self):
+        export_task = ExportTask.objects.create(user=self.user, data={
+            'source': reverse('asset-detail', args=[self.asset.uid]),
+            'type': 'csv',
+            'shard_count': '2',
+        })
+        write_csv_lines = ExportTask._write_csv_lines
+
+        def fail_on_second_shard(self, output_file, csv_lines,
+                                 index_offset=0):
+            if index_offset:
+                raise Exception('shard failed')
+            return write_csv_lines(self, output_file, csv_lines, index_offset)
+
+        with mock.patch.object(ExportTask, '_write_csv_lines',
+                               fail_on_second_shard):
+            export_task.run()
+        export_task = ExportTask.objects.get(pk=export_task.pk)
+        self.assertEqual(export_task.status, ExportTask.ERROR)
+        self.assertEqual(export_task.messages['error'], 'shard failed')
+        for shard_index in range(2):
+            self.assertFalse(export_task.result.storage.exists(
+                export_task._get_shard_result_name(shard_index)))
+
     def test_export_latest_version_only(self):
         new_survey_content = [{
             'label': ['Do you descend... new label',
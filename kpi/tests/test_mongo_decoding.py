@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import collections
+import copy
 import unittest
 
+import mock
+
 from django.test import TestCase
 from django.conf import settings
 
@@ -156,3 +160,76 @@ class MongoBase64Decoding(TestCase):
         decoded = list(get_instances_from_mongo())
         expected_results = decoded_results
         self.assertEqual(decoded, expected_results)
+
+    def test_lazy_decoding_leaves_document_untouched(self):
+        encoded = {
+            '_id': 190,
+            'dotLg==dot': 'dotted',
+            'dottyLg==group': [
+                {'dottyLg==group/inLg==group': 'greetings'},
+                {'dottyLg==group/inLg==group': 'salutations'},
+            ],
+            'regular': '1.3',
+        }
+        original = copy.deepcopy(encoded)
+        readable = MongoHelper.to_readable_dict(encoded, lazy=True)
+        self.assertEqual(
+            sorted(readable.keys()),
+            ['_id', 'dot.dot', 'dotty.group', 'regular']
+        )
+        self.assertEqual(readable['dot.dot'], 'dotted')
+        self.assertEqual(
+            [dict(item) for item in readable['dotty.group']],
+            [
+                {'dotty.group/in.group': 'greetings'},
+                {'dotty.group/in.group': 'salutations'},
+            ]
+        )
+        self.assertNotIn('dotLg==dot', readable)
+        # Nothing has been decoded in place
+        self.assertEqual(encoded, original)
+        # Writes go through to the underlying document
+        readable['added'] = True
+        self.assertTrue(encoded['added'])
+        del readable['dot.dot']
+        self.assertNotIn('dotLg==dot', encoded)
+
+    def test_lazy_decoding_writes_lists_through(self):
+        encoded = {
+            'dottyLg==group': [
+                {'dottyLg==group/inLg==group': 'greetings'},
+            ],
+        }
+        readable = MongoHelper.to_readable_dict(encoded, lazy=True)
+        group = readable['dotty.group']
+        group[0]['dotty.group/in.group'] = 'salutations'
+        group.append({'dotty.group/in.group': 'and farewell'})
+        self.assertEqual(encoded['dottyLg==group'], [
+            {'dottyLg==group/inLg==group': 'salutations'},
+            {'dotty.group/in.group': 'and farewell'},
+        ])
+        self.assertEqual(len(readable['dotty.group']), 2)
+
+    def test_readable_keys_cache_is_bounded_per_form(self):
+        with mock.patch.object(
+            MongoHelper, 'READABLE_KEYS_CACHE_MAX_FORMS', 2
+        ), mock.patch.object(
+            MongoHelper, 'READABLE_KEYS_CACHE_MAX_KEYS', 2
+        ), mock.patch.object(
+            MongoHelper, '_readable_keys_cache', collections.OrderedDict()
+        ):
+            cache = MongoHelper._readable_keys_cache
+            MongoHelper.to_readable_dict({'aLg==a': 1}, form_id='form_a')
+            MongoHelper.to_readable_dict({'bLg==b': 1}, form_id='form_b')
+            # A form with many keys only fills its own cache
+            MongoHelper.to_readable_dict(
+                {'cLg==c': 1, 'dLg==d': 1, 'eLg==e': 1}, form_id='form_b')
+            self.assertEqual(cache['form_a'], {'aLg==a': 'a.a'})
+            self.assertEqual(len(cache['form_b']), 2)
+
+            # The least recently used form is forgotten first
+            MongoHelper.to_readable_dict({'aLg==a': 1}, form_id='form_a')
+            readable = MongoHelper.to_readable_dict(
+                {'fLg==f': 1}, form_id='form_c')
+            self.assertEqual(list(cache), ['form_a', 'form_c'])
+            self.assertEqual(readable, {'f.f': 1})
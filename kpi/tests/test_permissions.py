@@ -1,11 +1,20 @@
+from StringIO import StringIO
+
+import mock
 from django.contrib.auth.models import Permission
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 
 from ..models.asset import Asset
 from ..models.collection import Collection
-from ..models.object_permission import get_all_objects_for_user
+from ..models.object_permission import (
+    EffectivePermission,
+    get_all_objects_for_user,
+    get_objects_for_user,
+)
 
 
 class BasePermissionsTestCase(TestCase):
@@ -509,3 +518,55 @@ class PermissionsTestCase(BasePermissionsTestCase):
 
         self.assertListEqual(
             sorted(new_admin_asset_2.get_perms(self.someuser)), expected_permissions)
+
+    def test_effective_permissions_are_materialized(self):
+        asset = self.admin_asset
+        asset.assign_perm(self.someuser, 'change_asset')
+        self.assertListEqual(
+            sorted(EffectivePermission.objects.filter_for_object(
+                asset, user=self.someuser).values_list('codename', flat=True)),
+            ['change_asset', 'share_asset', 'view_asset']
+        )
+        with self.assertNumQueries(1):
+            self.assertTrue(asset.has_perm(self.someuser, 'share_asset'))
+        self.assertIn(asset, get_objects_for_user(
+            self.someuser, 'share_asset', Asset))
+
+        asset.remove_perm(self.someuser, 'view_asset')
+        self.assertFalse(EffectivePermission.objects.filter_for_object(
+            asset, user=self.someuser).exists())
+        self.assertNotIn(asset, get_objects_for_user(
+            self.someuser, 'view_asset', Asset))
+
+    def test_effective_permissions_are_synchronized_once(self):
+        asset = self.admin_asset
+        with mock.patch.object(
+                Asset, '_sync_effective_perms', autospec=True,
+                side_effect=Asset._sync_effective_perms) as sync:
+            # Implies `view_asset`
+            asset.assign_perm(self.someuser, 'change_asset')
+            self.assertEqual(sync.call_count, 1)
+            # Implies revoking `change_asset`
+            asset.remove_perm(self.someuser, 'view_asset')
+            self.assertEqual(sync.call_count, 2)
+        self.assertFalse(EffectivePermission.objects.filter_for_object(
+            asset, user=self.someuser).exists())
+
+    def test_rebuild_effective_permissions(self):
+        asset = self.admin_asset
+        asset.assign_perm(self.someuser, 'view_asset')
+        call_command('rebuild_effective_permissions', check=True,
+                     stdout=StringIO())
+
+        EffectivePermission.objects.filter_for_object(asset).delete()
+        self.assertFalse(self.someuser.has_perm('view_asset', asset))
+        with self.assertRaises(CommandError):
+            call_command('rebuild_effective_permissions', check=True,
+                         stdout=StringIO())
+
+        call_command('rebuild_effective_permissions', stdout=StringIO())
+        self.assertTrue(self.someuser.has_perm('view_asset', asset))
+        self.assertListEqual(
+            sorted(asset.get_perms(asset.owner)), self.asset_owner_permissions)
+        call_command('rebuild_effective_permissions', check=True,
+                     stdout=StringIO())
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import haystack
+import mock
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from kpi.haystack_utils import (
+    process_search_index_queue,
+    SEARCH_INDEX_QUEUE_LOCK_KEY,
+    SEARCH_INDEX_QUEUE_MAX_ATTEMPTS,
+)
+from kpi.models import Asset, SearchIndexQueueItem
+
+
+@override_settings(SEARCH_INDEX_ASYNC=True)
+class SearchIndexQueueTestCase(TestCase):
+    fixtures = ['test_data']
+
+    def setUp(self):
+        self.user = User.objects.get(username='someuser')
+        patcher = mock.patch(
+            'kpi.tasks.update_search_index_from_queue.apply_async')
+        self.patched_apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+        # The patched task never clears its pending flag
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def _get_queue_items(self, obj):
+        return SearchIndexQueueItem.objects.filter(
+            content_type=ContentType.objects.get_for_model(obj),
+            object_id=obj.pk)
+
+    def _patch_backend(self):
+        backend = haystack.connections['default'].get_backend()
+        return mock.patch.multiple(backend, update=mock.DEFAULT,
+                                   remove=mock.DEFAULT)
+
+    def test_changes_are_queued_once_per_object(self):
+        asset = Asset.objects.create(owner=self.user, name='First name')
+        asset.name = 'Second name'
+        asset.save()
+        self.assertEqual(self._get_queue_items(asset).count(), 1)
+        self.assertTrue(self.patched_apply_async.called)
+
+        with self._patch_backend() as patched_backend:
+            processed_count = process_search_index_queue()
+        self.assertTrue(processed_count >= 1)
+        self.assertFalse(SearchIndexQueueItem.objects.exists())
+        indexed_assets = [
+            obj for call in patched_backend['update'].call_args_list
+            for obj in call[0][1] if isinstance(obj, Asset)
+        ]
+        self.assertEqual(indexed_assets, [asset])
+
+    def test_deleted_objects_are_removed_from_index(self):
+        asset = Asset.objects.create(owner=self.user)
+        asset_pk = asset.pk
+        asset.delete()
+        with self._patch_backend() as patched_backend:
+            process_search_index_queue()
+        patched_backend['remove'].assert_any_call(
+            'kpi.asset.{}'.format(asset_pk))
+
+    def test_deferred_changes_are_not_queued(self):
+        signal_processor = apps.get_app_config('haystack').signal_processor
+        with signal_processor.defer():
+            asset = Asset.objects.create(owner=self.user)
+        self.assertFalse(self._get_queue_items(asset).exists())
+
+    def test_one_task_is_pending_at_a_time(self):
+        asset = Asset.objects.create(owner=self.user)
+        asset.save()
+        Asset.objects.create(owner=self.user)
+        self.assertEqual(self.patched_apply_async.call_count, 1)
+
+    def test_failing_objects_do_not_block_the_queue(self):
+        failing_asset = Asset.objects.create(owner=self.user)
+        asset = Asset.objects.create(owner=self.user)
+
+        def _update(index, objs, *args, **kwargs):
+            if failing_asset in objs:
+                raise Exception('Cannot index')
+
+        for _ in range(SEARCH_INDEX_QUEUE_MAX_ATTEMPTS):
+            with self._patch_backend() as patched_backend:
+                patched_backend['update'].side_effect = _update
+                process_search_index_queue()
+            self.assertFalse(self._get_queue_items(asset).exists())
+        item = self._get_queue_items(failing_asset).get()
+        self.assertEqual(item.attempts, SEARCH_INDEX_QUEUE_MAX_ATTEMPTS)
+        self.assertEqual(item.last_error, 'Cannot index')
+
+        # Given up on until it changes again
+        with self._patch_backend() as patched_backend:
+            self.assertEqual(process_search_index_queue(), 0)
+        patched_backend['update'].assert_not_called()
+        failing_asset.save()
+        self.assertEqual(self._get_queue_items(failing_asset).get().attempts,
+                         0)
+
+    def test_queue_is_processed_by_one_worker_at_a_time(self):
+        asset = Asset.objects.create(owner=self.user)
+        cache.add(SEARCH_INDEX_QUEUE_LOCK_KEY, True)
+        with self._patch_backend() as patched_backend:
+            self.assertIsNone(process_search_index_queue())
+        patched_backend['update'].assert_not_called()
+        self.assertTrue(self._get_queue_items(asset).exists())
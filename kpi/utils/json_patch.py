@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal JSON Patch (RFC 6902) support: `make_patch()` only produces `add`,
+`remove` and `replace` operations, and `apply_patch()` only understands those.
+"""
+from __future__ import unicode_literals
+
+import copy
+
+
+def _escape(token):
+    return unicode(token).replace('~', '~0').replace('/', '~1')
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+def _same(source, target):
+    # `==` alone considers e.g. `True` and `1` equal
+    if type(source) != type(target) or source != target:
+        return False
+    if isinstance(source, dict):
+        return all(_same(value, target[key])
+                   for key, value in source.iteritems())
+    if isinstance(source, list):
+        return all(_same(*pair) for pair in zip(source, target))
+    return True
+
+
+def _diff(source, target, path, patch):
+    if _same(source, target):
+        return
+    if type(source) != type(target):
+        patch.append({'op': 'replace', 'path': path, 'value': target})
+    elif isinstance(source, dict):
+        for key in source:
+            child_path = '{}/{}'.format(path, _escape(key))
+            if key not in target:
+                patch.append({'op': 'remove', 'path': child_path})
+            else:
+                _diff(source[key], target[key], child_path, patch)
+        for key in target:
+            if key not in source:
+                patch.append({'op': 'add',
+                              'path': '{}/{}'.format(path, _escape(key)),
+                              'value': target[key]})
+    elif isinstance(source, list):
+        # Skip the unchanged head and tail, so inserting or deleting a single
+        # row in the middle of a long list produces a single operation
+        prefix = 0
+        max_prefix = min(len(source), len(target))
+        while prefix < max_prefix and _same(source[prefix], target[prefix]):
+            prefix += 1
+        suffix = 0
+        max_suffix = max_prefix - prefix
+        while suffix < max_suffix and \
+                _same(source[-1 - suffix], target[-1 - suffix]):
+            suffix += 1
+        source_middle = source[prefix:len(source) - suffix]
+        target_middle = target[prefix:len(target) - suffix]
+
+        common = min(len(source_middle), len(target_middle))
+        for index in xrange(common):
+            _diff(source_middle[index], target_middle[index],
+                  '{}/{}'.format(path, prefix + index), patch)
+        # Removing at the same index repeatedly shifts the following items
+        for index in xrange(common, len(source_middle)):
+            patch.append({'op': 'remove',
+                          'path': '{}/{}'.format(path, prefix + common)})
+        for index in xrange(common, len(target_middle)):
+            patch.append({'op': 'add',
+                          'path': '{}/{}'.format(path, prefix + index),
+                          'value': target_middle[index]})
+    else:
+        patch.append({'op': 'replace', 'path': path, 'value': target})
+
+
+def make_patch(source, target):
+    """
+    Returns the list of operations that transforms `source` into `target`
+    """
+    patch = []
+    _diff(source, target, '', patch)
+    return patch
+
+
+def apply_patch(document, patch):
+    """
+    Returns a copy of `document` with the operations of `patch` applied.
+    `document` itself is left untouched.
+    """
+    document = copy.deepcopy(document)
+    for operation in patch:
+        op = operation['op']
+        path = operation['path']
+        if path == '':
+            if op == 'remove':
+                document = None
+            else:
+                document = copy.deepcopy(operation['value'])
+            continue
+
+        tokens = [_unescape(token) for token in path.split('/')[1:]]
+        parent = document
+        for token in tokens[:-1]:
+            if isinstance(parent, list):
+                token = int(token)
+            parent = parent[token]
+        key = tokens[-1]
+        if isinstance(parent, list):
+            key = len(parent) if key == '-' else int(key)
+
+        if op == 'remove':
+            del parent[key]
+        elif op == 'replace':
+            parent[key] = copy.deepcopy(operation['value'])
+        elif op == 'add':
+            value = copy.deepcopy(operation['value'])
+            if isinstance(parent, list):
+                parent.insert(key, value)
+            else:
+                parent[key] = value
+        else:
+            raise ValueError('Unsupported JSON Patch operation: {}'.format(op))
+
+    return document
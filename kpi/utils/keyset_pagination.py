@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import json
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import ugettext as _
+
+# Newest first, like the default ordering of assets and collections. `pk`
+# breaks ties between objects modified at the same time
+KEYSET_ORDERING = ('-date_modified', '-pk')
+
+
+def encode_cursor(obj):
+    """
+    Builds an opaque cursor pointing right after `obj`.
+
+    :param obj: Asset or Collection. Last object of a page
+    :return: str
+    """
+    position = {
+        'kind': obj.kind,
+        'date_modified': obj.date_modified.isoformat(),
+        'pk': obj.pk,
+    }
+    return base64.urlsafe_b64encode(json.dumps(position, sort_keys=True))
+
+
+def decode_cursor(cursor):
+    """
+    Reverse of `encode_cursor()`
+
+    :param cursor: str
+    :return: dict. `None` if `cursor` is empty
+    """
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        position = {
+            'kind': position['kind'],
+            'date_modified': parse_datetime(position['date_modified']),
+            'pk': int(position['pk']),
+        }
+    except (TypeError, ValueError, KeyError):
+        raise ValueError(_("Invalid `cursor` param"))
+    if position['date_modified'] is None:
+        raise ValueError(_("Invalid `cursor` param"))
+    return position
+
+
+def filter_after(queryset, position):
+    """
+    Orders `queryset` by `KEYSET_ORDERING` and, unless `position` is `None`,
+    restricts it to the objects that come after `position`. Unlike an offset,
+    this costs the same however far `position` is
+    """
+    queryset = queryset.order_by(*KEYSET_ORDERING)
+    if position is None:
+        return queryset
+    return queryset.filter(
+        Q(date_modified__lt=position['date_modified']) |
+        Q(date_modified=position['date_modified'], pk__lt=position['pk'])
+    )
+
+
+def get_keyset_page(queryset, position, limit):
+    """
+    :param queryset: QuerySet, or a pseudo-queryset that implements
+        `get_keyset_page(position, limit)` itself
+    :param position: dict. See `decode_cursor()`
+    :param limit: int
+    :return: list. At most `limit` objects following `position`
+    """
+    if hasattr(queryset, 'get_keyset_page'):
+        return queryset.get_keyset_page(position, limit)
+    return list(filter_after(queryset, position)[:limit])
+
+
+def estimate_count(queryset):
+    """
+    Returns the number of rows PostgreSQL's planner expects `queryset` to
+    return, which only costs planning the query. Counts exactly on other
+    databases
+
+    :param queryset: QuerySet, or a pseudo-queryset that implements
+        `estimate_count()` itself
+    :return: int
+    """
+    if hasattr(queryset, 'estimate_count'):
+        return queryset.estimate_count()
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    try:
+        # Ordering does not change the count
+        sql, params = queryset.order_by().query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
@@ -2,8 +2,10 @@
 from __future__ import unicode_literals
 
 import base64
+import collections
 import json
 import re
+import threading
 
 from bson import json_util, ObjectId
 from django.conf import settings
@@ -22,7 +24,7 @@ class MongoHelper(object):
     """
 
     KEY_WHITELIST = ['$or', '$and', '$exists', '$in', '$gt', '$gte',
-                     '$lt', '$lte', '$regex', '$options', '$all']
+                     '$lt', '$lte', '$regex', '$options', '$all', '$ne']
 
     ENCODING_SUBSTITUTIONS = [
         (re.compile(r'^\$'), base64.encodestring('$').strip()),
@@ -39,30 +41,104 @@ class MongoHelper(object):
     DEFAULT_LIMIT = 30000
     DEFAULT_BATCHSIZE = 1000
 
+    # Submissions of the same form share the same keys: remember how each
+    # key reads once decoded, per form. The forms whose keys were decoded
+    # least recently are forgotten first, and only the first
+    # `READABLE_KEYS_CACHE_MAX_KEYS` keys of a form are remembered, so that a
+    # form with many keys cannot push the others out
+    READABLE_KEYS_CACHE_MAX_FORMS = 100
+    READABLE_KEYS_CACHE_MAX_KEYS = 10000
+    _readable_keys_cache = collections.OrderedDict()
+    _readable_keys_cache_lock = threading.Lock()
+
     @classmethod
-    def to_readable_dict(cls, d):
+    def to_readable_dict(cls, d, lazy=False, form_id=None):
         """
         Updates encoded attributes of a dict with human-readable attributes.
         For example:
         { "myLg==attribute": True } => { "my.attribute": True }
 
         :param d: dict
+        :param lazy: boolean. If `True`, leave `d` untouched and return a
+            `ReadableDict` that decodes attributes only when they're accessed
+        :param form_id: string. Identifies the form `d` was submitted to, e.g.
+            its `mongo_userform_id`. Decoded keys are cached per form
         :return: dict
         """
+        readable_keys = cls._get_readable_keys(form_id)
+        if lazy:
+            return ReadableDict(d, readable_keys)
+        return cls._to_readable_dict(d, readable_keys)
 
-        for key, value in list(d.items()):
-            if type(value) == list:
-                value = [cls.to_readable_dict(e)
-                         if type(e) == dict else e for e in value]
-            elif type(value) == dict:
-                value = cls.to_readable_dict(value)
-
-            if cls._is_attribute_encoded(key):
+    @classmethod
+    def _to_readable_dict(cls, d, readable_keys):
+        get_readable_key = cls.get_readable_key
+        # `keys()` returns a copy (Python 2), so `d` may be modified within
+        # the loop
+        for key in d.keys():
+            value = d[key]
+            value_type = type(value)
+            if value_type == dict:
+                cls._to_readable_dict(value, readable_keys)
+            elif value_type == list:
+                for element in value:
+                    if type(element) == dict:
+                        cls._to_readable_dict(element, readable_keys)
+
+            readable_key = get_readable_key(key, readable_keys)
+            if readable_key != key:
                 del d[key]
-                d[cls.decode(key)] = value
+                d[readable_key] = value
 
         return d
 
+    @classmethod
+    def _get_readable_keys(cls, form_id):
+        """
+        Returns the cache of decoded keys of `form_id`, creating it if needed,
+        and marks it as the most recently used
+
+        :param form_id: string
+        :return: dict
+        """
+        with cls._readable_keys_cache_lock:
+            try:
+                readable_keys = cls._readable_keys_cache.pop(form_id)
+            except KeyError:
+                readable_keys = {}
+                while len(cls._readable_keys_cache) >= \
+                        cls.READABLE_KEYS_CACHE_MAX_FORMS:
+                    cls._readable_keys_cache.popitem(last=False)
+            cls._readable_keys_cache[form_id] = readable_keys
+        return readable_keys
+
+    @classmethod
+    def get_readable_key(cls, key, readable_keys=None):
+        """
+        Returns the human-readable (i.e. decoded) version of `key`, which is
+        `key` itself when it is not encoded
+
+        :param key: string
+        :param readable_keys: dict. Cache of decoded keys; see
+            `_get_readable_keys()`
+        :return: string
+        """
+        if readable_keys is None:
+            readable_keys = cls._get_readable_keys(None)
+        try:
+            return readable_keys[key]
+        except KeyError:
+            pass
+
+        if cls._is_attribute_encoded(key):
+            readable_key = cls.decode(key)
+        else:
+            readable_key = key
+
+        if len(readable_keys) < cls.READABLE_KEYS_CACHE_MAX_KEYS:
+            readable_keys[key] = readable_key
+        return readable_key
+
     @classmethod
     def to_safe_dict(cls, d, reading=False):
         """
@@ -253,13 +329,102 @@ class MongoHelper(object):
             sort = MongoHelper.to_safe_dict(sort, reading=True)
             sort_key = sort.keys()[0]
             sort_dir = int(sort[sort_key])  # -1 for desc, 1 for asc
-            cursor.sort(sort_key, sort_dir)
+            if sort_key == "_id":
+                cursor.sort(sort_key, sort_dir)
+            else:
+                # Break ties on `_id` to make the order deterministic, which
+                # keyset pagination relies on. See `get_keyset_query()`
+                cursor.sort([(sort_key, sort_dir), ("_id", sort_dir)])
 
         # set batch size
-        cursor.batch_size = cls.DEFAULT_BATCHSIZE
+        cursor.batch_size(cls.DEFAULT_BATCHSIZE)
 
         return cursor
 
+    @staticmethod
+    def encode_cursor(instance, sort_key="_id"):
+        """
+        Builds an opaque cursor pointing right after `instance`.
+
+        :param instance: dict. Last instance of a page
+        :param sort_key: str. Field instances are sorted on
+        :return: str
+        """
+        position = {"_id": instance.get("_id")}
+        if sort_key != "_id":
+            position["value"] = instance.get(sort_key)
+        return base64.urlsafe_b64encode(
+            json.dumps(position, default=json_util.default))
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Reverse of `encode_cursor()`
+
+        :param cursor: str
+        :return: dict. `None` if `cursor` is empty
+        """
+        if not cursor:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(str(cursor)),
+                                  object_hook=json_util.object_hook)
+        except (TypeError, ValueError):
+            raise ValueError(_("Invalid `cursor` param"))
+        if not isinstance(position, dict) or "_id" not in position:
+            raise ValueError(_("Invalid `cursor` param"))
+        return position
+
+    @classmethod
+    def get_keyset_query(cls, query, sort_key, sort_dir, position):
+        """
+        Restricts `query` to instances located after `position` (see
+        `decode_cursor()`) when sorted on `sort_key` then `_id`. Unlike
+        `start`, the cost of the resulting query does not grow with the
+        number of instances already read.
+
+        :param query: dict
+        :param sort_key: str
+        :param sort_dir: int. -1 for desc, 1 for asc
+        :param position: dict
+        :return: dict
+        """
+        if position is None:
+            return query
+
+        operator = "$gt" if sort_dir > 0 else "$lt"
+        if sort_key == "_id":
+            keyset_query = {"_id": {operator: position["_id"]}}
+        else:
+            # Missing and `None` values sort before all others, but Mongo
+            # only compares values of the same type: nothing is `$gt` or `$lt`
+            # `None`, and `None` is not `$lt` anything
+            value = position.get("value")
+            same_value_query = {sort_key: value,
+                                "_id": {operator: position["_id"]}}
+            if value is None and sort_dir > 0:
+                keyset_query = {"$or": [
+                    same_value_query,
+                    {sort_key: {"$ne": None}},
+                ]}
+            elif value is None:
+                keyset_query = same_value_query
+            elif sort_dir > 0:
+                keyset_query = {"$or": [
+                    {sort_key: {operator: value}},
+                    same_value_query,
+                ]}
+            else:
+                keyset_query = {"$or": [
+                    {sort_key: {operator: value}},
+                    same_value_query,
+                    {sort_key: None},
+                ]}
+
+        if query:
+            return {"$and": [query, keyset_query]}
+        return keyset_query
+
     @classmethod
     def validate_params(cls, **kwargs):
         """
@@ -316,3 +481,114 @@ class MongoHelper(object):
             "sort": sort,
             "instances_ids": instances_ids
         }
+
+
+def _wrap_readable(value, readable_keys):
+    value_type = type(value)
+    if value_type == dict:
+        return ReadableDict(value, readable_keys)
+    if value_type == list:
+        return ReadableList(value, readable_keys)
+    return value
+
+
+def _unwrap_readable(value):
+    if isinstance(value, ReadableDict):
+        return value._document
+    if isinstance(value, ReadableList):
+        return value._list
+    return value
+
+
+class ReadableDict(collections.MutableMapping):
+    """
+    Read-through, human-readable view of a dict retrieved from Mongo: encoded
+    attributes are decoded (see `MongoHelper.to_readable_dict()`) only when
+    they are accessed, and the underlying dict is never rewritten. Values
+    that are dicts are returned as `ReadableDict`s, and lists as
+    `ReadableList`s; changes made through either go to the underlying dict
+    """
+
+    def __init__(self, document, readable_keys=None):
+        self._document = document
+        # Cache of decoded keys; see `MongoHelper._get_readable_keys()`
+        self._readable_keys = readable_keys
+        # Maps readable keys to the keys of `self._document`
+        self.__raw_keys = None
+
+    @property
+    def _raw_keys(self):
+        if self.__raw_keys is None:
+            get_readable_key = MongoHelper.get_readable_key
+            readable_keys = self._readable_keys
+            self.__raw_keys = dict(
+                (get_readable_key(key, readable_keys), key)
+                for key in self._document
+            )
+        return self.__raw_keys
+
+    def __getitem__(self, key):
+        return _wrap_readable(self._document[self._raw_keys[key]],
+                              self._readable_keys)
+
+    def __setitem__(self, key, value):
+        raw_key = self._raw_keys.setdefault(key, key)
+        self._document[raw_key] = _unwrap_readable(value)
+
+    def __delitem__(self, key):
+        del self._document[self._raw_keys.pop(key)]
+
+    def __iter__(self):
+        return iter(self._raw_keys)
+
+    def __len__(self):
+        return len(self._document)
+
+    def __contains__(self, key):
+        return key in self._raw_keys
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
+
+
+class ReadableList(collections.MutableSequence):
+    """
+    Same as `ReadableDict`, for the lists within a dict retrieved from Mongo,
+    e.g. the entries of a repeating group
+    """
+
+    def __init__(self, list_, readable_keys=None):
+        self._list = list_
+        self._readable_keys = readable_keys
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_wrap_readable(value, self._readable_keys)
+                    for value in self._list[index]]
+        return _wrap_readable(self._list[index], self._readable_keys)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            self._list[index] = [_unwrap_readable(v) for v in value]
+        else:
+            self._list[index] = _unwrap_readable(value)
+
+    def __delitem__(self, index):
+        del self._list[index]
+
+    def __len__(self):
+        return len(self._list)
+
+    def insert(self, index, value):
+        self._list.insert(index, _unwrap_readable(value))
+
+    def __eq__(self, other):
+        if isinstance(other, ReadableList):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, list(self))
@@ -5,7 +5,7 @@ import base64
 import copy
 import datetime
 import json
-from hashlib import md5
+from collections import OrderedDict
 from itertools import chain
 
 import constance
@@ -17,15 +17,27 @@ from django.contrib.auth.models import User
 from django.db import transaction
 from django.db.models import Q
 from django.forms import model_to_dict
-from django.http import Http404, HttpResponseBadRequest, HttpResponseRedirect
+from django.http import (
+    Http404,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, resolve_url
 from django.template.response import TemplateResponse
-from django.utils.http import is_safe_url
+from django.utils.http import is_safe_url, parse_etags, quote_etag
 from django.utils.translation import ugettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from private_storage.views import PrivateStorageDetailView
-from rest_framework import exceptions, mixins, renderers, status, viewsets
+from rest_framework import (
+    exceptions,
+    mixins,
+    renderers,
+    serializers,
+    status,
+    viewsets,
+)
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import (
     api_view,
@@ -36,6 +48,8 @@ from rest_framework.decorators import (
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.views import APIView
 from rest_framework_extensions.mixins import NestedViewSetMixin
 from taggit.models import Tag
@@ -54,6 +68,7 @@ from .constants import (
     CLONE_COMPATIBLE_TYPES,
     CLONE_FROM_VERSION_ID_ARG_NAME,
     COLLECTION_CLONE_FIELDS,
+    INSTANCE_FORMAT_TYPE_XML,
 )
 from .deployment_backends.backends import DEPLOYMENT_BACKENDS
 from .filters import (
@@ -68,6 +83,7 @@ from .model_utils import disable_auto_field_update, remove_string_prefix
 from .models import (
     Asset,
     AssetFile,
+    AssetSetVersion,
     AssetSnapshot,
     AssetVersion,
     AuthorizedApplication,
@@ -111,6 +127,7 @@ from .serializers import (
     ExportTaskSerializer,
     ImportTaskListSerializer,
     ImportTaskSerializer,
+    KeysetPaginated,
     ObjectPermissionSerializer,
     OneTimeAuthenticationKeySerializer,
     SitewideMessageSerializer,
@@ -217,6 +234,7 @@ class CollectionViewSet(viewsets.ModelViewSet):
     serializer_class = CollectionSerializer
     permission_classes = (IsOwnerOrReadOnly,)
     filter_backends = (KpiObjectPermissionsFilter, SearchFilter)
+    pagination_class = KeysetPaginated
     lookup_field = 'uid'
 
     def _clone(self):
@@ -569,6 +587,8 @@ class ExportTaskViewSet(NoUpdateModelViewSet):
             'lang',
             'hierarchy_in_labels',
             'fields_from_all_versions',
+            'incremental',
+            'shard_count',
         )
         task_data = {}
         for opt in valid_options:
@@ -579,6 +599,17 @@ class ExportTaskViewSet(NoUpdateModelViewSet):
         if not task_data.get('source', False):
             raise exceptions.ValidationError(
                 {'source': 'This field is required.'})
+        # Complain if the export cannot be split into that many shards
+        if 'shard_count' in task_data:
+            try:
+                shard_count = int(task_data['shard_count'])
+            except ValueError:
+                shard_count = 0
+            if not 1 <= shard_count <= settings.EXPORT_MAX_SHARDS:
+                raise exceptions.ValidationError(
+                    {'shard_count': 'This field must be an integer between '
+                                    '1 and {}.'.format(
+                                        settings.EXPORT_MAX_SHARDS)})
         # Get the source object
         source_type, source = _resolve_url_to_asset_or_collection(
             task_data['source'])
@@ -809,6 +840,38 @@ class SubmissionViewSet(NestedViewSetMixin, viewsets.ViewSet):
     >
     >       curl -X GET https://[kpi-url]/assets/aSAvYreNzVEkrWg5Gdcvg/submissions/
 
+    Submissions are paginated with `start` and `limit` by default. Deep pages
+    get slower and slower to retrieve that way; pass `cursor` (empty for the
+    first page) to paginate with the position of the last submission instead.
+    The response then contains the URL of the `next` page, which is `null`
+    on the last page.
+
+    <pre class="prettyprint">
+    <b>GET</b> /assets/<code>{asset_uid}</code>/submissions/?cursor=&limit=<code>{limit}</code>
+    </pre>
+
+    > Example
+    >
+    >       curl -X GET https://[kpi-url]/assets/aSAvYreNzVEkrWg5Gdcvg/submissions/?cursor=&limit=100
+
+    > Response
+    >
+    >       {
+    >           "next": "https://[kpi-url]/assets/aSAvYreNzVEkrWg5Gdcvg/submissions/?cursor=eyJfaWQiOiAxMDB9&limit=100",
+    >           "results": [...]
+    >       }
+
+    `sort` is supported on one field only. With XML format, the `next` URL is
+    an attribute of the `<root>` element and only `_id` can be sorted on.
+
+    Large lists can be streamed with `stream=true`: submissions are sent as
+    soon as they are retrieved, instead of once all of them have been
+    gathered. `stream` is not compatible with `cursor`.
+
+    <pre class="prettyprint">
+    <b>GET</b> /assets/<code>{asset_uid}</code>/submissions/?stream=true
+    </pre>
+
     ## CRUD
 
     * `uid` - is the unique identifier of a specific asset
@@ -957,8 +1020,54 @@ class SubmissionViewSet(NestedViewSetMixin, viewsets.ViewSet):
         filters = request.GET.dict()
         # remove `format` from filters, it's redundant.
         filters.pop('format', None)
-        submissions = deployment.get_submissions(format_type=format_type, **filters)
-        return Response(list(submissions))
+        stream = filters.pop('stream', 'false').lower() == 'true'
+        if stream:
+            if 'cursor' in filters:
+                raise serializers.ValidationError(
+                    _('`stream` is not compatible with `cursor`'))
+            submissions = deployment.get_submissions(format_type=format_type, **filters)
+            return self._get_streaming_response(format_type, submissions)
+
+        if 'cursor' not in filters:
+            submissions = deployment.get_submissions(format_type=format_type, **filters)
+            return Response(list(submissions))
+
+        submissions, next_cursor = deployment.get_submissions_page(
+            format_type=format_type, **filters)
+        next_url = None
+        if next_cursor is not None:
+            next_url = replace_query_param(request.build_absolute_uri(),
+                                           'cursor', next_cursor)
+        return Response(OrderedDict([
+            ('next', next_url),
+            ('results', submissions),
+        ]))
+
+    @staticmethod
+    def _get_streaming_response(format_type, submissions):
+        """
+        Writes `submissions` to the response one by one, without ever holding
+        the whole list in memory.
+        """
+        if format_type == INSTANCE_FORMAT_TYPE_XML:
+            def content():
+                yield '<root>'
+                for submission in submissions:
+                    yield submission
+                yield '</root>'
+            content_type = 'application/xml'
+        else:
+            def content():
+                encoder = JSONEncoder()
+                separator = ''
+                yield '['
+                for submission in submissions:
+                    yield separator + encoder.encode(submission)
+                    separator = ','
+                yield ']'
+            content_type = 'application/json'
+
+        return StreamingHttpResponse(content(), content_type=content_type)
 
     def retrieve(self, request, pk, *args, **kwargs):
         format_type = kwargs.get('format', request.GET.get('format', 'json'))
@@ -1010,7 +1119,10 @@ class AssetVersionViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
             # Save time by only retrieving fields from the DB that the
             # serializer will use
             _queryset = _queryset.only(
-                'uid', 'deployed', 'date_modified', 'asset_id')
+                'uid', 'deployed', 'date_modified', 'asset_id',
+                'content_blob')
+        else:
+            _queryset = _queryset.select_related('content_blob__keyframe')
         # `AssetVersionListSerializer.get_url()` asks for the asset UID
         _queryset = _queryset.select_related('asset__uid')
         return _queryset
@@ -1036,8 +1148,25 @@ class AssetViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
     >
     >       curl -X GET https://[kpi-url]/assets/
 
-    Get an hash of all `version_id`s of assets.
-    Useful to detect any changes in assets with only one call to `API`
+    Assets are paginated with `offset` and `limit` by default. Deep pages get
+    slower and slower to retrieve that way; pass `cursor` (empty for the first
+    page) to paginate with the position of the last asset instead. The `next`
+    link then carries the cursor of the following page. Pass `count=false` to
+    skip counting the assets, or `count=estimate` for an approximate count.
+
+    <pre class="prettyprint">
+    <b>GET</b> /assets/?cursor=&limit=<code>{limit}</code>&count=false
+    </pre>
+
+    > Example
+    >
+    >       curl -X GET https://[kpi-url]/assets/?cursor=&limit=100&count=false
+
+    Get a hash that changes whenever one of the assets the user can view is
+    created, modified, deleted or shared.
+    Useful to detect any changes in assets with only one call to `API`.
+    The hash is also sent as the `ETag` header; send it back in
+    `If-None-Match` to get an empty `304` response while nothing has changed
 
     <pre class="prettyprint">
     <b>GET</b> /assets/hash/
@@ -1164,6 +1293,7 @@ class AssetViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
     lookup_field = 'uid'
     permission_classes = (IsOwnerOrReadOnly,)
     filter_backends = (KpiObjectPermissionsFilter, SearchFilter)
+    pagination_class = KeysetPaginated
 
     renderer_classes = (renderers.BrowsableAPIRenderer,
                         AssetJsonRenderer,
@@ -1181,7 +1311,10 @@ class AssetViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
     def get_queryset(self, *args, **kwargs):
         queryset = super(AssetViewSet, self).get_queryset(*args, **kwargs)
         if self.action == 'list':
-            return queryset.model.optimize_queryset_for_list(queryset)
+            fields = AssetListSerializer.get_requested_fields(
+                self.request, AssetListSerializer.Meta.fields)
+            return queryset.model.optimize_queryset_for_list(
+                queryset, fields=fields)
         else:
             # This is called to retrieve an individual record. How much do we
             # have to care about optimizations for that?
@@ -1303,8 +1436,12 @@ class AssetViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
     @list_route(methods=["GET"], renderer_classes=[renderers.JSONRenderer])
     def hash(self, request):
         """
-        Creates an hash of `version_id` of all accessible assets by the user.
-        Useful to detect changes between each request.
+        Returns a hash that changes whenever one of the assets accessible by
+        the user changes (see `AssetSetVersion`). Useful to detect changes
+        between each request.
+        The hash is also sent as the `ETag` header; when it matches the
+        `If-None-Match` header of the request, the response is an empty
+        `304 Not Modified`.
 
         :param request:
         :return: JSON
@@ -1312,23 +1449,19 @@ class AssetViewSet(NestedViewSetMixin, viewsets.ModelViewSet):
         user = self.request.user
         if user.is_anonymous():
             raise exceptions.NotAuthenticated()
-        else:
-            accessible_assets = get_objects_for_user(
-                user, "view_asset", Asset).filter(asset_type=ASSET_TYPE_SURVEY)\
-                .order_by("uid")
 
-            assets_version_ids = [asset.version_id for asset in accessible_assets if asset.version_id is not None]
-            # Sort alphabetically
-            assets_version_ids.sort()
-
-            if len(assets_version_ids) > 0:
-                hash = md5("".join(assets_version_ids)).hexdigest()
-            else:
-                hash = ""
-
-            return Response({
+        hash = AssetSetVersion.get_hash(user)
+        etag = quote_etag(hash)
+        if_none_match = parse_etags(
+            request.META.get('HTTP_IF_NONE_MATCH', ''))
+        if hash in if_none_match or '*' in if_none_match:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response({
                 "hash": hash
             })
+        response['ETag'] = etag
+        return response
 
     @detail_route(renderer_classes=[renderers.JSONRenderer])
     def content(self, request, uid):